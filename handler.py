@@ -1,5 +1,7 @@
 import runpod
 from runpod.serverless.utils import rp_upload
+import asyncio
+import aiohttp
 import json
 import urllib.request
 import urllib.parse
@@ -7,12 +9,34 @@ import time
 import os
 import requests
 import base64
+import hashlib
+import re
 from io import BytesIO
 import websocket
 import uuid
-import tempfile
 import socket
+import struct
+import mmap
+import mimetypes
+import threading
+import queue
 import traceback
+import shutil
+import fcntl
+from contextlib import contextmanager
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+import multiprocessing
+from requests.adapters import HTTPAdapter
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotoConfig
+
+from output_encoding import Image, OUTPUT_ENCODING_FORMATS, transcode_image
+
+# Processes spawned by the encode pool import this module again (as __mp_main__ when it
+# is the entry point) under their own name. They must not scan, evict or load anything
+IN_CHILD_PROCESS = multiprocessing.current_process().name != "MainProcess"
 
 # Time to wait between API check attempts in milliseconds
 COMFY_API_AVAILABLE_INTERVAL_MS = 50
@@ -21,6 +45,10 @@ COMFY_API_AVAILABLE_MAX_RETRIES = 500
 # Websocket reconnection behaviour (can be overridden through environment variables)
 WEBSOCKET_RECONNECT_ATTEMPTS = int(os.environ.get("WEBSOCKET_RECONNECT_ATTEMPTS", 5))
 WEBSOCKET_RECONNECT_DELAY_S = int(os.environ.get("WEBSOCKET_RECONNECT_DELAY_S", 3))
+# Seconds a job waits for a websocket event before logging that it is still waiting
+WEBSOCKET_EVENT_TIMEOUT_S = 10
+# Number of prompts for which early events (received before the job registered) are buffered
+WEBSOCKET_PENDING_PROMPTS = 64
 
 # Extra verbose websocket trace logs (set WEBSOCKET_TRACE=true to enable)
 if os.environ.get("WEBSOCKET_TRACE", "false").lower() == "true":
@@ -28,8 +56,413 @@ if os.environ.get("WEBSOCKET_TRACE", "false").lower() == "true":
 
 # Host where ComfyUI is running
 COMFY_HOST = "127.0.0.1:8188"
+# Number of input images decoded and uploaded to ComfyUI at the same time
+COMFY_UPLOAD_WORKERS = int(os.environ.get("COMFY_UPLOAD_WORKERS", 4))
+# Number of output images fetched from ComfyUI and delivered at the same time
+COMFY_OUTPUT_WORKERS = int(os.environ.get("COMFY_OUTPUT_WORKERS", 4))
+# ComfyUI's input directory (local to the handler in the default container layout)
+COMFY_INPUT_DIR = os.environ.get("COMFY_INPUT_DIR", "/comfyui/input")
+# ComfyUI's output and temp directories, read directly instead of going through /view
+COMFY_OUTPUT_DIR = os.environ.get("COMFY_OUTPUT_DIR", "/comfyui/output")
+COMFY_TEMP_DIR = os.environ.get("COMFY_TEMP_DIR", "/comfyui/temp")
+# Read output files from the local filesystem when they exist (falls back to /view)
+OUTPUT_READ_LOCAL = os.environ.get("OUTPUT_READ_LOCAL", "true").lower() == "true"
+# Output files of at least this size in MB are memory-mapped instead of read
+OUTPUT_MMAP_MIN_MB = float(os.environ.get("OUTPUT_MMAP_MIN_MB", 8))
+# Size budget of the content-addressed input image cache in MB (0 disables the cache)
+INPUT_CACHE_MAX_MB = int(os.environ.get("INPUT_CACHE_MAX_MB", 1024))
+# Size budget of the result cache in MB (0 disables it). Repeated jobs (same workflow,
+# input images and model files) are answered from it without running ComfyUI
+RESULT_CACHE_MAX_MB = int(os.environ.get("RESULT_CACHE_MAX_MB", 0))
+# Local directory holding the result cache
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", "/tmp/comfyui-result-cache")
+# Jobs with nodes whose class matches this pattern (e.g. loading from a URL) bypass the result cache
+RESULT_CACHE_BYPASS_NODES = os.environ.get("RESULT_CACHE_BYPASS_NODES", r"(?i)random|url|http|datetime|timestamp")
+# Model directories (separated by ":") whose files identify the models in the result cache key
+COMFY_MODEL_DIRS = os.environ.get("COMFY_MODEL_DIRS", "/comfyui/models:/runpod-volume/models").split(":")
+# Let a job identical to one that is already running (same result cache key) wait for
+# that job's outputs instead of running the workflow again
+COALESCE_JOBS = os.environ.get("COALESCE_JOBS", "true").lower() == "true"
+# Experimental: wait this many ms for compatible jobs to merge into one prompt with the first one (0 disables batching).
+# Jobs are compatible when their workflows only differ in the inputs named in BATCH_VARYING_INPUTS
+BATCH_WINDOW_MS = int(os.environ.get("BATCH_WINDOW_MS", 0))
+# Maximum number of jobs merged into one prompt
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", 8))
+# Seconds the other jobs of a batch wait for the merged prompt before running on their own
+BATCH_LEADER_TIMEOUT_S = float(os.environ.get("BATCH_LEADER_TIMEOUT_S", 600))
+# Node inputs (separated by ",") whose values may differ between the jobs of a batch
+BATCH_VARYING_INPUTS = {name.strip() for name in os.environ.get("BATCH_VARYING_INPUTS", "text,seed,noise_seed").split(",") if name.strip()}
+# Size budget in MB of the cache tier shared by all workers on the network volume (0 disables it).
+# It holds input images and results, so a repeat landing on another worker is still a hit
+SHARED_CACHE_MAX_MB = int(os.environ.get("SHARED_CACHE_MAX_MB", 0))
+# Directory of the shared cache tier, on the network volume every worker mounts
+SHARED_CACHE_DIR = os.environ.get("SHARED_CACHE_DIR", "/runpod-volume/worker-comfyui/cache")
+# How input images reach ComfyUI: "upload" (POST /upload/image) or "inline"
+# (embedded in ETN_LoadImageBase64 nodes, falls back to "upload" if the node is missing)
+IMAGE_INPUT_MODE = os.environ.get("IMAGE_INPUT_MODE", "upload").lower()
+# Node class from comfyui-tooling-nodes that loads an image from a base64 string
+INLINE_IMAGE_NODE_CLASS = "ETN_LoadImageBase64"
+# How output images reach the handler: "history" (SaveImage to disk, then /history and /view)
+# or "websocket" (SaveImage replaced by ETN_SendImageWebSocket, images arrive as binary frames)
+IMAGE_OUTPUT_MODE = os.environ.get("IMAGE_OUTPUT_MODE", "history").lower()
+# Node class from comfyui-tooling-nodes that sends images over the websocket
+WEBSOCKET_IMAGE_NODE_CLASS = "ETN_SendImageWebSocket"
+# Binary websocket event carrying an encoded image, and the file extension per image type
+BINARY_EVENT_PREVIEW_IMAGE = 1
+BINARY_IMAGE_EXTENSIONS = {1: ".jpeg", 2: ".png", 3: ".webp"}
+# Response shape: "legacy" returns the first image as `message`, "images" returns every image
+RESPONSE_FORMAT = os.environ.get("RESPONSE_FORMAT", "legacy")
+RESPONSE_FORMATS = ("legacy", "images")
+# Output kinds a job can select with `input.outputs.kinds`
+OUTPUT_KINDS = ("images", "gifs", "videos", "audio")
+# Content types of output files that are missing from Python's built-in table
+# when the system has no mime.types, needed for the content type of uploads
+OUTPUT_CONTENT_TYPES = {
+    ".avif": "image/avif",
+    ".webp": "image/webp",
+    ".mkv": "video/x-matroska",
+    ".flac": "audio/flac",
+    ".ogg": "audio/ogg",
+    ".m4a": "audio/mp4",
+}
+for _extension, _content_type in OUTPUT_CONTENT_TYPES.items():
+    mimetypes.add_type(_content_type, _extension)
+# Quality used when `input.output_encoding.quality` is not given
+OUTPUT_ENCODING_QUALITY = int(os.environ.get("OUTPUT_ENCODING_QUALITY", 85))
+# Number of processes transcoding outputs
+OUTPUT_ENCODE_WORKERS = int(os.environ.get("OUTPUT_ENCODE_WORKERS", min(4, os.cpu_count() or 1)))
+# Directory of workflow templates (one API-format workflow per .json file) jobs can reference with `input.template`
+WORKFLOW_TEMPLATE_DIR = os.environ.get("WORKFLOW_TEMPLATE_DIR", "/workflows")
 # Enforce a clean state after each job is done
 REFRESH_WORKER = os.environ.get("REFRESH_WORKER", "false").lower() == "true"
+# Run the asyncio job pipeline (aiohttp transport) instead of the blocking one
+COMFY_ASYNC_HANDLER = os.environ.get("COMFY_ASYNC_HANDLER", "false").lower() == "true"
+# Stream progress and every output image as it is ready (generator handler, asyncio pipeline)
+COMFY_STREAM_OUTPUTS = os.environ.get("COMFY_STREAM_OUTPUTS", "false").lower() == "true"
+# Bounds for the number of jobs a worker accepts at once (1 = one job at a time)
+COMFY_MIN_CONCURRENCY = int(os.environ.get("COMFY_MIN_CONCURRENCY", 1))
+COMFY_MAX_CONCURRENCY = int(os.environ.get("COMFY_MAX_CONCURRENCY", 1))
+# Number of prompts ComfyUI should have queued (running one included) so the GPU never waits for the CPU side
+COMFY_TARGET_QUEUE_DEPTH = int(os.environ.get("COMFY_TARGET_QUEUE_DEPTH", 2))
+# Minimum seconds between concurrency changes; RunPod drains in-flight jobs before it resizes
+COMFY_CONCURRENCY_ADJUST_INTERVAL_S = float(os.environ.get("COMFY_CONCURRENCY_ADJUST_INTERVAL_S", 30))
+
+# Maximum number of keep-alive connections kept open to ComfyUI
+COMFY_HTTP_POOL_SIZE = int(os.environ.get("COMFY_HTTP_POOL_SIZE", 16))
+# Number of retries for idempotent ComfyUI HTTP calls (connection errors and 502/503/504)
+COMFY_HTTP_RETRIES = int(os.environ.get("COMFY_HTTP_RETRIES", 2))
+# Base delay between retries in seconds, doubled after every attempt
+COMFY_HTTP_RETRY_BACKOFF_S = float(os.environ.get("COMFY_HTTP_RETRY_BACKOFF_S", 0.25))
+# Deliver outputs with identical content once and report the copies as references
+OUTPUT_DEDUP = os.environ.get("OUTPUT_DEDUP", "true").lower() == "true"
+# Response share in MB for outputs inlined as base64 when S3 or upload URLs are available;
+# outputs beyond it go to object storage (0 = always use object storage when available)
+INLINE_RESPONSE_BUDGET_MB = float(os.environ.get("INLINE_RESPONSE_BUDGET_MB", 0))
+# Chunk size in KB used to stream outputs to S3 or presigned URLs
+OUTPUT_STREAM_CHUNK_KB = int(os.environ.get("OUTPUT_STREAM_CHUNK_KB", 1024))
+# Timeout in seconds for uploading one output to a presigned URL
+OUTPUT_UPLOAD_TIMEOUT_S = 300
+# Retries for uploads to client-supplied presigned URLs (connection errors, 429 and 5xx)
+OUTPUT_UPLOAD_RETRIES = int(os.environ.get("OUTPUT_UPLOAD_RETRIES", 2))
+# Output files uploaded to S3 at the same time, across all jobs
+S3_MAX_CONCURRENT_UPLOADS = int(os.environ.get("S3_MAX_CONCURRENT_UPLOADS", 8))
+# Files of at least this size in MB are sent as multipart uploads (e.g. videos)
+S3_MULTIPART_THRESHOLD_MB = int(os.environ.get("S3_MULTIPART_THRESHOLD_MB", 16))
+S3_MULTIPART_CHUNK_MB = int(os.environ.get("S3_MULTIPART_CHUNK_MB", 8))
+# Parts of one multipart upload sent at the same time
+S3_MULTIPART_CONCURRENCY = int(os.environ.get("S3_MULTIPART_CONCURRENCY", 4))
+# Lifetime of the presigned URLs returned for uploaded files (7 days, like rp_upload)
+S3_PRESIGNED_URL_EXPIRY_S = 604800
+# Per-endpoint request timeout (seconds) and whether a failed call may be retried.
+# Queuing a prompt is never retried because ComfyUI would execute it twice.
+COMFY_HTTP_ENDPOINTS = {
+    "probe": {"timeout": 5, "retry": False},
+    "upload": {"timeout": 30, "retry": True},
+    "prompt": {"timeout": 30, "retry": False},
+    "history": {"timeout": 30, "retry": True},
+    "view": {"timeout": 60, "retry": True},
+    "object_info": {"timeout": 10, "retry": True},
+}
+COMFY_HTTP_RETRY_STATUS_CODES = (502, 503, 504)
+
+# ---------------------------------------------------------------------------
+# Shared HTTP client for all calls to the ComfyUI API
+# ---------------------------------------------------------------------------
+
+class ComfyClient:
+    """
+    Thread-safe HTTP client for the ComfyUI API.
+
+    Every thread gets its own requests.Session, but all sessions are mounted on
+    the same HTTPAdapter, so they share one keep-alive connection pool. A job
+    therefore reuses warm connections instead of opening a new TCP connection
+    for every call.
+    """
+
+    def __init__(self, host, pool_size=COMFY_HTTP_POOL_SIZE, retries=COMFY_HTTP_RETRIES,
+                 backoff_s=COMFY_HTTP_RETRY_BACKOFF_S, endpoints=COMFY_HTTP_ENDPOINTS):
+        self.base_url = f"http://{host}"
+        self.retries = retries
+        self.backoff_s = backoff_s
+        self.endpoints = endpoints
+        # Retries are handled in request() so the policy can differ per endpoint
+        self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        """Return the calling thread's session, creating it on first use."""
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.mount("http://", self._adapter)
+            session.mount("https://", self._adapter)
+            self._local.session = session
+        return session
+
+    def url(self, path):
+        """Build an absolute URL for a ComfyUI path; absolute URLs are passed through."""
+        if "://" in path:
+            return path
+        return f"{self.base_url}{path}"
+
+    def request(self, method, path, endpoint, **kwargs):
+        """
+        Send a request using the timeout and retry policy configured for `endpoint`.
+        """
+        policy = self.endpoints[endpoint]
+        kwargs.setdefault("timeout", policy["timeout"])
+        attempts = 1 + (self.retries if policy["retry"] else 0)
+        url = self.url(path)
+
+        for attempt in range(attempts):
+            is_last_attempt = attempt == attempts - 1
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.ConnectionError as e:
+                if is_last_attempt:
+                    raise
+                print(f"worker-comfyui - {method} {url} failed ({e}), retrying ({attempt + 1}/{attempts - 1})...")
+            else:
+                if is_last_attempt or response.status_code not in COMFY_HTTP_RETRY_STATUS_CODES:
+                    return response
+                print(f"worker-comfyui - {method} {url} returned {response.status_code}, retrying ({attempt + 1}/{attempts - 1})...")
+                response.close()
+            time.sleep(self.backoff_s * (2 ** attempt))
+
+    def get(self, path, endpoint, **kwargs):
+        return self.request("GET", path, endpoint, **kwargs)
+
+    def post(self, path, endpoint, **kwargs):
+        return self.request("POST", path, endpoint, **kwargs)
+
+    def close(self):
+        """Close all pooled connections."""
+        self._adapter.close()
+
+comfy_client = ComfyClient(COMFY_HOST)
+
+# ---------------------------------------------------------------------------
+# S3 uploads: one pooled boto3 client, uploads straight from memory
+# ---------------------------------------------------------------------------
+
+class S3Uploader:
+    """
+    Uploads output files to an S3 compatible bucket from memory.
+
+    The boto3 client (and its connection pool) is created once and shared by
+    all threads. At most `max_uploads` files are uploaded at once; files of at
+    least `multipart_threshold` bytes are sent as multipart uploads with up to
+    `multipart_concurrency` parts in flight. Object keys and the returned
+    presigned URLs follow rp_upload.upload_image().
+    """
+
+    def __init__(
+        self,
+        endpoint_url,
+        access_key_id=None,
+        secret_access_key=None,
+        bucket_name=None,
+        max_uploads=S3_MAX_CONCURRENT_UPLOADS,
+        multipart_threshold=S3_MULTIPART_THRESHOLD_MB * 1024 * 1024,
+        multipart_chunksize=S3_MULTIPART_CHUNK_MB * 1024 * 1024,
+        multipart_concurrency=S3_MULTIPART_CONCURRENCY,
+    ):
+        self.endpoint_url = endpoint_url
+        self.bucket_name = bucket_name
+        self.client = boto3.session.Session().client(
+            "s3",
+            endpoint_url=endpoint_url,
+            aws_access_key_id=access_key_id,
+            aws_secret_access_key=secret_access_key,
+            region_name=rp_upload.extract_region_from_url(endpoint_url),
+            config=BotoConfig(
+                signature_version="s3v4",
+                retries={"max_attempts": 3, "mode": "standard"},
+                max_pool_connections=max_uploads * multipart_concurrency,
+                # Plain payloads, many S3 compatible stores reject aws-chunked checksum trailers
+                request_checksum_calculation="when_required",
+                response_checksum_validation="when_required",
+            ),
+        )
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_chunksize,
+            max_concurrency=multipart_concurrency,
+            use_threads=multipart_concurrency > 1,
+        )
+        self._slots = threading.BoundedSemaphore(max_uploads)
+
+    def upload(self, job_id, filename, data, content_type=None):
+        """
+        Upload `data` (bytes, a memory map or a readable stream) and return a
+        presigned GET URL. Streams are read in multipart chunks, never whole.
+        """
+        extension = os.path.splitext(filename)[1]
+        bucket = self.bucket_name or time.strftime("%m-%y")
+        key = f"{job_id}/{uuid.uuid4().hex[:8]}{extension}"
+        content_type = content_type or mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+        if hasattr(data, "read"):
+            body = data
+        else:
+            body = data if isinstance(data, mmap.mmap) else BytesIO(data)
+            body.seek(0)
+        with self._slots:
+            self.client.upload_fileobj(
+                body, bucket, key, ExtraArgs={"ContentType": content_type}, Config=self.transfer_config
+            )
+        return self.client.generate_presigned_url(
+            "get_object", Params={"Bucket": bucket, "Key": key}, ExpiresIn=S3_PRESIGNED_URL_EXPIRY_S
+        )
+
+_s3_uploaders = {}
+_s3_uploaders_lock = threading.Lock()
+
+def get_s3_uploader():
+    """
+    Return the shared S3Uploader for the bucket configured in the environment,
+    or None if BUCKET_ENDPOINT_URL is not set.
+    """
+    endpoint_url = os.environ.get("BUCKET_ENDPOINT_URL")
+    if not endpoint_url:
+        return None
+    settings = (
+        endpoint_url,
+        os.environ.get("BUCKET_ACCESS_KEY_ID"),
+        os.environ.get("BUCKET_SECRET_ACCESS_KEY"),
+        os.environ.get("BUCKET_NAME"),
+    )
+    with _s3_uploaders_lock:
+        if settings not in _s3_uploaders:
+            _s3_uploaders[settings] = S3Uploader(*settings)
+        return _s3_uploaders[settings]
+
+# ---------------------------------------------------------------------------
+# Output streaming: source -> optional transform -> sink in fixed-size chunks,
+# so the memory a delivery needs does not grow with the size of the output
+# ---------------------------------------------------------------------------
+
+class ChunkStream:
+    """
+    Read-only file object over an iterator of byte chunks, so boto3 and
+    requests can consume a chunk pipeline like a file. Never buffers more
+    than one chunk plus the requested read size.
+    """
+
+    def __init__(self, chunks, size=None):
+        self._chunks = iter(chunks)
+        self._buffer = bytearray()
+        # requests sends a Content-Length header for objects with a `len`
+        if size is not None:
+            self.len = size
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = bytes(self._buffer) + b"".join(self._chunks)
+            self._buffer.clear()
+            return data
+        while len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+def _file_chunks(path, chunk_size):
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+def _response_chunks(response, chunk_size):
+    try:
+        yield from response.iter_content(chunk_size)
+    finally:
+        response.close()
+
+def open_output_source(filename, subfolder, image_type, chunk_size=OUTPUT_STREAM_CHUNK_KB * 1024):
+    """
+    Open an output file as a stream source. Returns (chunk iterator, size in
+    bytes or None). Reads the local file if there is one, otherwise streams
+    the /view response without loading it into memory.
+    """
+    path = _local_output_file(filename, subfolder, image_type)
+    if path is not None:
+        print(f"worker-comfyui - Streaming {filename} from {path}")
+        return _file_chunks(path, chunk_size), os.path.getsize(path)
+
+    print(f"worker-comfyui - Streaming {filename} from /view")
+    params = urllib.parse.urlencode({"filename": filename, "subfolder": subfolder, "type": image_type})
+    response = comfy_client.get(f"/view?{params}", "view", stream=True)
+    try:
+        response.raise_for_status()
+    except requests.HTTPError:
+        response.close()
+        raise
+    size = response.headers.get("Content-Length")
+    return _response_chunks(response, chunk_size), int(size) if size else None
+
+def stream_output(source, sink, transform=None):
+    """
+    Move an output from `source` ((chunk iterator, size) from
+    open_output_source()) to `sink`, a callable that consumes a ChunkStream
+    and returns where the data went. `transform` may wrap the chunk iterator;
+    the size is then unknown unless the transform keeps it unchanged.
+    """
+    chunks, size = source
+    if transform is not None:
+        chunks = transform(chunks)
+        size = None
+    try:
+        return sink(ChunkStream(chunks, size))
+    finally:
+        # Release the file or connection even if the sink stopped early
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+upload_session = requests.Session()
+upload_session.mount("https://", HTTPAdapter(pool_connections=COMFY_HTTP_POOL_SIZE, pool_maxsize=COMFY_HTTP_POOL_SIZE))
+upload_session.mount("http://", HTTPAdapter(pool_connections=COMFY_HTTP_POOL_SIZE, pool_maxsize=COMFY_HTTP_POOL_SIZE))
+
+def put_presigned_url(url, stream, content_type="application/octet-stream"):
+    """
+    Sink for stream_output(): PUT the stream to a presigned URL and return the
+    URL of the object (the presigned URL without its query string). S3 needs a
+    Content-Length, so the stream must know its size.
+    """
+    if getattr(stream, "len", None) is None:
+        raise ValueError("Presigned uploads need a known size")
+    response = upload_session.put(url, data=stream, headers={"Content-Type": content_type}, timeout=OUTPUT_UPLOAD_TIMEOUT_S)
+    response.raise_for_status()
+    return url.split("?", 1)[0]
 
 # ---------------------------------------------------------------------------
 # Helper: quick reachability probe of ComfyUI HTTP endpoint (port 8188)
@@ -38,7 +471,7 @@ REFRESH_WORKER = os.environ.get("REFRESH_WORKER", "false").lower() == "true"
 def _comfy_server_status():
     """Return a dictionary with basic reachability info for the ComfyUI HTTP server."""
     try:
-        resp = requests.get(f"http://{COMFY_HOST}/", timeout=5)
+        resp = comfy_client.get("/", "probe")
         return {
             "reachable": resp.status_code == 200,
             "status_code": resp.status_code,
@@ -76,6 +509,334 @@ def _attempt_websocket_reconnect(ws_url, max_attempts, delay_s, initial_error):
     print("worker-comfyui - Failed to reconnect websocket after connection closed.")
     raise websocket.WebSocketConnectionClosedException(f"Connection closed and failed to reconnect. Last error: {last_reconnect_error}")
 
+class _PromptEventRouter:
+    """
+    Routes ComfyUI websocket events to per-prompt queues.
+
+    Every event that carries a `prompt_id` is put on the queue of the job
+    waiting on that prompt. Events that arrive before the job has registered
+    (ComfyUI can start executing before /prompt returns) are buffered and
+    replayed on register(). Subclasses own the connection and set
+    `queue_factory` to the queue type their waiters read from.
+    """
+
+    queue_factory = queue.Queue
+
+    def __init__(self, host, client_id=None):
+        self.client_id = client_id or str(uuid.uuid4())
+        self.ws_url = f"ws://{host}/ws?clientId={self.client_id}"
+        self.queue_remaining = None
+        self._queue_low_water = None
+        self._executing = None
+        self._lock = threading.Lock()
+        self._waiters = {}
+        self._pending = OrderedDict()
+
+    def register(self, prompt_id):
+        """Return the event queue for `prompt_id`, pre-filled with any buffered events."""
+        events = self.queue_factory()
+        with self._lock:
+            for message in self._pending.pop(prompt_id, []):
+                events.put_nowait(message)
+            self._waiters[prompt_id] = events
+        return events
+
+    def take_queue_low_water(self):
+        """
+        Return the lowest queue_remaining reported since the previous call
+        (None if no status was received) and start a new observation window.
+        """
+        low_water = self._queue_low_water
+        self._queue_low_water = self.queue_remaining
+        return low_water
+
+    def unregister(self, prompt_id):
+        with self._lock:
+            self._waiters.pop(prompt_id, None)
+            self._pending.pop(prompt_id, None)
+
+    def _broadcast(self, message):
+        with self._lock:
+            for events in self._waiters.values():
+                events.put_nowait(message)
+
+    def _dispatch(self, message):
+        """Route one decoded websocket message to the job waiting on its prompt."""
+        msg_type = message.get("type")
+        data = message.get("data") or {}
+
+        if msg_type == "status":
+            queue_remaining = data.get("status", {}).get("exec_info", {}).get("queue_remaining")
+            self.queue_remaining = queue_remaining
+            if queue_remaining is not None and (self._queue_low_water is None or queue_remaining < self._queue_low_water):
+                self._queue_low_water = queue_remaining
+            print(f"worker-comfyui - Status update: {'N/A' if queue_remaining is None else queue_remaining} items remaining in queue")
+            return
+
+        prompt_id = data.get("prompt_id")
+        if prompt_id is None:
+            return
+
+        if msg_type == "executing":
+            # Binary frames carry no prompt_id; remember who is executing to route them
+            self._executing = (prompt_id, data["node"]) if data.get("node") is not None else None
+
+        self._route(prompt_id, message)
+
+    def _dispatch_binary(self, payload):
+        """
+        Route a binary frame (an image sent by a node) to the prompt that is
+        currently executing. ComfyUI executes one prompt at a time, so the
+        last `executing` event tells which prompt and node sent it.
+        """
+        if len(payload) < 8 or self._executing is None:
+            return
+        event, image_type = struct.unpack(">II", payload[:8])
+        if event != BINARY_EVENT_PREVIEW_IMAGE:
+            return
+        prompt_id, node = self._executing
+        self._route(prompt_id, {
+            "type": "binary",
+            "data": {"prompt_id": prompt_id, "node": node, "image_type": image_type, "image": payload[8:]},
+        })
+
+    def _route(self, prompt_id, message):
+        with self._lock:
+            events = self._waiters.get(prompt_id)
+            if events is not None:
+                events.put_nowait(message)
+                return
+            self._pending.setdefault(prompt_id, []).append(message)
+            self._pending.move_to_end(prompt_id)
+            while len(self._pending) > WEBSOCKET_PENDING_PROMPTS:
+                self._pending.popitem(last=False)
+
+class ComfyWebsocketManager(_PromptEventRouter):
+    """
+    Worker-lifetime websocket connection to ComfyUI shared by all jobs.
+
+    A background reader thread owns the socket and routes events to the
+    waiting jobs. When the connection drops, the reader reconnects and tells
+    all waiters with a synthetic `reconnected` event, or a `connection_lost`
+    event if reconnecting failed.
+    """
+
+    def __init__(self, host, client_id=None):
+        super().__init__(host, client_id)
+        self._ws = None
+        self._thread = None
+
+    @property
+    def connected(self):
+        return self._ws is not None and self._ws.connected
+
+    @property
+    def reader_alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """Connect and start the reader thread unless it is already running."""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            print(f"worker-comfyui - Connecting to websocket: {self.ws_url}")
+            ws = websocket.WebSocket()
+            ws.connect(self.ws_url, timeout=WEBSOCKET_EVENT_TIMEOUT_S)
+            print(f"worker-comfyui - Websocket connected")
+            self._ws = ws
+            self._thread = threading.Thread(target=self._read_loop, name="comfy-websocket", daemon=True)
+            self._thread.start()
+
+    def _read_loop(self):
+        while True:
+            try:
+                out = self._ws.recv()
+                if isinstance(out, str):
+                    self._dispatch(json.loads(out))
+                else:
+                    self._dispatch_binary(out)
+            except websocket.WebSocketTimeoutException:
+                continue
+            except json.JSONDecodeError:
+                print(f"worker-comfyui - Received invalid JSON message via websocket.")
+            except (websocket.WebSocketConnectionClosedException, ConnectionError, OSError) as closed_err:
+                try:
+                    self._ws = _attempt_websocket_reconnect(self.ws_url, WEBSOCKET_RECONNECT_ATTEMPTS, WEBSOCKET_RECONNECT_DELAY_S, closed_err)
+                    print("worker-comfyui - Resuming message listening after successful reconnect.")
+                    self._broadcast({"type": "reconnected", "data": {}})
+                except websocket.WebSocketConnectionClosedException as reconn_failed_err:
+                    self._ws = None
+                    self._broadcast({"type": "connection_lost", "data": {"error": str(reconn_failed_err)}})
+                    return
+            except Exception as e:
+                # Protocol errors or a failing dispatch: drop the socket so the next job reconnects
+                print(f"worker-comfyui - Websocket reader failed: {e}")
+                print(traceback.format_exc())
+                ws, self._ws = self._ws, None
+                try:
+                    ws.close()
+                except Exception:
+                    pass
+                self._broadcast({"type": "connection_lost", "data": {"error": f"Websocket reader failed: {e}"}})
+                return
+
+ws_manager = ComfyWebsocketManager(COMFY_HOST)
+
+# ---------------------------------------------------------------------------
+# Workflow templates: workflows loaded and validated once at startup, which
+# jobs reference by id with a few overrides instead of sending the whole graph
+# ---------------------------------------------------------------------------
+
+# Numeric overrides of `input.overrides` and the node inputs each one sets
+TEMPLATE_NUMBER_OVERRIDES = {"seed": ("seed", "noise_seed"), "width": ("width",), "height": ("height",)}
+TEMPLATE_OVERRIDES = ("prompt", "negative_prompt", *TEMPLATE_NUMBER_OVERRIDES, "images", "nodes")
+
+def _is_node_link(value, workflow):
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[1], int) and str(value[0]) in workflow
+
+def workflow_error(workflow):
+    """
+    Return what is wrong with the structure of an API-format workflow, or None.
+    """
+    if not isinstance(workflow, dict) or not workflow:
+        return "the workflow must be a non-empty object of nodes"
+    for node_id, node in workflow.items():
+        if not isinstance(node, dict) or not isinstance(node.get("class_type"), str):
+            return f"node {node_id} has no 'class_type'"
+        if not isinstance(node.get("inputs", {}), dict):
+            return f"the inputs of node {node_id} are not an object"
+        for name, value in node.get("inputs", {}).items():
+            if isinstance(value, list) and len(value) == 2 and isinstance(value[1], int) and str(value[0]) not in workflow:
+                return f"input '{name}' of node {node_id} links to missing node {value[0]}"
+    return None
+
+def _upstream_text_nodes(workflow, node_id, found, seen):
+    """
+    Collect the prompt nodes (with a string `text` input) node_id is computed from.
+    """
+    if node_id in seen:
+        return
+    seen.add(node_id)
+    inputs = workflow[node_id].get("inputs", {})
+    if isinstance(inputs.get("text"), str):
+        found.add(node_id)
+        return
+    for value in inputs.values():
+        if _is_node_link(value, workflow):
+            _upstream_text_nodes(workflow, str(value[0]), found, seen)
+
+class WorkflowTemplate:
+    """
+    A validated workflow and the node inputs its overrides set, found once
+    when the template is loaded.
+    """
+
+    def __init__(self, template_id, workflow):
+        self.id = template_id
+        self.workflow = {str(node_id): node for node_id, node in workflow.items()}
+        self.targets = {name: [] for name in TEMPLATE_OVERRIDES if name != "nodes"}
+
+        # Prompt nodes feeding a `negative` input (and no `positive` one) take the negative prompt
+        linked = {"positive": set(), "negative": set()}
+        for node in self.workflow.values():
+            for name, value in node.get("inputs", {}).items():
+                if name in linked and _is_node_link(value, self.workflow):
+                    _upstream_text_nodes(self.workflow, str(value[0]), linked[name], set())
+        negative = linked["negative"] - linked["positive"]
+
+        for node_id in sorted(self.workflow, key=lambda node_id: (len(node_id), node_id)):
+            inputs = self.workflow[node_id].get("inputs", {})
+            if isinstance(inputs.get("text"), str):
+                self.targets["negative_prompt" if node_id in negative else "prompt"].append((node_id, "text"))
+            for override, names in TEMPLATE_NUMBER_OVERRIDES.items():
+                self.targets[override].extend((node_id, name) for name in names if isinstance(inputs.get(name), int) and not isinstance(inputs.get(name), bool))
+            if self.workflow[node_id]["class_type"] == "LoadImage" and isinstance(inputs.get("image"), str):
+                self.targets["images"].append((node_id, "image"))
+
+    def instantiate(self, overrides):
+        """
+        Return the workflow with the overrides applied and None, or None and
+        an error message. Only the nodes that change are copied.
+        """
+        overrides = overrides or {}
+        if not isinstance(overrides, dict):
+            return None, "'overrides' must be an object"
+        unknown = sorted(set(overrides) - set(TEMPLATE_OVERRIDES))
+        if unknown:
+            return None, f"Unknown override(s) {', '.join(unknown)}, expected: {', '.join(TEMPLATE_OVERRIDES)}"
+
+        changes = {}
+        for name, value in overrides.items():
+            if name == "nodes":
+                continue
+            targets = self.targets[name]
+            if not targets:
+                return None, f"Template '{self.id}' has no input for override '{name}'"
+            if name in ("prompt", "negative_prompt"):
+                if not isinstance(value, str):
+                    return None, f"'overrides.{name}' must be a string"
+                values = [value] * len(targets)
+            elif name == "images":
+                if not isinstance(value, list) or not all(isinstance(image, str) for image in value) or len(value) > len(targets):
+                    return None, f"'overrides.images' must be a list of at most {len(targets)} file name(s)"
+                values = value
+            else:
+                if not isinstance(value, int) or isinstance(value, bool):
+                    return None, f"'overrides.{name}' must be an integer"
+                values = [value] * len(targets)
+            for (node_id, input_name), input_value in zip(targets, values):
+                changes.setdefault(node_id, {})[input_name] = input_value
+
+        node_overrides = overrides.get("nodes", {})
+        if not isinstance(node_overrides, dict):
+            return None, "'overrides.nodes' must be an object of node ids"
+        for node_id, inputs in node_overrides.items():
+            node = self.workflow.get(str(node_id))
+            if node is None or not isinstance(inputs, dict):
+                return None, f"'overrides.nodes' references unknown node {node_id} of template '{self.id}'"
+            for input_name, input_value in inputs.items():
+                if input_name not in node.get("inputs", {}) or _is_node_link(node["inputs"][input_name], self.workflow):
+                    return None, f"Node {node_id} of template '{self.id}' has no widget input '{input_name}'"
+                changes.setdefault(str(node_id), {})[input_name] = input_value
+
+        workflow = dict(self.workflow)
+        for node_id, inputs in changes.items():
+            node = workflow[node_id]
+            workflow[node_id] = {**node, "inputs": {**node.get("inputs", {}), **inputs}}
+        return workflow, None
+
+def load_workflow_templates(directory):
+    """
+    Load every .json file of `directory` as a template whose id is the file
+    name without extension. A file holds an API-format workflow, or a job
+    input like test_resources/workflows (`{"input": {"workflow": ...}}`).
+    Invalid files are reported and skipped.
+    """
+    templates = {}
+    if not directory or not os.path.isdir(directory):
+        return templates
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".json"):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            with open(path) as f:
+                workflow = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"worker-comfyui - Skipping workflow template {path}: {e}")
+            continue
+        if isinstance(workflow, dict) and isinstance(workflow.get("input"), dict):
+            workflow = workflow["input"].get("workflow")
+        error = workflow_error(workflow)
+        if error:
+            print(f"worker-comfyui - Skipping workflow template {path}: {error}")
+            continue
+        templates[name[: -len(".json")]] = WorkflowTemplate(name[: -len(".json")], workflow)
+    print(f"worker-comfyui - Loaded {len(templates)} workflow template(s) from {directory}")
+    return templates
+
+workflow_templates = load_workflow_templates(WORKFLOW_TEMPLATE_DIR) if not IN_CHILD_PROCESS else {}
+
 def validate_input(job_input):
     """
     Validates the input for the handler function.
@@ -91,6 +852,18 @@ def validate_input(job_input):
             return None, "Invalid JSON format in input"
 
     workflow = job_input.get("workflow")
+    template_id = job_input.get("template")
+    if template_id is not None:
+        if workflow is not None:
+            return None, "Pass either 'workflow' or 'template', not both"
+        template = workflow_templates.get(template_id) if isinstance(template_id, str) else None
+        if template is None:
+            return None, f"Unknown template '{template_id}', available: {', '.join(sorted(workflow_templates)) or 'none'}"
+        workflow, error_message = template.instantiate(job_input.get("overrides"))
+        if error_message:
+            return None, error_message
+    elif job_input.get("overrides") is not None:
+        return None, "'overrides' requires 'template'"
     if workflow is None:
         return None, "Missing 'workflow' parameter"
 
@@ -112,7 +885,99 @@ def validate_input(job_input):
             if not isinstance(img, dict) or "name" not in img or "image" not in img:
                 return None, "Each image must contain 'name' and 'image' keys"
 
-    return {"workflow": workflow, "images": images}, None
+    validated = {"workflow": workflow, "images": images}
+    if job_input.get("outputs") is not None:
+        output_selection, error_message = _validate_output_selection(job_input["outputs"])
+        if error_message:
+            return None, error_message
+        validated["outputs"] = output_selection
+    upload_urls = job_input.get("upload_urls")
+    if upload_urls is not None:
+        # Either a URL template (string) or one URL per output
+        urls = [upload_urls] if isinstance(upload_urls, str) else upload_urls
+        if not isinstance(urls, list) or not urls or not all(
+            isinstance(url, str) and url.startswith(("http://", "https://")) for url in urls
+        ):
+            return None, "'upload_urls' must be an http(s) URL template or a non-empty list of http(s) URLs"
+        validated["upload_urls"] = upload_urls
+
+    response_format = job_input.get("response_format")
+    if response_format is not None:
+        if response_format not in RESPONSE_FORMATS:
+            return None, f"'response_format' must be one of: {', '.join(RESPONSE_FORMATS)}"
+        validated["response_format"] = response_format
+
+    cache = job_input.get("cache")
+    if cache is not None:
+        if not isinstance(cache, bool):
+            return None, "'cache' must be a boolean"
+        validated["cache"] = cache
+
+    if job_input.get("output_encoding") is not None:
+        output_encoding, error_message = _validate_output_encoding(job_input["output_encoding"])
+        if error_message:
+            return None, error_message
+        validated["output_encoding"] = output_encoding
+
+    return validated, None
+
+def _validate_output_selection(selection):
+    """
+    Validate `input.outputs`, the outputs a client wants returned:
+    `nodes` (output node ids), `kinds` (output keys such as "images") and
+    `limit` (maximum number of images). Returns (selection, error message).
+    """
+    if not isinstance(selection, dict):
+        return None, "'outputs' must be an object"
+
+    nodes = selection.get("nodes")
+    if nodes is not None:
+        if not isinstance(nodes, list) or not all(isinstance(node, (str, int)) for node in nodes):
+            return None, "'outputs.nodes' must be a list of node ids"
+        nodes = [str(node) for node in nodes]
+
+    kinds = selection.get("kinds")
+    if kinds is not None:
+        if not isinstance(kinds, list) or not all(isinstance(kind, str) for kind in kinds) or not set(kinds) <= set(OUTPUT_KINDS):
+            return None, f"'outputs.kinds' must be a list of: {', '.join(OUTPUT_KINDS)}"
+
+    limit = selection.get("limit")
+    if limit is not None and (not isinstance(limit, int) or isinstance(limit, bool) or limit < 1):
+        return None, "'outputs.limit' must be a positive integer"
+
+    return {"nodes": nodes, "kinds": kinds, "limit": limit}, None
+
+def _validate_output_encoding(encoding):
+    """
+    Validate `input.output_encoding`, how output images are transcoded:
+    `format` (webp, avif, jpeg or png), `quality` (1-100), `max_dimension`
+    (longest side in pixels) and `thumbnail` (longest side of an additional
+    preview). Returns (encoding, error message).
+    """
+    if not isinstance(encoding, dict):
+        return None, "'output_encoding' must be an object"
+
+    image_format = encoding.get("format")
+    if image_format not in OUTPUT_ENCODING_FORMATS:
+        return None, f"'output_encoding.format' must be one of: {', '.join(OUTPUT_ENCODING_FORMATS)}"
+    if Image is None:
+        return None, "'output_encoding' requires Pillow, which is not installed"
+    Image.init()
+    if OUTPUT_ENCODING_FORMATS[image_format][0] not in Image.SAVE:
+        return None, f"Pillow cannot write {image_format} on this worker"
+
+    quality = encoding.get("quality", OUTPUT_ENCODING_QUALITY)
+    if not isinstance(quality, int) or isinstance(quality, bool) or not 1 <= quality <= 100:
+        return None, "'output_encoding.quality' must be an integer from 1 to 100"
+
+    sizes = {}
+    for key in ("max_dimension", "thumbnail"):
+        value = encoding.get(key)
+        if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value < 1):
+            return None, f"'output_encoding.{key}' must be a positive integer"
+        sizes[key] = value
+
+    return {"format": image_format, "quality": quality, **sizes}, None
 
 def check_server(url, retries=500, delay=50):
     """
@@ -121,7 +986,7 @@ def check_server(url, retries=500, delay=50):
     print(f"worker-comfyui - Checking API server at {url}...")
     for i in range(retries):
         try:
-            response = requests.get(url, timeout=5)
+            response = comfy_client.get(url, "probe")
             if response.status_code == 200:
                 print(f"worker-comfyui - API is reachable")
                 return True
@@ -134,59 +999,494 @@ def check_server(url, retries=500, delay=50):
     print(f"worker-comfyui - Failed to connect to server at {url} after {retries} attempts.")
     return False
 
-def upload_images(images):
+def _decode_image_data(image_data_uri):
     """
-    Upload a list of base64 encoded images to the ComfyUI server.
-    Maintains backwards compatibility with single image upload.
+    Decode a base64 image, stripping a Data URI prefix if present.
     """
-    if not images:
-        return {"status": "success", "message": "No images to upload", "details": []}
+    if "," in image_data_uri:
+        base64_data = image_data_uri.split(",", 1)[1]
+    else:
+        base64_data = image_data_uri
+    return base64.b64decode(base64_data)
 
-    responses = []
-    upload_errors = []
+def _decoded_input_image(image):
+    """
+    Return the decoded bytes of a job's input image and their SHA-256. They
+    are kept on the image, so the result cache key and the upload decode and
+    hash it once.
+    """
+    if "_decoded" not in image:
+        blob = _decode_image_data(image["image"])
+        image["_decoded"] = (blob, hashlib.sha256(blob).hexdigest())
+    return image["_decoded"]
 
-    print(f"worker-comfyui - Uploading {len(images)} image(s)...")
+class InputImageCache:
+    """
+    Index of the content-addressed input images in ComfyUI's input directory.
+
+    Input images are stored under the SHA-256 of their decoded bytes, so an
+    image a previous job already uploaded is not sent again. The stable names
+    also let ComfyUI's executor cache reuse the results of downstream nodes.
+    Once the indexed images exceed `max_bytes`, the least recently used ones
+    are deleted. Images used by running jobs are pinned and never evicted.
+    If the input directory is not local (remote ComfyUI), the index only
+    covers this worker's own uploads and evicted files are left in place.
+    """
 
-    for image in images:
-        try:
-            name = image["name"]
-            image_data_uri = image["image"]
+    NAME_PATTERN = re.compile(r"^[0-9a-f]{64}(\.[A-Za-z0-9]+)?$")
+
+    def __init__(self, input_dir, max_bytes):
+        self.input_dir = input_dir
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._pins = Counter()
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._scan()
+
+    @staticmethod
+    def stored_name(name, blob, digest=None):
+        """Return the content-addressed file name for an image (`digest` is the SHA-256 of blob, if known)."""
+        extension = os.path.splitext(name)[1].lower() or ".png"
+        return (digest or hashlib.sha256(blob).hexdigest()) + extension
+
+    def _scan(self):
+        """Index content-addressed images left in the input directory by earlier runs."""
+        if not os.path.isdir(self.input_dir):
+            return
+        found = []
+        for entry in os.scandir(self.input_dir):
+            if entry.is_file() and self.NAME_PATTERN.match(entry.name):
+                stat = entry.stat()
+                found.append((stat.st_atime, entry.name, stat.st_size))
+        with self._lock:
+            for _, name, size in sorted(found):
+                self._entries[name] = size
+                self._total_bytes += size
+            self._evict()
+
+    def acquire(self, stored_name):
+        """Pin `stored_name` and return True if it is already in the input directory."""
+        with self._lock:
+            if stored_name not in self._entries:
+                self.misses += 1
+                return False
+            if os.path.isdir(self.input_dir) and not os.path.exists(os.path.join(self.input_dir, stored_name)):
+                # Removed behind our back, e.g. by a manual cleanup
+                self._total_bytes -= self._entries.pop(stored_name)
+                self.misses += 1
+                return False
+            self._entries.move_to_end(stored_name)
+            self._pins[stored_name] += 1
+            self.hits += 1
+            return True
+
+    def add(self, stored_name, size):
+        """Record (and pin) an image that was just uploaded."""
+        with self._lock:
+            self._total_bytes -= self._entries.pop(stored_name, 0)
+            self._entries[stored_name] = size
+            self._total_bytes += size
+            self._pins[stored_name] += 1
+            self._evict()
+
+    def release(self, stored_names):
+        """Unpin the images of a finished job."""
+        with self._lock:
+            for stored_name in stored_names:
+                self._pins[stored_name] -= 1
+                if self._pins[stored_name] <= 0:
+                    del self._pins[stored_name]
+            self._evict()
+
+    def _evict(self):
+        for stored_name in list(self._entries):
+            if self._total_bytes <= self.max_bytes:
+                break
+            if self._pins.get(stored_name):
+                continue
+            self._total_bytes -= self._entries.pop(stored_name)
+            try:
+                os.remove(os.path.join(self.input_dir, stored_name))
+                print(f"worker-comfyui - Evicted cached input image {stored_name}")
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"worker-comfyui - Could not evict cached input image {stored_name}: {e}")
 
-            # Strip Data URI prefix if present
-            if "," in image_data_uri:
-                base64_data = image_data_uri.split(",", 1)[1]
+input_cache = InputImageCache(COMFY_INPUT_DIR, INPUT_CACHE_MAX_MB * 1024 * 1024) if INPUT_CACHE_MAX_MB > 0 and not IN_CHILD_PROCESS else None
+
+class SharedCache:
+    """
+    Second cache tier on the network volume, shared by all workers.
+
+    Entries are files (input images) or directories (results) under
+    `<namespace>/<key>`. They are copied to a temporary name and renamed into
+    place, so no worker ever reads a partial entry. A compact `index.json`
+    maps every entry to its size and last use. All index updates happen under
+    an exclusive `flock` on `.lock`, which also serializes the evictions of
+    the workers. Once the entries exceed `max_bytes`, the least recently
+    used ones are deleted. `stats` counts hits and misses per namespace.
+    """
+
+    INDEX = "index.json"
+    LOCK = ".lock"
+    # Last use is only rewritten when it is older than this, to keep index writes rare
+    TOUCH_INTERVAL_S = 60
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.stats = {namespace: {"hits": 0, "misses": 0} for namespace in ("inputs", "results")}
+        # flock() does not exclude the threads of one process from each other
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @contextmanager
+    def _locked(self):
+        with self._lock, open(os.path.join(self.directory, self.LOCK), "a+") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_index(self):
+        try:
+            with open(os.path.join(self.directory, self.INDEX)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_index(self, index):
+        path = os.path.join(self.directory, self.INDEX)
+        staging = f"{path}.{uuid.uuid4().hex[:8]}"
+        with open(staging, "w") as f:
+            json.dump(index, f, separators=(",", ":"))
+        os.replace(staging, path)
+
+    def _path(self, namespace, key):
+        return os.path.join(self.directory, namespace, key)
+
+    def lookup(self, namespace, key):
+        """
+        Return the path of the entry for `key`, or None. Counts a hit or miss
+        and refreshes the entry's last use.
+        """
+        path = self._path(namespace, key)
+        with self._locked():
+            index = self._read_index()
+            entry = index.get(f"{namespace}/{key}")
+            if entry is None or not os.path.exists(path):
+                self.stats[namespace]["misses"] += 1
+                return None
+            self.stats[namespace]["hits"] += 1
+            now = int(time.time())
+            if now - entry[1] > self.TOUCH_INTERVAL_S:
+                entry[1] = now
+                self._write_index(index)
+        return path
+
+    def publish(self, namespace, key, source):
+        """
+        Add an entry from `source`, bytes or the path of a file or directory.
+        Entries that another worker already published are left alone.
+        """
+        path = self._path(namespace, key)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        staging = os.path.join(self.directory, namespace, f".{key}.{uuid.uuid4().hex[:8]}")
+        try:
+            if isinstance(source, (bytes, bytearray)):
+                with open(staging, "wb") as f:
+                    f.write(source)
+            elif os.path.isdir(source):
+                shutil.copytree(source, staging)
             else:
-                base64_data = image_data_uri
+                shutil.copyfile(source, staging)
+            size = _tree_size(staging)
+            with self._locked():
+                if os.path.exists(path):
+                    return
+                os.rename(staging, path)
+                index = self._read_index()
+                index[f"{namespace}/{key}"] = [size, int(time.time())]
+                self._evict(index)
+                self._write_index(index)
+            print(f"worker-comfyui - Published {namespace[:-1]} {key[:12]} to the shared cache")
+        except Exception as e:
+            print(f"worker-comfyui - Could not publish {namespace[:-1]} {key[:12]} to the shared cache: {e}")
+        finally:
+            _remove_path(staging)
+
+    def _evict(self, index):
+        total_bytes = sum(size for size, _ in index.values())
+        for entry_key, (size, _) in sorted(index.items(), key=lambda item: item[1][1]):
+            if total_bytes <= self.max_bytes:
+                break
+            namespace, key = entry_key.split("/", 1)
+            _remove_path(self._path(namespace, key))
+            del index[entry_key]
+            total_bytes -= size
+            print(f"worker-comfyui - Evicted {entry_key[:20]} from the shared cache")
+
+def _tree_size(path):
+    """
+    Return the size of a file, or of all files below a directory.
+    """
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
 
-            blob = base64.b64decode(base64_data)
+def _remove_path(path):
+    """
+    Remove a file or directory if it exists.
+    """
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
 
-            files = {
-                "image": (name, BytesIO(blob), "image/png"),
-                "overwrite": (None, "true"),
-            }
+def _shared_cache():
+    """
+    Create the shared cache tier if it is enabled and the network volume is mounted.
+    """
+    if SHARED_CACHE_MAX_MB <= 0 or IN_CHILD_PROCESS:
+        return None
+    try:
+        return SharedCache(SHARED_CACHE_DIR, SHARED_CACHE_MAX_MB * 1024 * 1024)
+    except OSError as e:
+        print(f"worker-comfyui - Shared cache disabled, {SHARED_CACHE_DIR} is not writable: {e}")
+        return None
 
-            response = requests.post(f"http://{COMFY_HOST}/upload/image", files=files, timeout=30)
-            response.raise_for_status()
+shared_cache = _shared_cache()
 
-            responses.append(f"Successfully uploaded {name}")
-            print(f"worker-comfyui - Successfully uploaded {name}")
+def _restore_shared_input(stored_name):
+    """
+    Copy an input image another worker already uploaded from the shared cache
+    into ComfyUI's input directory instead of uploading it again.
+    Returns True if the image is now in the input directory (and pinned).
+    """
+    if shared_cache is None or input_cache is None or not os.path.isdir(input_cache.input_dir):
+        return False
+    path = shared_cache.lookup("inputs", stored_name)
+    if path is None:
+        return False
+    target = os.path.join(input_cache.input_dir, stored_name)
+    staging = f"{target}.{uuid.uuid4().hex[:8]}"
+    try:
+        shutil.copyfile(path, staging)
+        os.replace(staging, target)
+    except OSError as e:
+        print(f"worker-comfyui - Could not copy {stored_name} from the shared cache: {e}")
+        _remove_path(staging)
+        return False
+    input_cache.add(stored_name, os.path.getsize(target))
+    return True
+
+def _publish_input(stored_name, blob):
+    """
+    Share a freshly uploaded input image with the other workers, in the background.
+    """
+    if shared_cache is not None and input_cache is not None:
+        output_pool.submit(shared_cache.publish, "inputs", stored_name, blob)
 
-        except base64.binascii.Error as e:
-            error_msg = f"Error decoding base64 for {image.get('name', 'unknown')}: {e}"
-            print(f"worker-comfyui - {error_msg}")
-            upload_errors.append(error_msg)
-        except requests.Timeout:
-            error_msg = f"Timeout uploading {image.get('name', 'unknown')}"
-            print(f"worker-comfyui - {error_msg}")
-            upload_errors.append(error_msg)
-        except requests.RequestException as e:
-            error_msg = f"Error uploading {image.get('name', 'unknown')}: {e}"
-            print(f"worker-comfyui - {error_msg}")
-            upload_errors.append(error_msg)
+def cache_stats():
+    """
+    Return the hit and miss counters of every enabled cache tier.
+    """
+    stats = {}
+    if input_cache is not None:
+        stats["inputs.local"] = {"hits": input_cache.hits, "misses": input_cache.misses}
+    if result_cache is not None:
+        stats["results.local"] = {"hits": result_cache.hits, "misses": result_cache.misses}
+    if shared_cache is not None:
+        for namespace, counters in shared_cache.stats.items():
+            stats[f"{namespace}.shared"] = dict(counters)
+    return stats
+
+def _release_input_images(stored_names):
+    """
+    Unpin the cached input images used by a job.
+    """
+    if input_cache is not None and stored_names:
+        input_cache.release(stored_names.values())
+
+def _rewrite_image_references(workflow, stored_names):
+    """
+    Return a copy of `workflow` in which every node input that references an
+    uploaded image by its original name uses the stored name instead.
+    """
+    renames = {name: stored for name, stored in stored_names.items() if name != stored}
+    if not renames or not isinstance(workflow, dict):
+        return workflow
+
+    rewritten = {}
+    for node_id, node in workflow.items():
+        inputs = node.get("inputs") if isinstance(node, dict) else None
+        if isinstance(inputs, dict) and any(isinstance(v, str) and v in renames for v in inputs.values()):
+            node = {**node, "inputs": {k: renames.get(v, v) if isinstance(v, str) else v for k, v in inputs.items()}}
+        rewritten[node_id] = node
+    return rewritten
+
+_node_class_availability = {}
+
+def node_class_available(class_type):
+    """
+    Return True if ComfyUI knows the node class `class_type`.
+    The answer is cached for the lifetime of the worker.
+    """
+    if class_type not in _node_class_availability:
+        try:
+            response = comfy_client.get(f"/object_info/{urllib.parse.quote(class_type)}", "object_info")
+            response.raise_for_status()
+            _node_class_availability[class_type] = class_type in response.json()
         except Exception as e:
-            error_msg = f"Unexpected error uploading {image.get('name', 'unknown')}: {e}"
-            print(f"worker-comfyui - {error_msg}")
-            upload_errors.append(error_msg)
+            # Don't cache failures, ComfyUI might just be busy
+            print(f"worker-comfyui - Warning: Could not check for node class {class_type}: {e}")
+            return False
+        print(f"worker-comfyui - Node class {class_type} available: {_node_class_availability[class_type]}")
+    return _node_class_availability[class_type]
+
+def _inline_input_images(workflow, images):
+    """
+    Replace LoadImage nodes that reference a job-supplied image with
+    ETN_LoadImageBase64 nodes carrying the image data inline.
+    Returns the rewritten workflow and the images that still have to be
+    uploaded, either because another node references them by name or
+    because their data is not valid base64.
+    """
+    if not isinstance(workflow, dict):
+        return workflow, images
+
+    inline_data = {}
+    for image in images:
+        image_data_uri = image["image"]
+        base64_data = image_data_uri.split(",", 1)[1] if "," in image_data_uri else image_data_uri
+        try:
+            base64.b64decode(base64_data, validate=True)
+        except (base64.binascii.Error, ValueError):
+            # Uploading reports the decoding error the usual way
+            continue
+        inline_data[image["name"]] = base64_data
+
+    inlined = set()
+    rewritten = {}
+    for node_id, node in workflow.items():
+        if isinstance(node, dict) and node.get("class_type") == "LoadImage":
+            name = (node.get("inputs") or {}).get("image")
+            if isinstance(name, str) and name in inline_data:
+                node = {**node, "class_type": INLINE_IMAGE_NODE_CLASS, "inputs": {"image": inline_data[name]}}
+                inlined.add(name)
+        rewritten[node_id] = node
+
+    # Images that other nodes still reference by name have to be uploaded as well
+    for node in rewritten.values():
+        if isinstance(node, dict) and node.get("class_type") != INLINE_IMAGE_NODE_CLASS:
+            inputs = node.get("inputs")
+            if isinstance(inputs, dict):
+                inlined.difference_update(v for v in inputs.values() if isinstance(v, str))
+
+    if inlined:
+        print(f"worker-comfyui - Inlined {len(inlined)} image(s) into {INLINE_IMAGE_NODE_CLASS} nodes")
+    return rewritten, [image for image in images if image["name"] not in inlined]
+
+def _rewrite_save_nodes_for_websocket(workflow):
+    """
+    Replace SaveImage nodes with ETN_SendImageWebSocket nodes so the images
+    arrive as binary websocket frames instead of being written to disk.
+    Returns the rewritten workflow and a mapping from each rewritten node id
+    to its filename prefix.
+    """
+    if not isinstance(workflow, dict):
+        return workflow, {}
+
+    rewritten = {}
+    prefixes = {}
+    for node_id, node in workflow.items():
+        if isinstance(node, dict) and node.get("class_type") == "SaveImage":
+            inputs = node.get("inputs") or {}
+            prefixes[node_id] = os.path.basename(str(inputs.get("filename_prefix") or "ComfyUI"))
+            node = {**node, "class_type": WEBSOCKET_IMAGE_NODE_CLASS, "inputs": {"images": inputs.get("images"), "format": "PNG"}}
+        rewritten[node_id] = node
+    return rewritten, prefixes
+
+def _websocket_output_images(frames, prefixes):
+    """
+    Turn the binary frames received from rewritten save nodes into
+    (node id, filename, image bytes) tuples, named like ComfyUI names saved files.
+    """
+    images = []
+    for frame in frames:
+        if frame["node"] not in prefixes:
+            continue
+        extension = BINARY_IMAGE_EXTENSIONS.get(frame["image_type"], ".png")
+        filename = f"{prefixes[frame['node']]}_{len(images) + 1:05}_{extension}"
+        images.append((frame["node"], filename, frame["image"]))
+    print(f"worker-comfyui - Received {len(images)} image(s) over the websocket")
+    return images
+
+def _upload_image(image):
+    """
+    Decode and upload one base64 encoded image.
+    Returns a (success message, error message, stored name) tuple; the stored
+    name is the content-addressed name when the input cache is enabled.
+    """
+    name = image.get("name", "unknown")
+    try:
+        blob, digest = _decoded_input_image(image)
+
+        stored_name = name
+        if input_cache is not None:
+            stored_name = input_cache.stored_name(name, blob, digest)
+            if input_cache.acquire(stored_name):
+                print(f"worker-comfyui - {name} is already in ComfyUI's input directory as {stored_name}")
+                return f"Reused cached upload of {name}", None, stored_name
+            if _restore_shared_input(stored_name):
+                print(f"worker-comfyui - Copied {name} from the shared cache as {stored_name}")
+                return f"Reused shared upload of {name}", None, stored_name
+
+        # Pass the raw bytes (not a stream) so a retried request can resend them
+        files = {
+            "image": (stored_name, blob, "image/png"),
+            "overwrite": (None, "true"),
+        }
+
+        response = comfy_client.post("/upload/image", "upload", files=files)
+        response.raise_for_status()
+        if input_cache is not None:
+            input_cache.add(stored_name, len(blob))
+            _publish_input(stored_name, blob)
+
+        print(f"worker-comfyui - Successfully uploaded {name}")
+        return f"Successfully uploaded {name}", None, stored_name
+
+    except base64.binascii.Error as e:
+        error_msg = f"Error decoding base64 for {name}: {e}"
+    except requests.Timeout:
+        error_msg = f"Timeout uploading {name}"
+    except requests.RequestException as e:
+        error_msg = f"Error uploading {name}: {e}"
+    except Exception as e:
+        error_msg = f"Unexpected error uploading {name}: {e}"
+    print(f"worker-comfyui - {error_msg}")
+    return None, error_msg, None
+
+def _upload_result(images, results):
+    """
+    Summarize per-image (success message, error message, stored name) tuples,
+    in input order. Returns the upload result and a mapping from the original
+    to the stored name of every image that is now available to ComfyUI.
+    """
+    responses = [ok for ok, _, _ in results if ok]
+    upload_errors = [err for _, err, _ in results if err]
+    stored_names = {image["name"]: stored for image, (_, _, stored) in zip(images, results) if stored}
 
     if upload_errors:
         print(f"worker-comfyui - image(s) upload finished with errors")
@@ -194,21 +1494,52 @@ def upload_images(images):
             "status": "error",
             "message": "Some images failed to upload",
             "details": upload_errors,
-        }
+        }, stored_names
 
     print(f"worker-comfyui - image(s) upload complete")
     return {
         "status": "success",
         "message": "All images uploaded successfully",
         "details": responses,
-    }
+    }, stored_names
+
+def upload_images(images, max_workers=None):
+    """
+    Upload a list of base64 encoded images to the ComfyUI server.
+    Maintains backwards compatibility with single image upload.
+    """
+    upload_result, stored_names = upload_input_images(images, max_workers)
+    _release_input_images(stored_names)
+    return upload_result
+
+def upload_input_images(images, max_workers=None):
+    """
+    Upload a list of base64 encoded images to the ComfyUI server.
+    Images are decoded and uploaded concurrently by up to `max_workers`
+    threads (default COMFY_UPLOAD_WORKERS).
+    Returns the upload result and the mapping from original to stored image
+    names. Cached images stay pinned until passed to _release_input_images().
+    """
+    if not images:
+        return {"status": "success", "message": "No images to upload", "details": []}, {}
+
+    print(f"worker-comfyui - Uploading {len(images)} image(s)...")
+
+    max_workers = min(max_workers or COMFY_UPLOAD_WORKERS, len(images))
+    if max_workers <= 1:
+        results = [_upload_image(image) for image in images]
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="comfy-upload") as executor:
+            results = list(executor.map(_upload_image, images))
+
+    return _upload_result(images, results)
 
 def get_available_models():
     """
     Get list of available models from ComfyUI
     """
     try:
-        response = requests.get(f"http://{COMFY_HOST}/object_info", timeout=10)
+        response = comfy_client.get("/object_info", "object_info")
         response.raise_for_status()
         object_info = response.json()
 
@@ -235,83 +1566,140 @@ def queue_workflow(workflow, client_id):
     data = json.dumps(payload).encode("utf-8")
 
     headers = {"Content-Type": "application/json"}
-    response = requests.post(f"http://{COMFY_HOST}/prompt", data=data, headers=headers, timeout=30)
+    response = comfy_client.post("/prompt", "prompt", data=data, headers=headers)
 
     if response.status_code == 400:
-        print(f"worker-comfyui - ComfyUI returned 400. Response body: {response.text}")
-        try:
-            error_data = response.json()
-            print(f"worker-comfyui - Parsed error data: {error_data}")
-
-            error_message = "Workflow validation failed"
-            error_details = []
-
-            if "error" in error_data:
-                error_info = error_data["error"]
-                if isinstance(error_info, dict):
-                    error_message = error_info.get("message", error_message)
-                    if error_info.get("type") == "prompt_outputs_failed_validation":
-                        error_message = "Workflow validation failed"
-                else:
-                    error_message = str(error_info)
+        _raise_prompt_validation_error(response.text)
 
-            if "node_errors" in error_data:
-                for node_id, node_error in error_data["node_errors"].items():
-                    if isinstance(node_error, dict):
-                        for error_type, error_msg in node_error.items():
-                            error_details.append(f"Node {node_id} ({error_type}): {error_msg}")
-                    else:
-                        error_details.append(f"Node {node_id}: {node_error}")
+    response.raise_for_status()
+    return response.json()
 
-            if error_data.get("type") == "prompt_outputs_failed_validation":
-                error_message = error_data.get("message", "Workflow validation failed")
-                available_models = get_available_models()
-                if available_models.get("checkpoints"):
-                    error_message += f"\n\nThis usually means a required model or parameter is not available."
-                    error_message += f"\nAvailable checkpoint models: {', '.join(available_models['checkpoints'])}"
-                else:
-                    error_message += "\n\nThis usually means a required model or parameter is not available."
-                    error_message += "\nNo checkpoint models appear to be available. Please check your model installation."
+def _raise_prompt_validation_error(response_text):
+    """
+    Turn the body of a 400 response from /prompt into a descriptive ValueError.
+    """
+    print(f"worker-comfyui - ComfyUI returned 400. Response body: {response_text}")
+    try:
+        error_data = json.loads(response_text)
+        print(f"worker-comfyui - Parsed error data: {error_data}")
+
+        error_message = "Workflow validation failed"
+        error_details = []
+
+        if "error" in error_data:
+            error_info = error_data["error"]
+            if isinstance(error_info, dict):
+                error_message = error_info.get("message", error_message)
+                if error_info.get("type") == "prompt_outputs_failed_validation":
+                    error_message = "Workflow validation failed"
+            else:
+                error_message = str(error_info)
 
-                raise ValueError(error_message)
+        if "node_errors" in error_data:
+            for node_id, node_error in error_data["node_errors"].items():
+                if isinstance(node_error, dict):
+                    for error_type, error_msg in node_error.items():
+                        error_details.append(f"Node {node_id} ({error_type}): {error_msg}")
+                else:
+                    error_details.append(f"Node {node_id}: {node_error}")
+
+        if error_data.get("type") == "prompt_outputs_failed_validation":
+            error_message = error_data.get("message", "Workflow validation failed")
+            available_models = get_available_models()
+            if available_models.get("checkpoints"):
+                error_message += f"\n\nThis usually means a required model or parameter is not available."
+                error_message += f"\nAvailable checkpoint models: {', '.join(available_models['checkpoints'])}"
+            else:
+                error_message += "\n\nThis usually means a required model or parameter is not available."
+                error_message += "\nNo checkpoint models appear to be available. Please check your model installation."
 
-            if error_details:
-                detailed_message = f"{error_message}:\n" + "\n".join(f"• {detail}" for detail in error_details)
+            raise ValueError(error_message)
 
-                if any("not in list" in detail and "ckpt_name" in detail for detail in error_details):
-                    available_models = get_available_models()
-                    if available_models.get("checkpoints"):
-                        detailed_message += f"\n\nAvailable checkpoint models: {', '.join(available_models['checkpoints'])}"
-                    else:
-                        detailed_message += "\n\nNo checkpoint models appear to be available. Please check your model installation."
+        if error_details:
+            detailed_message = f"{error_message}:\n" + "\n".join(f"• {detail}" for detail in error_details)
 
-                raise ValueError(detailed_message)
-            else:
-                raise ValueError(f"{error_message}. Raw response: {response.text}")
+            if any("not in list" in detail and "ckpt_name" in detail for detail in error_details):
+                available_models = get_available_models()
+                if available_models.get("checkpoints"):
+                    detailed_message += f"\n\nAvailable checkpoint models: {', '.join(available_models['checkpoints'])}"
+                else:
+                    detailed_message += "\n\nNo checkpoint models appear to be available. Please check your model installation."
 
-        except (json.JSONDecodeError, KeyError) as e:
-            raise ValueError(f"ComfyUI validation failed (could not parse error response): {response.text}")
+            raise ValueError(detailed_message)
+        else:
+            raise ValueError(f"{error_message}. Raw response: {response_text}")
 
-    response.raise_for_status()
-    return response.json()
+    except (json.JSONDecodeError, KeyError) as e:
+        raise ValueError(f"ComfyUI validation failed (could not parse error response): {response_text}")
 
 def get_history(prompt_id):
     """
     Retrieve the history of a given prompt using its ID
     """
-    response = requests.get(f"http://{COMFY_HOST}/history/{prompt_id}", timeout=30)
+    response = comfy_client.get(f"/history/{prompt_id}", "history")
     response.raise_for_status()
     return response.json()
 
+def _local_output_path(filename, subfolder, image_type):
+    """
+    Resolve a filename/subfolder/type triple from the history to a path in
+    ComfyUI's output, temp or input directory (or the result cache). Returns None for unknown types
+    and for paths that escape the directory.
+    """
+    base_dir = {"output": COMFY_OUTPUT_DIR, "temp": COMFY_TEMP_DIR, "input": COMFY_INPUT_DIR, "cached": RESULT_CACHE_DIR}.get(image_type)
+    if base_dir is None:
+        return None
+    base_dir = os.path.realpath(base_dir)
+    path = os.path.realpath(os.path.join(base_dir, subfolder or "", filename))
+    if os.path.commonpath([base_dir, path]) != base_dir:
+        print(f"worker-comfyui - Refusing to read {filename!r} from {subfolder!r}: outside of {base_dir}")
+        return None
+    return path
+
+def _local_output_file(filename, subfolder, image_type):
+    """
+    Return the path of an output file that can be read from local disk, or
+    None. Result cache entries are always read locally.
+    """
+    if not OUTPUT_READ_LOCAL and image_type != "cached":
+        return None
+    path = _local_output_path(filename, subfolder, image_type)
+    return path if path is not None and os.path.isfile(path) else None
+
+def read_local_output(filename, subfolder, image_type):
+    """
+    Read an output file straight from disk when ComfyUI runs in the same container.
+    Large files are memory-mapped. Returns None if the file is not available locally.
+    """
+    path = _local_output_file(filename, subfolder, image_type)
+    if path is None:
+        return None
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size and size >= OUTPUT_MMAP_MIN_MB * 1024 * 1024:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                data = f.read()
+    except OSError as e:
+        print(f"worker-comfyui - Error reading {path}, falling back to /view: {e}")
+        return None
+    print(f"worker-comfyui - Read image data for {filename} from {path}")
+    return data
+
 def get_image_data(filename, subfolder, image_type):
     """
-    Fetch image bytes from the ComfyUI /view endpoint.
+    Fetch image bytes from the local output directory or the ComfyUI /view endpoint.
     """
+    data = read_local_output(filename, subfolder, image_type)
+    if data is not None:
+        return data
+
     print(f"worker-comfyui - Fetching image data: type={image_type}, subfolder={subfolder}, filename={filename}")
     data = {"filename": filename, "subfolder": subfolder, "type": image_type}
     url_values = urllib.parse.urlencode(data)
     try:
-        response = requests.get(f"http://{COMFY_HOST}/view?{url_values}", timeout=60)
+        response = comfy_client.get(f"/view?{url_values}", "view")
         response.raise_for_status()
         print(f"worker-comfyui - Successfully fetched image data for {filename}")
         return response.content
@@ -325,56 +1713,1366 @@ def get_image_data(filename, subfolder, image_type):
         print(f"worker-comfyui - Unexpected error fetching image data for {filename}: {e}")
         return None
 
-def handler(job):
+def _prompt_event_outcome(message, prompt_id, errors):
     """
-    Handles a job using ComfyUI via websockets for status and image retrieval.
-    Maintains backwards compatibility with single image inputs.
+    Interpret one websocket event of a running prompt.
+    Returns "done" when the prompt finished, "error" when it failed (the error is
+    recorded in `errors`), "reconnected" after a websocket reconnect and None
+    for any other event.
     """
-    job_input = job["input"]
-    job_id = job["id"]
+    msg_type = message.get("type")
+    data = message.get("data", {})
+    if msg_type == "executing":
+        if data.get("node") is None:
+            print(f"worker-comfyui - Execution finished for prompt {prompt_id}")
+            return "done"
+    elif msg_type == "execution_error":
+        error_details = f"Node Type: {data.get('node_type')}, Node ID: {data.get('node_id')}, Message: {data.get('exception_message')}"
+        print(f"worker-comfyui - Execution error received: {error_details}")
+        errors.append(f"Workflow execution error: {error_details}")
+        return "error"
+    elif msg_type == "reconnected":
+        return "reconnected"
+    elif msg_type == "connection_lost":
+        raise websocket.WebSocketConnectionClosedException(data.get("error"))
+    return None
+
+def _missing_history_response(prompt_id, errors):
+    """
+    Build the error response for a prompt that is missing from the history.
+    """
+    error_msg = f"Prompt ID {prompt_id} not found in history after execution."
+    print(f"worker-comfyui - {error_msg}")
+    if not errors:
+        return {"error": error_msg}
+    errors.append(error_msg)
+    return {"error": "Job processing failed, prompt ID not found in history.", "details": errors}
+
+def _history_outputs(history, prompt_id, errors):
+    """
+    Return the outputs of a prompt from its history entry.
+    """
+    outputs = history.get(prompt_id, {}).get("outputs", {})
+    if not outputs:
+        warning_msg = f"No outputs found in history for prompt {prompt_id}."
+        print(f"worker-comfyui - {warning_msg}")
+        if not errors:
+            errors.append(warning_msg)
+    return outputs
+
+def _collect_output_images(outputs, errors):
+    """
+    Return the files of all output nodes that should be delivered to the
+    client: images, plus gifs, videos and audio (e.g. from VideoHelperSuite
+    or SaveAudio), each tagged with its output `kind`.
+    Temp files are skipped and unhandled output keys are reported.
+    """
+    images = []
+    print(f"worker-comfyui - Processing {len(outputs)} output nodes...")
+    for node_id, node_output in outputs.items():
+        for kind in OUTPUT_KINDS:
+            if kind not in node_output:
+                continue
+            print(f"worker-comfyui - Node {node_id} contains {len(node_output[kind])} file(s) of kind '{kind}'")
+            for image_info in node_output[kind]:
+                filename = image_info.get("filename")
+                img_type = image_info.get("type")
+
+                # Skip temp images
+                if img_type == "temp":
+                    print(f"worker-comfyui - Skipping {kind} {filename} because type is 'temp'")
+                    continue
 
-    # Validate input
-    validated_data, error_message = validate_input(job_input)
-    if error_message:
-        return {"error": error_message}
+                if not filename:
+                    warn_msg = f"Skipping {kind} in node {node_id} due to missing filename: {image_info}"
+                    print(f"worker-comfyui - {warn_msg}")
+                    errors.append(warn_msg)
+                    continue
 
-    workflow = validated_data["workflow"]
-    input_images = validated_data.get("images")
+                images.append({
+                    "node_id": node_id,
+                    "filename": filename,
+                    "subfolder": image_info.get("subfolder", ""),
+                    "type": img_type,
+                    "kind": kind,
+                })
 
-    # Check server availability
+        # Check for other output types ("animated" only flags animated images)
+        other_keys = [k for k in node_output.keys() if k not in OUTPUT_KINDS and k != "animated"]
+        if other_keys:
+            warn_msg = f"Node {node_id} produced unhandled output keys: {other_keys}."
+            print(f"worker-comfyui - WARNING: {warn_msg}")
+            print(f"worker-comfyui - --> If this output is useful, please consider opening an issue on GitHub to discuss adding support.")
+
+    return images
+
+def _workflow_leaf_nodes(workflow):
+    """
+    Return the ids of the nodes whose outputs no other node consumes.
+    Output nodes (SaveImage, PreviewImage, ...) are always leaves.
+    """
+    if not isinstance(workflow, dict):
+        return set()
+    consumed = set()
+    for node in workflow.values():
+        inputs = node.get("inputs") if isinstance(node, dict) else None
+        for value in (inputs or {}).values():
+            if isinstance(value, list) and len(value) == 2 and isinstance(value[1], int):
+                consumed.add(str(value[0]))
+    return {str(node_id) for node_id in workflow} - consumed
+
+class _PromptOutputs:
+    """
+    Outputs of a running prompt, accumulated from its `executed` events so
+    images can be fetched while the rest of the workflow is still running.
+    Only the outputs picked by the job's `input.outputs` selection are handed out.
+    """
+
+    def __init__(self, workflow, selection=None):
+        selection = selection or {}
+        self.outputs = {}
+        self.cached_nodes = set()
+        self.reconnected = False
+        self._leaf_nodes = _workflow_leaf_nodes(workflow)
+        self._started = set()
+        self._nodes = set(selection["nodes"]) if selection.get("nodes") is not None else None
+        self._kinds = selection.get("kinds")
+        self._limit = selection.get("limit")
+        # (image info, image bytes or None) of every output handed out, for the result cache
+        self.handed_out = []
+
+    def _selected(self, node_id):
+        return self._nodes is None or node_id in self._nodes
+
+    def _remaining(self):
+        return None if self._limit is None else max(self._limit - len(self._started), 0)
+
+    def add_event(self, message):
+        """
+        Record a websocket event. Returns {node_id: output} when the event
+        reports the output of a finished node, otherwise None.
+        """
+        msg_type = message.get("type")
+        data = message.get("data") or {}
+        if msg_type == "executed" and isinstance(data.get("output"), dict):
+            node_id = str(data.get("node"))
+            self.outputs[node_id] = data["output"]
+            return {node_id: data["output"]}
+        if msg_type == "execution_cached":
+            self.cached_nodes.update(str(node_id) for node_id in data.get("nodes") or [])
+        elif msg_type == "reconnected":
+            self.reconnected = True
+        return None
+
+    def new_images(self, outputs, errors, exclude=()):
+        """
+        Return the selected files of `outputs` that were not handed out
+        before, skipping the nodes in `exclude` (their images arrive over the websocket).
+        """
+        if self._remaining() == 0:
+            return []
+        outputs = {node_id: output for node_id, output in outputs.items() if self._selected(node_id) and node_id not in exclude}
+        if self._kinds is not None:
+            outputs = {node_id: {key: value for key, value in output.items() if key in self._kinds} for node_id, output in outputs.items()}
+
+        images = []
+        for image_info in _collect_output_images(outputs, errors):
+            key = (image_info["filename"], image_info["subfolder"], image_info["type"])
+            if key in self._started:
+                continue
+            if self._remaining() == 0:
+                break
+            # Position among the job's outputs, picks the client's upload URL
+            image_info["index"] = len(self._started)
+            self._started.add(key)
+            images.append(image_info)
+            self.handed_out.append((image_info, None))
+        return images
+
+    def websocket_images(self, frames, prefixes):
+        """
+        Return the selected images received over the websocket as
+        (image info, image bytes) tuples.
+        """
+        if self._kinds is not None and "images" not in self._kinds:
+            return []
+        images = [image for image in _websocket_output_images(frames, prefixes) if self._selected(image[0])]
+        remaining = self._remaining()
+        if remaining is not None:
+            images = images[:remaining]
+        # Indexes continue after the files of other nodes fetched from disk
+        first_index = len(self._started)
+        self._started.update((node_id, filename) for node_id, filename, _ in images)
+        images = [
+            ({"node_id": node_id, "filename": filename, "index": first_index + index}, image_bytes)
+            for index, (node_id, filename, image_bytes) in enumerate(images)
+        ]
+        self.handed_out.extend(images)
+        return images
+
+    def all_outputs_known(self):
+        """
+        True unless the outputs of some nodes may be missing from the events,
+        whether they are selected or not.
+        """
+        return not self.reconnected and not (self.cached_nodes & self._leaf_nodes) - set(self.outputs)
+
+    def needs_history(self):
+        """
+        True if some outputs may be missing from the events: `executed` events
+        are lost while the websocket reconnects, and older ComfyUI versions do
+        not send them for output nodes served from the cache.
+        """
+        if self._remaining() == 0:
+            return False
+        if self.reconnected:
+            return True
+        missing = (self.cached_nodes & self._leaf_nodes) - set(self.outputs)
+        return any(self._selected(node_id) for node_id in missing)
+
+    def merge_history(self, outputs):
+        """
+        Add the history outputs of nodes without an `executed` event and return them.
+        """
+        missing = {node_id: output for node_id, output in outputs.items() if node_id not in self.outputs}
+        self.outputs.update(missing)
+        return missing
+
+def _no_outputs_warning(prompt_id, errors):
+    """
+    Record that a finished prompt reported no outputs.
+    """
+    warning_msg = f"No outputs received for prompt {prompt_id}."
+    print(f"worker-comfyui - {warning_msg}")
+    if not errors:
+        errors.append(warning_msg)
+
+def _inline_image(filename, image_bytes, errors):
+    """
+    Return an output entry with the image encoded as base64.
+    """
+    try:
+        base64_image = base64.b64encode(image_bytes).decode("utf-8")
+        print(f"worker-comfyui - Encoded {filename} as base64")
+        return {"filename": filename, "type": "base64", "data": base64_image}
+    except Exception as e:
+        error_msg = f"Error encoding {filename} to base64: {e}"
+        print(f"worker-comfyui - {error_msg}")
+        errors.append(error_msg)
+        return None
+
+_encode_pool = None
+_encode_pool_lock = threading.Lock()
+
+def get_encode_pool():
+    """
+    Return the process pool transcoding outputs, started on first use.
+    Its processes are spawned, not forked, so they do not inherit the
+    locks of the websocket and upload threads. They run
+    output_encoding.transcode_image(), which does not need this module.
+    """
+    global _encode_pool
+    with _encode_pool_lock:
+        if _encode_pool is None:
+            _encode_pool = ProcessPoolExecutor(max_workers=OUTPUT_ENCODE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _encode_pool
+
+def _encode_output(image_info, image_bytes, encoding, errors):
+    """
+    Transcode an output in the encode process pool. Returns (image info with
+    the new file name, image bytes, thumbnail bytes or None); on failure the
+    error is recorded and the original image is returned.
+    """
+    filename = image_info["filename"]
+    try:
+        # bytes() copies outputs that were memory mapped, which cannot be pickled
+        data, thumbnail = get_encode_pool().submit(transcode_image, bytes(image_bytes), encoding).result()
+    except Exception as e:
+        error_msg = f"Error transcoding {filename} to {encoding['format']}: {e}"
+        print(f"worker-comfyui - {error_msg}")
+        errors.append(error_msg)
+        return image_info, image_bytes, None
+
+    new_filename = os.path.splitext(filename)[0] + OUTPUT_ENCODING_FORMATS[encoding["format"]][1]
+    print(f"worker-comfyui - Transcoded {filename} to {new_filename} ({len(image_bytes)} -> {len(data)} bytes)")
+    return {**image_info, "filename": new_filename}, data, thumbnail
+
+def _build_response(output_data, errors, response_format="legacy"):
+    """
+    Build the final job response from the delivered outputs and collected errors.
+    The "legacy" format returns the first image as `message`, the "images"
+    format returns every image along with the non-fatal errors.
+    """
+    if response_format == "images" and output_data:
+        print(f"worker-comfyui - Job completed. Returning {len(output_data)} image(s).")
+        response = {"status": "success", "images": output_data, "refresh_worker": REFRESH_WORKER}
+        if errors:
+            print(f"worker-comfyui - Job completed with errors/warnings: {errors}")
+            response["errors"] = errors
+        return response
+
+    # For backwards compatibility, return the first image in the old format
+    if output_data:
+        first = next((entry for entry in output_data if entry["type"] != "ref"), output_data[0])
+        return {"status": "success", "message": first["data"], "refresh_worker": REFRESH_WORKER}
+
+    if errors:
+        print(f"worker-comfyui - Job completed with errors/warnings: {errors}")
+        return {"error": "Job processing failed", "details": errors}
+
+    print(f"worker-comfyui - Job completed successfully, but the workflow produced no images.")
+    response = {"status": "success_no_images", "refresh_worker": REFRESH_WORKER}
+    if response_format == "images":
+        response["images"] = []
+    return response
+
+class _ResponseBudget:
+    """
+    Room left in a job's response for outputs inlined as base64. Once an
+    output does not fit, the budget is exhausted and every later output goes
+    to object storage as well. Shared by the parallel deliveries of a job.
+    """
+
+    def __init__(self, max_bytes):
+        self.remaining = max_bytes
+        self.exhausted = False
+        self._lock = threading.Lock()
+
+    def reserve(self, size):
+        """
+        Reserve room for an output of `size` raw bytes (base64 encoded).
+        Returns False if it has to go to object storage.
+        """
+        if size is None:
+            return False
+        encoded_size = 4 * ((size + 2) // 3)
+        with self._lock:
+            if self.exhausted or encoded_size > self.remaining:
+                self.exhausted = True
+                return False
+            self.remaining -= encoded_size
+            return True
+
+def _response_budget():
+    """
+    Return a fresh response budget for a job, or None if outputs are never inlined by size.
+    """
+    if INLINE_RESPONSE_BUDGET_MB <= 0:
+        return None
+    return _ResponseBudget(int(INLINE_RESPONSE_BUDGET_MB * 1024 * 1024))
+
+def _stream_to_s3(job_id, filename, open_source, uploader, errors):
+    """
+    Stream one output from disk or /view to S3 without holding it in memory.
+    """
+    try:
+        s3_url = stream_output(open_source(), lambda stream: uploader.upload(job_id, filename, stream))
+    except Exception as e:
+        error_msg = f"Error uploading {filename} to S3: {e}"
+        print(f"worker-comfyui - {error_msg}")
+        errors.append(error_msg)
+        return None
+    print(f"worker-comfyui - Uploaded {filename} to S3: {s3_url}")
+    return {"filename": filename, "type": "s3_url", "data": s3_url}
+
+def _resolve_upload_url(upload_urls, job_id, image_info, errors):
+    """
+    Return the client-supplied upload URL for an output: the entry at its
+    index of a URL list, or a URL template with the {job_id}, {index},
+    {filename} and {node_id} placeholders filled in.
+    """
+    index = image_info["index"]
+    if isinstance(upload_urls, str):
+        placeholders = {"job_id": job_id, "index": index, "filename": image_info["filename"], "node_id": image_info["node_id"]}
+        url = upload_urls
+        for name, value in placeholders.items():
+            url = url.replace(f"{{{name}}}", urllib.parse.quote(str(value)))
+        return url
+    if index < len(upload_urls):
+        return upload_urls[index]
+    error_msg = f"No upload URL left for {image_info['filename']} (output #{index + 1}, {len(upload_urls)} URL(s) given)"
+    print(f"worker-comfyui - {error_msg}")
+    errors.append(error_msg)
+    return None
+
+def _upload_to_url(url, open_source, filename, errors):
+    """
+    Stream an output to a client-supplied presigned URL. Failed attempts
+    (connection errors, 429 and 5xx) are retried with a fresh source.
+    Returns the output entry with the object URL, or None on failure.
+    """
+    content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    object_url = url.split("?", 1)[0]
+    attempts = 1 + OUTPUT_UPLOAD_RETRIES
+    for attempt in range(attempts):
+        try:
+            print(f"worker-comfyui - Uploading {filename} to {object_url}...")
+            stream_output(open_source(), lambda stream: put_presigned_url(url, stream, content_type))
+            print(f"worker-comfyui - Uploaded {filename} to {object_url}")
+            return {"filename": filename, "type": "url", "data": object_url}
+        except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+            status = e.response.status_code if e.response is not None else None
+            retryable = status is None or status == 429 or status >= 500
+            if not retryable or attempt == attempts - 1:
+                error = e
+                break
+            print(f"worker-comfyui - Upload of {filename} failed ({e}), retrying ({attempt + 1}/{attempts - 1})...")
+            time.sleep(COMFY_HTTP_RETRY_BACKOFF_S * (2 ** attempt))
+        except Exception as e:
+            error = e
+            break
+    error_msg = f"Error uploading {filename} to {object_url}: {error}"
+    print(f"worker-comfyui - {error_msg}")
+    errors.append(error_msg)
+    return None
+
+def _deliver_remote(job_id, image_info, open_source, errors, upload_urls=None):
+    """
+    Stream an output to the client's upload URL, or to the configured bucket.
+    """
+    filename = image_info["filename"]
+    if upload_urls:
+        url = _resolve_upload_url(upload_urls, job_id, image_info, errors)
+        if url is None:
+            return None
+        return _upload_to_url(url, open_source, filename, errors)
+    return _stream_to_s3(job_id, filename, open_source, get_s3_uploader(), errors)
+
+class _OutputDedup:
+    """
+    Content hashes of the outputs delivered for a job. Only the first output
+    with a given content is transcoded and uploaded or encoded; copies (e.g.
+    two SaveImage nodes on the same VAEDecode, or identical frames of a
+    batch) wait for it and are reported as references to its filename.
+    """
+
+    def __init__(self):
+        self._first = {}
+        self._lock = threading.Lock()
+
+    def deliver(self, image_info, digest, deliver):
+        """
+        Deliver an output with `deliver()` unless an output with the same
+        content `digest` was delivered before. If that delivery failed, the
+        copy is delivered on its own.
+        """
+        with self._lock:
+            first = self._first.get(digest)
+            if first is None:
+                self._first[digest] = pending = Future()
+        if first is None:
+            entry = None
+            try:
+                entry = deliver()
+                return entry
+            finally:
+                pending.set_result(entry)
+
+        first_entry = first.result()
+        if first_entry is None:
+            return deliver()
+        print(f"worker-comfyui - {image_info['filename']} is identical to {first_entry['filename']}, returning a reference")
+        return _tag_kind({"filename": image_info["filename"], "type": "ref", "data": first_entry["filename"]}, image_info)
+
+def _job_output_dedup(upload_urls):
+    """
+    Return the _OutputDedup of a job, or None if OUTPUT_DEDUP is off or the
+    job gave `input.upload_urls`: every one of them expects its own object.
+    """
+    return _OutputDedup() if OUTPUT_DEDUP and not upload_urls else None
+
+def _output_digest(image_info):
+    """
+    Hash an output file for deduplication. Local files are hashed in chunks
+    and read again for delivery; images that are only available through
+    /view are fetched into memory once. Returns (hex digest, image bytes or
+    None), (None, None) if the output could not be fetched, or ("", None)
+    for a gif, video or audio file only available through /view: it is
+    streamed to its destination without deduplication rather than held in
+    memory.
+    """
+    filename, subfolder, image_type = image_info["filename"], image_info["subfolder"], image_info["type"]
+    path = _local_output_file(filename, subfolder, image_type)
+    if path is not None:
+        digest = hashlib.sha256()
+        for chunk in _file_chunks(path, OUTPUT_STREAM_CHUNK_KB * 1024):
+            digest.update(chunk)
+        return digest.hexdigest(), None
+    if image_info.get("kind", "images") != "images":
+        return "", None
+
+    image_bytes = get_image_data(filename, subfolder, image_type)
+    if not image_bytes:
+        return None, None
+    return hashlib.sha256(image_bytes).hexdigest(), image_bytes
+
+def _tag_kind(entry, image_info):
+    """
+    Mark the output entry of a gif, video or audio file with its kind.
+    Image entries keep their original shape.
+    """
+    kind = image_info.get("kind", "images")
+    if entry and kind != "images":
+        entry["kind"] = kind
+    return entry
+
+def _deliver_image_bytes(job_id, image_info, image_bytes, errors, upload_urls=None, budget=None, encoding=None, dedup=None):
+    """
+    Deliver an output held in memory (received over the websocket, or fetched
+    to be transcoded): inline as base64, or to object storage if there is one
+    and the output does not fit the budget. Only images are transcoded.
+    """
+    if dedup is not None:
+        digest = hashlib.sha256(image_bytes).hexdigest()
+        return dedup.deliver(image_info, digest, lambda: _deliver_image_bytes(job_id, image_info, image_bytes, errors, upload_urls, budget, encoding))
+
+    thumbnail = None
+    if encoding and image_info.get("kind", "images") == "images":
+        image_info, image_bytes, thumbnail = _encode_output(image_info, image_bytes, encoding, errors)
+
+    has_remote = bool(upload_urls) or get_s3_uploader() is not None
+    if has_remote and (budget is None or not budget.reserve(len(image_bytes))):
+        source = lambda: (iter([image_bytes]), len(image_bytes))
+        entry = _deliver_remote(job_id, image_info, source, errors, upload_urls)
+    else:
+        entry = _inline_image(image_info["filename"], image_bytes, errors)
+
+    if entry and thumbnail:
+        entry["thumbnail"] = base64.b64encode(thumbnail).decode("utf-8")
+    return _tag_kind(entry, image_info)
+
+def _fetch_and_deliver(job_id, image_info, errors, upload_urls=None, budget=None, encoding=None, dedup=None):
+    """
+    Fetch one output file and deliver it: inline as base64, or streamed to
+    object storage if there is one and the file does not fit the budget
+    (large videos become multipart uploads). Images that are transcoded are
+    fetched into memory instead.
+    """
+    filename = image_info["filename"]
+    if dedup is not None:
+        digest, image_bytes = _output_digest(image_info)
+        if digest is None:
+            errors.append(f"Failed to fetch image data for {filename} from /view endpoint.")
+            return None
+        if not digest:
+            return _fetch_and_deliver(job_id, image_info, errors, upload_urls, budget, encoding)
+        if image_bytes is not None:
+            return _deliver_image_bytes(job_id, image_info, image_bytes, errors, upload_urls, budget, encoding, dedup)
+        return dedup.deliver(image_info, digest, lambda: _fetch_and_deliver(job_id, image_info, errors, upload_urls, budget, encoding))
+
+    if encoding and image_info.get("kind", "images") == "images":
+        image_bytes = get_image_data(filename, image_info["subfolder"], image_info["type"])
+        if not image_bytes:
+            errors.append(f"Failed to fetch image data for {filename} from /view endpoint.")
+            return None
+        return _deliver_image_bytes(job_id, image_info, image_bytes, errors, upload_urls, budget, encoding, dedup)
+
+    open_source = lambda: open_output_source(filename, image_info["subfolder"], image_info["type"])
+
+    if upload_urls or get_s3_uploader() is not None:
+        if budget is not None:
+            try:
+                source = open_source()
+            except Exception as e:
+                errors.append(f"Failed to fetch image data for {filename}: {e}")
+                return None
+            chunks, size = source
+            if budget.reserve(size):
+                return _tag_kind(_inline_image(filename, b"".join(chunks), errors), image_info)
+            # Hand the already opened source to the first upload attempt
+            pending = [source]
+            open_source = lambda: pending.pop() if pending else open_output_source(filename, image_info["subfolder"], image_info["type"])
+        return _tag_kind(_deliver_remote(job_id, image_info, open_source, errors, upload_urls), image_info)
+
+    image_bytes = get_image_data(filename, image_info["subfolder"], image_info["type"])
+    if not image_bytes:
+        errors.append(f"Failed to fetch image data for {filename} from /view endpoint.")
+        return None
+    return _tag_kind(_inline_image(filename, image_bytes, errors), image_info)
+
+# Shared by all jobs, output images are fetched while their workflow is still running
+output_pool = ThreadPoolExecutor(max_workers=COMFY_OUTPUT_WORKERS, thread_name_prefix="comfy-output")
+
+# ---------------------------------------------------------------------------
+# Result cache
+# ---------------------------------------------------------------------------
+
+MODEL_FILE_EXTENSIONS = (".safetensors", ".ckpt", ".pt", ".pth", ".bin", ".gguf", ".sft", ".onnx")
+
+def _canonical_workflow(workflow):
+    """
+    Return the workflow without the `_meta` of its nodes (titles, which do
+    not change the result), for hashing with sorted keys.
+    """
+    return {
+        node_id: {key: value for key, value in node.items() if key != "_meta"} if isinstance(node, dict) else node
+        for node_id, node in workflow.items()
+    }
+
+def _result_cache_bypass_reason(workflow):
+    """
+    Return why a workflow must not be answered from the result cache, or None.
+    Seeds of -1 and "randomize" widget values mean the client wants a new
+    result each time; nodes matching RESULT_CACHE_BYPASS_NODES are not
+    deterministic (random values, remote content, timestamps).
+    """
+    if not isinstance(workflow, dict):
+        return "the workflow is not an object"
+    bypass_nodes = re.compile(RESULT_CACHE_BYPASS_NODES) if RESULT_CACHE_BYPASS_NODES else None
+    for node_id, node in workflow.items():
+        if not isinstance(node, dict):
+            continue
+        class_type = str(node.get("class_type", ""))
+        if bypass_nodes is not None and bypass_nodes.search(class_type):
+            return f"node {node_id} ({class_type}) is not deterministic"
+        for name, value in (node.get("inputs") or {}).items():
+            if "seed" in name and isinstance(value, (int, float)) and not isinstance(value, bool) and value < 0:
+                return f"node {node_id} uses a random seed"
+            if value in ("randomize", "random"):
+                return f"node {node_id} randomizes {name}"
+    return None
+
+# Model name -> path of the file found for it, so a job only stats its models.
+# Names without a file map to the time.monotonic() of the search, which is
+# repeated after MODEL_LOOKUP_RETRY_S
+_model_paths = {}
+MODEL_LOOKUP_RETRY_S = 60
+
+def _model_identities(workflow):
+    """
+    Return {model name: "size:mtime"} for the model files referenced by the
+    workflow, so replacing a model file on disk invalidates cached results.
+    """
+    names = {
+        value
+        for node in workflow.values() if isinstance(node, dict)
+        for value in (node.get("inputs") or {}).values()
+        if isinstance(value, str) and value.lower().endswith(MODEL_FILE_EXTENSIONS)
+    }
+    identities = {}
+    for name in sorted(names):
+        identities[name] = "missing"
+        found = _model_paths.get(name)
+        if isinstance(found, str):
+            try:
+                stat = os.stat(found)
+                identities[name] = f"{stat.st_size}:{stat.st_mtime_ns}"
+                continue
+            except OSError:
+                pass
+        elif found is not None and time.monotonic() - found < MODEL_LOOKUP_RETRY_S:
+            continue
+        _model_paths[name] = time.monotonic()
+        for models_dir in COMFY_MODEL_DIRS:
+            if not os.path.isdir(models_dir):
+                continue
+            for category in sorted(os.listdir(models_dir)):
+                path = os.path.join(models_dir, category, name)
+                if os.path.isfile(path):
+                    stat = os.stat(path)
+                    identities[name] = f"{stat.st_size}:{stat.st_mtime_ns}"
+                    _model_paths[name] = path
+                    break
+            if identities[name] != "missing":
+                break
+    return identities
+
+def result_cache_key(workflow, images=None, selection=None):
+    """
+    Return the result cache key of a job: the SHA-256 of its canonical
+    workflow, input image hashes, model file identities and output selection.
+    Returns None if the job bypasses the cache.
+    """
+    reason = _result_cache_bypass_reason(workflow)
+    if reason:
+        if result_cache is not None:
+            print(f"worker-comfyui - Bypassing the result cache: {reason}")
+        return None
+    try:
+        image_hashes = {image["name"]: _decoded_input_image(image)[1] for image in images or []}
+    except (ValueError, TypeError):
+        # Let the upload report the broken image
+        return None
+    canonical = {
+        "workflow": _canonical_workflow(workflow),
+        "images": image_hashes,
+        "models": _model_identities(workflow),
+        "outputs": selection,
+    }
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+class ResultCache:
+    """
+    Disk-backed LRU cache of finished job results.
+
+    Each entry is a directory named after the job's cache key. It holds every
+    output file as `<index>/<filename>` plus a `manifest.json` listing their
+    node ids and kinds. Entries are written to a temporary directory and
+    renamed into place, so readers never see a partial entry. Once the
+    entries exceed `max_bytes`, the least recently used ones are deleted.
+    Entries being delivered are pinned and never evicted.
+    """
+
+    MANIFEST = "manifest.json"
+    KEY_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+    # Staging directories (".<key>.<id>") younger than this may still be written by a running store
+    STAGING_GRACE_S = 3600
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._pins = Counter()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._scan()
+
+    def _scan(self):
+        """Index the entries left in the cache directory by earlier runs and drop unfinished ones."""
+        os.makedirs(self.directory, exist_ok=True)
+        found = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_dir():
+                continue
+            manifest = os.path.join(entry.path, self.MANIFEST)
+            if self.KEY_PATTERN.match(entry.name) and os.path.isfile(manifest):
+                found.append((os.stat(manifest).st_atime, entry.name, _tree_size(entry.path)))
+            elif not entry.name.startswith(".") or time.time() - entry.stat().st_mtime > self.STAGING_GRACE_S:
+                shutil.rmtree(entry.path, ignore_errors=True)
+        with self._lock:
+            for _, key, size in sorted(found):
+                self._entries[key] = size
+                self._total_bytes += size
+            self._evict()
+
+    def acquire(self, key, count=True):
+        """
+        Pin the entry for `key` and return its outputs as image infos
+        (type "cached"), or None on a miss. `count` records the hit or miss.
+        """
+        with self._lock:
+            manifest = None
+            if key in self._entries:
+                try:
+                    with open(os.path.join(self.directory, key, self.MANIFEST)) as f:
+                        manifest = json.load(f)
+                except (OSError, ValueError):
+                    # Removed behind our back, e.g. by a manual cleanup
+                    self._total_bytes -= self._entries.pop(key)
+            if manifest is None:
+                self.misses += count
+                return None
+            self.hits += count
+            self._entries.move_to_end(key)
+            self._pins[key] += 1
+        return [
+            {"node_id": output["node_id"], "filename": output["filename"], "subfolder": f"{key}/{index}", "type": "cached", "kind": output["kind"], "index": index}
+            for index, output in enumerate(manifest)
+        ]
+
+    def release(self, key):
+        """Unpin an entry once its outputs were delivered."""
+        with self._lock:
+            self._pins[key] -= 1
+            if self._pins[key] <= 0:
+                del self._pins[key]
+            self._evict()
+
+    def store(self, key, outputs):
+        """
+        Store the outputs of a finished job: (image info, image bytes or None)
+        tuples, where outputs without bytes are copied from ComfyUI.
+        """
+        if key in self._entries:
+            return
+        staging = os.path.join(self.directory, f".{key}.{uuid.uuid4().hex[:8]}")
+        try:
+            manifest = []
+            for index, (image_info, image_bytes) in enumerate(outputs):
+                filename = os.path.basename(image_info["filename"])
+                os.makedirs(os.path.join(staging, str(index)))
+                with open(os.path.join(staging, str(index), filename), "wb") as f:
+                    if image_bytes is not None:
+                        f.write(image_bytes)
+                    else:
+                        chunks, _ = open_output_source(filename, image_info["subfolder"], image_info["type"])
+                        for chunk in chunks:
+                            f.write(chunk)
+                manifest.append({"node_id": image_info["node_id"], "filename": filename, "kind": image_info.get("kind", "images")})
+            with open(os.path.join(staging, self.MANIFEST), "w") as f:
+                json.dump(manifest, f)
+        except Exception as e:
+            print(f"worker-comfyui - Could not store result {key} in the cache: {e}")
+            shutil.rmtree(staging, ignore_errors=True)
+            return
+        if self._commit(key, staging):
+            print(f"worker-comfyui - Stored {len(outputs)} output(s) in the result cache ({key[:12]})")
+
+    def import_entry(self, key, source):
+        """
+        Copy an entry directory, e.g. from the shared cache tier, into this cache.
+        Returns True if the entry is now in the cache.
+        """
+        if key in self._entries:
+            return True
+        staging = os.path.join(self.directory, f".{key}.{uuid.uuid4().hex[:8]}")
+        try:
+            shutil.copytree(source, staging)
+        except OSError as e:
+            print(f"worker-comfyui - Could not copy result {key[:12]} from the shared cache: {e}")
+            shutil.rmtree(staging, ignore_errors=True)
+            return False
+        return self._commit(key, staging)
+
+    def _commit(self, key, staging):
+        """Rename a complete staging directory into place and index it."""
+        size = _tree_size(staging)
+        try:
+            os.rename(staging, os.path.join(self.directory, key))
+        except OSError as e:
+            # An entry for the same key stored by a parallel job also ends up here
+            print(f"worker-comfyui - Could not store result {key[:12]} in the cache: {e}")
+            shutil.rmtree(staging, ignore_errors=True)
+            return key in self._entries
+        with self._lock:
+            self._entries[key] = size
+            self._total_bytes += size
+            self._evict()
+        return True
+
+    def _evict(self):
+        for key in list(self._entries):
+            if self._total_bytes <= self.max_bytes:
+                break
+            if self._pins.get(key):
+                continue
+            self._total_bytes -= self._entries.pop(key)
+            shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+            print(f"worker-comfyui - Evicted cached result {key[:12]}")
+
+result_cache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_MB * 1024 * 1024) if RESULT_CACHE_MAX_MB > 0 and not IN_CHILD_PROCESS else None
+
+def _job_cache_key(validated_data):
+    """
+    Return the result cache key of a validated job, or None if neither the
+    cache nor job coalescing is enabled or the job bypasses them
+    (`input.cache: false`). Coalescing needs a second job running at the
+    same time, so a worker taking one job at a time skips the key.
+    """
+    coalescing = COALESCE_JOBS and COMFY_MAX_CONCURRENCY > 1
+    if (result_cache is None and not coalescing) or not validated_data.get("cache", True):
+        return None
+    if not isinstance(validated_data["workflow"], dict):
+        return None
+    return result_cache_key(validated_data["workflow"], validated_data.get("images"), validated_data.get("outputs"))
+
+def _acquire_cached_result(cache_key):
+    """
+    Look a result up in the local cache, then in the shared tier, whose hits
+    are copied to the local cache first. Returns the pinned outputs or None.
+    """
+    if cache_key is None or result_cache is None:
+        return None
+    outputs = result_cache.acquire(cache_key)
+    tier = "local"
+    if outputs is None and shared_cache is not None:
+        path = shared_cache.lookup("results", cache_key)
+        if path is not None and result_cache.import_entry(cache_key, path):
+            outputs = result_cache.acquire(cache_key, count=False)
+            tier = "shared"
+    if outputs is not None:
+        print(f"worker-comfyui - Result cache hit ({tier} tier), returning {len(outputs)} cached output(s)")
+    print(f"worker-comfyui - Cache stats: {cache_stats()}")
+    return outputs
+
+def _share_result(cache_key, outputs):
+    """
+    Store a result in the local cache and publish it to the shared tier.
+    """
+    result_cache.store(cache_key, outputs)
+    path = os.path.join(result_cache.directory, cache_key)
+    if shared_cache is not None and os.path.isdir(path):
+        shared_cache.publish("results", cache_key, path)
+
+def _store_result(job_id, cache_key, handed_out, output_data, errors):
+    """
+    Hand the outputs of a job that finished without errors to the identical
+    jobs waiting for it and store them in the result cache, in the background.
+    """
+    if cache_key is None:
+        return
+    outputs = None if errors or not output_data else list(handed_out)
+    inflight_jobs.finish(cache_key, job_id, outputs)
+    if outputs is not None and result_cache is not None:
+        output_pool.submit(_share_result, cache_key, outputs)
+
+# ---------------------------------------------------------------------------
+# In-flight job coalescing
+# ---------------------------------------------------------------------------
+
+class InflightJobs:
+    """
+    Jobs that are running a workflow, by result cache key. An identical job
+    arriving meanwhile waits for the outputs of the running one (its leader)
+    instead of queueing the same prompt again. When the leader fails, the
+    jobs waiting for it get None and one of them becomes the new leader.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._leaders = {}
+        self.coalesced = 0
+
+    def join(self, key, job_id):
+        """
+        Make job_id the leader for key and return None, or return the Future
+        of the job already leading it, which resolves to its outputs.
+        """
+        with self._lock:
+            leader = self._leaders.get(key)
+            if leader is None:
+                self._leaders[key] = (job_id, Future())
+                return None
+            if leader[0] == job_id:
+                return None
+            self.coalesced += 1
+            return leader[1]
+
+    def finish(self, key, job_id, outputs):
+        """
+        Resolve the Future of job_id's key with its outputs (None if it failed).
+        """
+        with self._lock:
+            leader = self._leaders.get(key)
+            if leader is None or leader[0] != job_id:
+                return
+            del self._leaders[key]
+        leader[1].set_result(outputs)
+
+    def abandon(self, job_id):
+        """
+        Fail every key job_id still leads, once the job is done.
+        """
+        with self._lock:
+            keys = [key for key, (leader_id, _) in self._leaders.items() if leader_id == job_id]
+        for key in keys:
+            self.finish(key, job_id, None)
+
+inflight_jobs = InflightJobs()
+
+def _wait_for_identical_job(cache_key, job_id):
+    """
+    Wait for a running job with the same key and return its outputs as
+    (image_info, bytes or None) pairs, or None once this job is the one to run
+    the workflow.
+    """
+    if cache_key is None or not COALESCE_JOBS:
+        return None
+    while True:
+        leader = inflight_jobs.join(cache_key, job_id)
+        if leader is None:
+            return None
+        print("worker-comfyui - Identical job is running, waiting for its outputs")
+        outputs = leader.result()
+        if outputs is not None:
+            print(f"worker-comfyui - Sharing {len(outputs)} output(s) of the identical job")
+            return outputs
+        print("worker-comfyui - Identical job failed, running the workflow")
+
+async def _async_wait_for_identical_job(cache_key, job_id):
+    """
+    Async variant of _wait_for_identical_job().
+    """
+    if cache_key is None or not COALESCE_JOBS:
+        return None
+    while True:
+        leader = inflight_jobs.join(cache_key, job_id)
+        if leader is None:
+            return None
+        print("worker-comfyui - Identical job is running, waiting for its outputs")
+        outputs = await asyncio.wrap_future(leader)
+        if outputs is not None:
+            print(f"worker-comfyui - Sharing {len(outputs)} output(s) of the identical job")
+            return outputs
+        print("worker-comfyui - Identical job failed, running the workflow")
+
+# ---------------------------------------------------------------------------
+# Micro-batching: compatible jobs arriving within a short window run as one prompt
+# ---------------------------------------------------------------------------
+
+def merge_workflows(workflows):
+    """
+    Merge workflows into one prompt. The nodes of the first workflow keep
+    their ids. A node of a later workflow whose class and inputs (links
+    resolved) equal a node of an earlier workflow is shared instead of added
+    again, so models are loaded and the common part of the graphs runs once
+    for all of them. Two nodes of one workflow are never mapped to the same
+    merged node, so identical nodes (e.g. two SaveImage nodes on one decode)
+    keep their own outputs. Returns the merged workflow and, per workflow, a
+    map from its node ids to the merged ones.
+    """
+    merged = {}
+    # Content -> merged ids of the nodes added by the earlier workflows
+    by_content = {}
+    mappings = []
+    next_id = 1 + max((int(node_id) for workflow in workflows for node_id in workflow if str(node_id).isdigit()), default=0)
+
+    for index, workflow in enumerate(workflows):
+        mapping = {}
+        used = set()
+        added = []
+
+        def add(node_id):
+            if node_id in mapping:
+                return mapping[node_id]
+            node = workflow[node_id]
+            inputs = {
+                name: [add(str(value[0])), value[1]] if _is_node_link(value, workflow) else value
+                for name, value in (node.get("inputs") or {}).items()
+            }
+            content = json.dumps([node.get("class_type"), inputs], sort_keys=True)
+            shared = [merged_id for merged_id in by_content.get(content, []) if merged_id not in used]
+            if shared:
+                merged_id = shared[0]
+            else:
+                nonlocal next_id
+                merged_id = str(node_id)
+                if index:
+                    merged_id, next_id = str(next_id), next_id + 1
+                merged[merged_id] = {**node, "inputs": inputs}
+                added.append((content, merged_id))
+            mapping[node_id] = merged_id
+            used.add(merged_id)
+            return merged_id
+
+        for node_id in workflow:
+            add(str(node_id))
+        for content, merged_id in added:
+            by_content.setdefault(content, []).append(merged_id)
+        mappings.append(mapping)
+    return merged, mappings
+
+def batch_signature(workflow):
+    """
+    Return the hash of a workflow with the values of BATCH_VARYING_INPUTS
+    blanked out. Jobs with equal signatures can run as one prompt.
+    """
+    masked = {
+        node_id: {
+            **node,
+            "inputs": {
+                name: None if name in BATCH_VARYING_INPUTS and not _is_node_link(value, workflow) else value
+                for name, value in (node.get("inputs") or {}).items()
+            },
+        }
+        for node_id, node in _canonical_workflow(workflow).items()
+    }
+    return hashlib.sha256(json.dumps(masked, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+class _Batch:
+    """
+    Jobs running as one prompt. The first job (the leader) runs the merged
+    workflow, `done` resolves to the outputs of all nodes of the prompt, or
+    None if it failed.
+    """
+
+    def __init__(self, leader_id):
+        self.leader_id = leader_id
+        self.members = []
+        self.mappings = {}
+        self.workflow = None
+        self.full = threading.Event()
+        self.done = Future()
+        # Jobs whose nodes failed validation in the merged prompt, they run on their own
+        self.failed = set()
+
+class BatchScheduler:
+    """
+    Groups jobs with the same batch signature that arrive within `window_s`
+    of the first one, up to `max_size` jobs.
+    """
+
+    def __init__(self, window_s, max_size):
+        self.window_s = window_s
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._open = {}
+        self._running = {}
+        self.batched = 0
+
+    def join(self, signature, job_id, workflow):
+        """
+        Add a job to the open batch of its signature, or open one led by it.
+        """
+        with self._lock:
+            batch = self._open.get(signature)
+            if batch is None:
+                batch = self._open[signature] = _Batch(job_id)
+                self._running[job_id] = batch
+            batch.members.append((job_id, workflow))
+            if len(batch.members) >= self.max_size:
+                del self._open[signature]
+                batch.full.set()
+        return batch
+
+    def close(self, signature, batch):
+        """
+        Stop a batch from taking new jobs and merge the workflows of its
+        members. Returns False if no other job joined.
+        """
+        with self._lock:
+            if self._open.get(signature) is batch:
+                del self._open[signature]
+        if len(batch.members) == 1:
+            self.finish(batch, None)
+            return False
+        batch.workflow, mappings = merge_workflows([workflow for _, workflow in batch.members])
+        batch.mappings = {job_id: mapping for (job_id, _), mapping in zip(batch.members, mappings)}
+        with self._lock:
+            self.batched += len(batch.members)
+        print(f"worker-comfyui - Running {len(batch.members)} jobs as one prompt ({len(batch.workflow)} nodes)")
+        return True
+
+    def finish(self, batch, outputs):
+        """
+        Hand the outputs of the merged prompt (None if it failed) to the other jobs of the batch.
+        """
+        with self._lock:
+            self._running.pop(batch.leader_id, None)
+        if not batch.done.done():
+            batch.done.set_result(outputs)
+
+    def abandon(self, job_id):
+        """
+        Fail the batch job_id leads if it did not finish, once the job is done.
+        """
+        with self._lock:
+            batch = self._running.get(job_id)
+        if batch is not None:
+            self.finish(batch, None)
+
+batch_scheduler = BatchScheduler(BATCH_WINDOW_MS / 1000, BATCH_MAX_SIZE) if BATCH_WINDOW_MS > 0 and BATCH_MAX_SIZE > 1 else None
+
+def _job_batch_signature(validated_data):
+    """
+    Return the batch signature of a validated job, or None if batching is
+    disabled, the job has input images (they are uploaded per job) or a seed
+    ComfyUI would reject.
+    """
+    if batch_scheduler is None or validated_data.get("images") or not isinstance(validated_data["workflow"], dict):
+        return None
+    workflow = validated_data["workflow"]
+    for node in workflow.values():
+        if not isinstance(node, dict):
+            return None
+        for name, value in (node.get("inputs") or {}).items():
+            if name in ("seed", "noise_seed") and not _is_node_link(value, workflow):
+                if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+                    return None
+    return batch_signature(workflow)
+
+def _batch_failed_jobs(batch, node_errors):
+    """
+    Return the ids of the jobs of a batch that own a node listed in the
+    `node_errors` ComfyUI accepted the merged prompt with, or an output
+    depending on one. Their outputs will be missing.
+    """
+    failed_nodes = set()
+    for node_id, node_error in (node_errors or {}).items():
+        failed_nodes.add(str(node_id))
+        if isinstance(node_error, dict):
+            failed_nodes.update(str(output_id) for output_id in node_error.get("dependent_outputs") or [])
+    return {job_id for job_id, mapping in batch.mappings.items() if failed_nodes & set(mapping.values())}
+
+def _member_outputs(batch, job_id, workflow, selection, outputs, errors):
+    """
+    Return the outputs of one job of a batch, picked from the outputs of the
+    merged prompt by its own node ids and `input.outputs` selection.
+    """
+    mapping = batch.mappings[job_id]
+    picker = _PromptOutputs(workflow, selection)
+    picker.new_images({node_id: outputs[merged_id] for node_id, merged_id in mapping.items() if merged_id in outputs}, errors)
+    return picker.handed_out
+
+def _batch_window_s():
+    """
+    Return how long a batch leader waits for other jobs: not at all when the
+    worker takes one job at a time, no other job could arrive.
+    """
+    if COMFY_MAX_CONCURRENCY <= 1 or _concurrency_state.get("current", COMFY_MIN_CONCURRENCY) <= 1:
+        return 0
+    return batch_scheduler.window_s
+
+def _failed_in_other_job(batch, job_id, message):
+    """
+    Return True if `message` is the execution error of a node the leader
+    job_id does not use, so the leader must run its workflow on its own.
+    """
+    node_id = (message.get("data") or {}).get("node_id")
+    return message.get("type") == "execution_error" and str(node_id) not in batch.mappings[job_id].values()
+
+def _check_batch_node_errors(batch, leader_id, queued_workflow):
+    """
+    Mark the jobs of a batch whose nodes ComfyUI rejected in the queue
+    response of the merged prompt, so they run on their own to get their own
+    outputs or validation error. Returns True if the leader is one of them;
+    it keeps running the prompt for the others.
+    """
+    batch.failed = _batch_failed_jobs(batch, queued_workflow.get("node_errors"))
+    if batch.failed:
+        print(f"worker-comfyui - {len(batch.failed)} job(s) of the batch failed validation, they run on their own")
+    return leader_id in batch.failed
+
+def _leader_selection(workflow, selection):
+    """
+    Restrict the `input.outputs` selection of a batch leader to its own nodes.
+    """
+    selection = dict(selection or {})
+    if selection.get("nodes") is None:
+        selection["nodes"] = [str(node_id) for node_id in workflow]
+    return selection
+
+def _deliver_outputs(job_id, outputs, errors, upload_urls=None, budget=None, encoding=None, dedup=None):
+    """
+    Deliver outputs that already exist, from the result cache or an identical
+    job, on the output pool. Returns the response entries in order.
+    """
+    fetches = []
+    for image_info, image_bytes in outputs:
+        if image_bytes is None:
+            fetches.append(output_pool.submit(_fetch_and_deliver, job_id, image_info, errors, upload_urls, budget, encoding, dedup))
+        else:
+            fetches.append(output_pool.submit(_deliver_image_bytes, job_id, image_info, image_bytes, errors, upload_urls, budget, encoding, dedup))
+    return [entry for entry in (fetch.result() for fetch in fetches) if entry]
+
+def handler(job):
+    """
+    Handles a job using ComfyUI via websockets for status and image retrieval.
+    Maintains backwards compatibility with single image inputs.
+    """
+    try:
+        return _run_job(job)
+    finally:
+        inflight_jobs.abandon(job["id"])
+        if batch_scheduler is not None:
+            batch_scheduler.abandon(job["id"])
+
+def _run_job(job, batching=True):
+    """
+    Body of handler(). With batching False the job runs on its own.
+    """
+    job_input = job["input"]
+    job_id = job["id"]
+
+    # Validate input
+    validated_data, error_message = validate_input(job_input)
+    if error_message:
+        return {"error": error_message}
+
+    workflow = validated_data["workflow"]
+    input_images = validated_data.get("images")
+    response_format = validated_data.get("response_format", RESPONSE_FORMAT)
+    upload_urls = validated_data.get("upload_urls")
+    budget = _response_budget()
+    encoding = validated_data.get("output_encoding")
+    dedup = _job_output_dedup(upload_urls)
+
+    # Answer repeated jobs from the result cache without running ComfyUI
+    cache_key = _job_cache_key(validated_data)
+    cached_outputs = _acquire_cached_result(cache_key)
+    if cached_outputs is not None:
+        errors = []
+        try:
+            output_data = _deliver_outputs(job_id, [(image_info, None) for image_info in cached_outputs], errors, upload_urls, budget, encoding, dedup)
+        finally:
+            result_cache.release(cache_key)
+        return _build_response(output_data, errors, response_format)
+
+    # Share the outputs of an identical job that is already running
+    shared_outputs = _wait_for_identical_job(cache_key, job_id)
+    if shared_outputs is not None:
+        errors = []
+        output_data = _deliver_outputs(job_id, shared_outputs, errors, upload_urls, budget, encoding, dedup)
+        return _build_response(output_data, errors, response_format)
+
+    # Run as one prompt with compatible jobs arriving within the batch window
+    selection = validated_data.get("outputs")
+    batch = None
+    signature = _job_batch_signature(validated_data) if batching else None
+    if signature is not None:
+        batch = batch_scheduler.join(signature, job_id, workflow)
+        if batch.leader_id == job_id:
+            batch.full.wait(_batch_window_s())
+            if batch_scheduler.close(signature, batch):
+                workflow = batch.workflow
+                selection = _leader_selection(validated_data["workflow"], selection)
+            else:
+                batch = None
+        else:
+            try:
+                outputs = batch.done.result(timeout=BATCH_LEADER_TIMEOUT_S)
+            except FutureTimeoutError:
+                print(f"worker-comfyui - Batched prompt did not finish within {BATCH_LEADER_TIMEOUT_S}s")
+                outputs = None
+            if outputs is not None and job_id not in batch.failed:
+                errors = []
+                handed_out = _member_outputs(batch, job_id, workflow, selection, outputs, errors)
+                output_data = _deliver_outputs(job_id, handed_out, errors, upload_urls, budget, encoding, dedup)
+                _store_result(job_id, cache_key, handed_out, output_data, errors)
+                return _build_response(output_data, errors, response_format)
+            print("worker-comfyui - Batched prompt failed, running the workflow on its own")
+            batch = None
+
+    # Check server availability
     if not check_server(f"http://{COMFY_HOST}/", COMFY_API_AVAILABLE_MAX_RETRIES, COMFY_API_AVAILABLE_INTERVAL_MS):
         return {"error": f"ComfyUI server ({COMFY_HOST}) not reachable after multiple retries."}
 
+    # Embed input images in the workflow if the tooling nodes are installed
+    if input_images and IMAGE_INPUT_MODE == "inline" and node_class_available(INLINE_IMAGE_NODE_CLASS):
+        workflow, input_images = _inline_input_images(workflow, input_images)
+
     # Upload input images if they exist
+    stored_names = {}
     if input_images:
-        upload_result = upload_images(input_images)
+        upload_result, stored_names = upload_input_images(input_images)
         if upload_result["status"] == "error":
+            _release_input_images(stored_names)
             return {
                 "error": "Failed to upload one or more input images",
                 "details": upload_result["details"],
             }
+        workflow = _rewrite_image_references(workflow, stored_names)
+
+    # Receive output images as websocket frames if the tooling nodes are installed.
+    # The images of other jobs in a batch must stay on disk for them
+    ws_output_prefixes = {}
+    if IMAGE_OUTPUT_MODE == "websocket" and batch is None and node_class_available(WEBSOCKET_IMAGE_NODE_CLASS):
+        workflow, ws_output_prefixes = _rewrite_save_nodes_for_websocket(workflow)
 
-    ws = None
-    client_id = str(uuid.uuid4())
     prompt_id = None
     output_data = []
     errors = []
+    prompt_outputs = _PromptOutputs(workflow, selection)
+    fetches = []
+    rerun_alone = False
 
     try:
-        # Establish WebSocket connection
-        ws_url = f"ws://{COMFY_HOST}/ws?clientId={client_id}"
-        print(f"worker-comfyui - Connecting to websocket: {ws_url}")
-        ws = websocket.WebSocket()
-        ws.connect(ws_url, timeout=10)
-        print(f"worker-comfyui - Websocket connected")
+        # Make sure the shared websocket connection is up
+        ws_manager.start()
 
         # Queue the workflow
         try:
-            queued_workflow = queue_workflow(workflow, client_id)
+            queued_workflow = queue_workflow(workflow, ws_manager.client_id)
             prompt_id = queued_workflow.get("prompt_id")
             if not prompt_id:
                 raise ValueError(f"Missing 'prompt_id' in queue response: {queued_workflow}")
             print(f"worker-comfyui - Queued workflow with ID: {prompt_id}")
+            if batch is not None:
+                rerun_alone = _check_batch_node_errors(batch, job_id, queued_workflow)
+                if rerun_alone:
+                    prompt_outputs = _PromptOutputs(workflow, {"nodes": []})
         except requests.RequestException as e:
             print(f"worker-comfyui - Error queuing workflow: {e}")
             raise ValueError(f"Error queuing workflow: {e}")
@@ -387,149 +3085,82 @@ def handler(job):
 
         # Wait for execution completion via WebSocket
         print(f"worker-comfyui - Waiting for workflow execution ({prompt_id})...")
+        events = ws_manager.register(prompt_id)
         execution_done = False
+        binary_frames = []
+        history = {}
         while True:
             try:
-                out = ws.recv()
-                if isinstance(out, str):
-                    message = json.loads(out)
-                    if message.get("type") == "status":
-                        status_data = message.get("data", {}).get("status", {})
-                        print(f"worker-comfyui - Status update: {status_data.get('exec_info', {}).get('queue_remaining', 'N/A')} items remaining in queue")
-                    elif message.get("type") == "executing":
-                        data = message.get("data", {})
-                        if data.get("node") is None and data.get("prompt_id") == prompt_id:
-                            print(f"worker-comfyui - Execution finished for prompt {prompt_id}")
-                            execution_done = True
-                            break
-                    elif message.get("type") == "execution_error":
-                        data = message.get("data", {})
-                        if data.get("prompt_id") == prompt_id:
-                            error_details = f"Node Type: {data.get('node_type')}, Node ID: {data.get('node_id')}, Message: {data.get('exception_message')}"
-                            print(f"worker-comfyui - Execution error received: {error_details}")
-                            errors.append(f"Workflow execution error: {error_details}")
-                            break
-                else:
-                    continue
-            except websocket.WebSocketTimeoutException:
+                message = events.get(timeout=WEBSOCKET_EVENT_TIMEOUT_S)
+            except queue.Empty:
+                if not ws_manager.reader_alive:
+                    raise websocket.WebSocketConnectionClosedException("Websocket reader stopped while waiting for the workflow")
                 print(f"worker-comfyui - Websocket receive timed out. Still waiting...")
                 continue
-            except websocket.WebSocketConnectionClosedException as closed_err:
-                try:
-                    ws = _attempt_websocket_reconnect(ws_url, WEBSOCKET_RECONNECT_ATTEMPTS, WEBSOCKET_RECONNECT_DELAY_S, closed_err)
-                    print("worker-comfyui - Resuming message listening after successful reconnect.")
-                    continue
-                except websocket.WebSocketConnectionClosedException as reconn_failed_err:
-                    raise reconn_failed_err
 
-            except json.JSONDecodeError:
-                print(f"worker-comfyui - Received invalid JSON message via websocket.")
+            if message.get("type") == "binary":
+                binary_frames.append(message["data"])
+                continue
+
+            # Start fetching the images of each output node as soon as it finished
+            finished_output = prompt_outputs.add_event(message)
+            if finished_output:
+                for image_info in prompt_outputs.new_images(finished_output, errors, exclude=ws_output_prefixes):
+                    fetches.append(output_pool.submit(_fetch_and_deliver, job_id, image_info, errors, upload_urls, budget, encoding, dedup))
+
+            outcome = _prompt_event_outcome(message, prompt_id, errors)
+            if outcome == "reconnected":
+                if ws_output_prefixes:
+                    errors.append("Websocket reconnected during execution, images sent in the meantime are missing.")
+                # Events sent while the socket was down are lost, so ask the history
+                history = get_history(prompt_id)
+                if prompt_id in history:
+                    print(f"worker-comfyui - Prompt {prompt_id} finished while the websocket was reconnecting")
+                    outcome = "done"
+            if outcome == "done":
+                execution_done = True
+                break
+            if outcome == "error":
+                if batch is not None and _failed_in_other_job(batch, job_id, message):
+                    rerun_alone = True
+                break
 
         if not execution_done and not errors:
             raise ValueError("Workflow monitoring loop exited without confirmation of completion or error.")
 
-        # Fetch history
-        print(f"worker-comfyui - Fetching history for prompt {prompt_id}...")
-        history = get_history(prompt_id)
-
-        if prompt_id not in history:
-            error_msg = f"Prompt ID {prompt_id} not found in history after execution."
-            print(f"worker-comfyui - {error_msg}")
-            if not errors:
-                return {"error": error_msg}
-            else:
-                errors.append(error_msg)
-                return {"error": "Job processing failed, prompt ID not found in history.", "details": errors}
-
-        prompt_history = history.get(prompt_id, {})
-        outputs = prompt_history.get("outputs", {})
-
-        if not outputs:
-            warning_msg = f"No outputs found in history for prompt {prompt_id}."
-            print(f"worker-comfyui - {warning_msg}")
-            if not errors:
-                errors.append(warning_msg)
-
-        print(f"worker-comfyui - Processing {len(outputs)} output nodes...")
-        for node_id, node_output in outputs.items():
-            if "images" in node_output:
-                print(f"worker-comfyui - Node {node_id} contains {len(node_output['images'])} image(s)")
-                for image_info in node_output["images"]:
-                    filename = image_info.get("filename")
-                    subfolder = image_info.get("subfolder", "")
-                    img_type = image_info.get("type")
-
-                    # Skip temp images
-                    if img_type == "temp":
-                        print(f"worker-comfyui - Skipping image {filename} because type is 'temp'")
-                        continue
-
-                    if not filename:
-                        warn_msg = f"Skipping image in node {node_id} due to missing filename: {image_info}"
-                        print(f"worker-comfyui - {warn_msg}")
-                        errors.append(warn_msg)
-                        continue
-
-                    image_bytes = get_image_data(filename, subfolder, img_type)
-
-                    if image_bytes:
-                        file_extension = os.path.splitext(filename)[1] or ".png"
-
-                        if os.environ.get("BUCKET_ENDPOINT_URL"):
-                            try:
-                                with tempfile.NamedTemporaryFile(suffix=file_extension, delete=False) as temp_file:
-                                    temp_file.write(image_bytes)
-                                    temp_file_path = temp_file.name
-                                print(f"worker-comfyui - Wrote image bytes to temporary file: {temp_file_path}")
-
-                                print(f"worker-comfyui - Uploading {filename} to S3...")
-                                s3_url = rp_upload.upload_image(job_id, temp_file_path)
-                                os.remove(temp_file_path)
-                                print(f"worker-comfyui - Uploaded {filename} to S3: {s3_url}")
-                                
-                                # For backwards compatibility, return the first image as the main result
-                                if not output_data:
-                                    output_data.append({
-                                        "filename": filename,
-                                        "type": "s3_url",
-                                        "data": s3_url,
-                                    })
-                            except Exception as e:
-                                error_msg = f"Error uploading {filename} to S3: {e}"
-                                print(f"worker-comfyui - {error_msg}")
-                                errors.append(error_msg)
-                                if "temp_file_path" in locals() and os.path.exists(temp_file_path):
-                                    try:
-                                        os.remove(temp_file_path)
-                                    except OSError as rm_err:
-                                        print(f"worker-comfyui - Error removing temp file {temp_file_path}: {rm_err}")
-                        else:
-                            # Return as base64 string
-                            try:
-                                base64_image = base64.b64encode(image_bytes).decode("utf-8")
-                                
-                                # For backwards compatibility, return the first image as the main result
-                                if not output_data:
-                                    output_data.append({
-                                        "filename": filename,
-                                        "type": "base64",
-                                        "data": base64_image,
-                                    })
-                                print(f"worker-comfyui - Encoded {filename} as base64")
-                            except Exception as e:
-                                error_msg = f"Error encoding {filename} to base64: {e}"
-                                print(f"worker-comfyui - {error_msg}")
-                                errors.append(error_msg)
-                    else:
-                        error_msg = f"Failed to fetch image data for {filename} from /view endpoint."
-                        errors.append(error_msg)
-
-            # Check for other output types
-            other_keys = [k for k in node_output.keys() if k != "images"]
-            if other_keys:
-                warn_msg = f"Node {node_id} produced unhandled output keys: {other_keys}."
-                print(f"worker-comfyui - WARNING: {warn_msg}")
-                print(f"worker-comfyui - --> If this output is useful, please consider opening an issue on GitHub to discuss adding support.")
+        if rerun_alone:
+            # Nothing of this run is handed out, the job runs again on its own
+            for fetch in fetches:
+                fetch.cancel()
+            fetches = []
+        elif ws_output_prefixes:
+            # The images are already in memory, no need for /history and /view
+            for image_info, image_bytes in prompt_outputs.websocket_images(binary_frames, ws_output_prefixes):
+                fetches.append(output_pool.submit(_deliver_image_bytes, job_id, image_info, image_bytes, errors, upload_urls, budget, encoding, dedup))
+        # The history is only needed for outputs that were not reported as events
+        elif prompt_outputs.needs_history():
+            if prompt_id not in history:
+                print(f"worker-comfyui - Fetching history for prompt {prompt_id}...")
+                history = get_history(prompt_id)
+
+            if prompt_id not in history:
+                return _missing_history_response(prompt_id, errors)
+
+            outputs = prompt_outputs.merge_history(_history_outputs(history, prompt_id, errors))
+            for image_info in prompt_outputs.new_images(outputs, errors):
+                fetches.append(output_pool.submit(_fetch_and_deliver, job_id, image_info, errors, upload_urls, budget, encoding, dedup))
+        elif not prompt_outputs.outputs:
+            _no_outputs_warning(prompt_id, errors)
+
+        if batch is not None and execution_done:
+            # The other jobs of the batch need the outputs of all nodes
+            if not prompt_outputs.all_outputs_known():
+                if prompt_id not in history:
+                    history = get_history(prompt_id)
+                prompt_outputs.merge_history(_history_outputs(history, prompt_id, []))
+            batch_scheduler.finish(batch, dict(prompt_outputs.outputs))
+
+        output_data = [entry for entry in (fetch.result() for fetch in fetches) if entry]
 
     except websocket.WebSocketException as e:
         print(f"worker-comfyui - WebSocket Error: {e}")
@@ -548,25 +3179,764 @@ def handler(job):
         print(traceback.format_exc())
         return {"error": f"An unexpected error occurred: {e}"}
     finally:
-        if ws and ws.connected:
-            print(f"worker-comfyui - Closing websocket connection.")
-            ws.close()
+        for fetch in fetches:
+            fetch.cancel()
+        if prompt_id:
+            ws_manager.unregister(prompt_id)
+        _release_input_images(stored_names)
+        if rerun_alone:
+            batch_scheduler.finish(batch, None)
+
+    if rerun_alone:
+        return _run_job(job, batching=False)
+    _store_result(job_id, cache_key, prompt_outputs.handed_out, output_data, errors)
+    return _build_response(output_data, errors, response_format)
 
-    # For backwards compatibility, return the first image in the old format
-    if output_data:
-        first_image = output_data[0]
-        if first_image["type"] == "s3_url":
-            return {"status": "success", "message": first_image["data"], "refresh_worker": REFRESH_WORKER}
-        else:  # base64
-            return {"status": "success", "message": first_image["data"], "refresh_worker": REFRESH_WORKER}
+# ---------------------------------------------------------------------------
+# Async pipeline: same job flow as handler(), built on aiohttp so one worker
+# can serve overlapping jobs without a thread per job
+# ---------------------------------------------------------------------------
 
-    if errors:
-        print(f"worker-comfyui - Job completed with errors/warnings: {errors}")
-        return {"error": "Job processing failed", "details": errors}
+class AsyncComfyResponse:
+    """
+    Status, headers and fully read body of an aiohttp response.
+    """
 
-    print(f"worker-comfyui - Job completed successfully, but the workflow produced no images.")
-    return {"status": "success_no_images", "refresh_worker": REFRESH_WORKER}
+    def __init__(self, response, body):
+        self.status = response.status
+        self.headers = response.headers
+        self.body = body
+        self._response = response
+
+    @property
+    def text(self):
+        return self.body.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.body)
+
+    def raise_for_status(self):
+        self._response.raise_for_status()
+
+class AsyncComfyClient:
+    """
+    aiohttp-based counterpart of ComfyClient with the same endpoint policies.
+
+    One ClientSession (and thus one keep-alive connection pool) is kept per
+    event loop. Requests return an AsyncComfyResponse.
+    """
+
+    def __init__(self, host, pool_size=COMFY_HTTP_POOL_SIZE, retries=COMFY_HTTP_RETRIES,
+                 backoff_s=COMFY_HTTP_RETRY_BACKOFF_S, endpoints=COMFY_HTTP_ENDPOINTS):
+        self.base_url = f"http://{host}"
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff_s = backoff_s
+        self.endpoints = endpoints
+        self._session = None
+        self._session_loop = None
+
+    def url(self, path):
+        if "://" in path:
+            return path
+        return f"{self.base_url}{path}"
+
+    async def session(self):
+        """Return the session of the running event loop, creating it on first use."""
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._session_loop is not loop:
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._session_loop = loop
+        return self._session
+
+    async def request(self, method, path, endpoint, files=None, **kwargs):
+        """
+        Send a request using the timeout and retry policy configured for `endpoint`.
+        `files` takes the same `{field: (filename, content, content_type)}` mapping
+        as requests; the multipart body is rebuilt for every attempt.
+        """
+        policy = self.endpoints[endpoint]
+        kwargs.setdefault("timeout", aiohttp.ClientTimeout(total=policy["timeout"]))
+        attempts = 1 + (self.retries if policy["retry"] else 0)
+        url = self.url(path)
+        session = await self.session()
+
+        for attempt in range(attempts):
+            is_last_attempt = attempt == attempts - 1
+            if files is not None:
+                form = aiohttp.FormData()
+                for field, (filename, content, *content_type) in files.items():
+                    if filename is None:
+                        form.add_field(field, content)
+                    else:
+                        form.add_field(field, content, filename=filename, content_type=content_type[0] if content_type else None)
+                kwargs["data"] = form
+            try:
+                async with session.request(method, url, **kwargs) as response:
+                    response = AsyncComfyResponse(response, await response.read())
+            except aiohttp.ClientConnectionError as e:
+                if is_last_attempt:
+                    raise
+                print(f"worker-comfyui - {method} {url} failed ({e}), retrying ({attempt + 1}/{attempts - 1})...")
+            else:
+                if is_last_attempt or response.status not in COMFY_HTTP_RETRY_STATUS_CODES:
+                    return response
+                print(f"worker-comfyui - {method} {url} returned {response.status}, retrying ({attempt + 1}/{attempts - 1})...")
+            await asyncio.sleep(self.backoff_s * (2 ** attempt))
+
+    async def get(self, path, endpoint, **kwargs):
+        return await self.request("GET", path, endpoint, **kwargs)
+
+    async def post(self, path, endpoint, **kwargs):
+        return await self.request("POST", path, endpoint, **kwargs)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+async_comfy_client = AsyncComfyClient(COMFY_HOST)
+
+class AsyncComfyWebsocketManager(_PromptEventRouter):
+    """
+    asyncio counterpart of ComfyWebsocketManager: one aiohttp websocket per
+    worker, read by a background task that routes events to asyncio queues.
+    """
+
+    queue_factory = asyncio.Queue
+
+    def __init__(self, host, client_id=None, http=async_comfy_client):
+        super().__init__(host, client_id)
+        self._http = http
+        self._ws = None
+        self._task = None
+        self._start_lock = None
+
+    def _running(self):
+        return self._task is not None and not self._task.done() and self._task.get_loop() is asyncio.get_running_loop()
+
+    async def start(self):
+        """Connect and start the reader task unless it is already running."""
+        if self._running():
+            return
+        # asyncio locks belong to one event loop, tests run each job in a new one
+        loop = asyncio.get_running_loop()
+        if self._start_lock is None or self._start_lock[0] is not loop:
+            self._start_lock = (loop, asyncio.Lock())
+        async with self._start_lock[1]:
+            if self._running():
+                return
+            previous, self._ws = self._ws, await self._connect()
+            if previous is not None and not previous.closed:
+                try:
+                    await previous.close()
+                except Exception as e:
+                    print(f"worker-comfyui - Could not close the previous websocket: {e}")
+            self._task = asyncio.create_task(self._read_loop())
+
+    async def _connect(self):
+        print(f"worker-comfyui - Connecting to websocket: {self.ws_url}")
+        session = await self._http.session()
+        ws = await asyncio.wait_for(session.ws_connect(self.ws_url), timeout=WEBSOCKET_EVENT_TIMEOUT_S)
+        print(f"worker-comfyui - Websocket connected")
+        return ws
+
+    async def _reconnect(self, initial_error):
+        """Async variant of _attempt_websocket_reconnect()."""
+        print(f"worker-comfyui - Websocket connection closed unexpectedly: {initial_error}. Attempting to reconnect...")
+        last_reconnect_error = initial_error
+        for attempt in range(WEBSOCKET_RECONNECT_ATTEMPTS):
+            try:
+                response = await self._http.get("/", "probe")
+                reachable = response.status == 200
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                reachable = False
+            if not reachable:
+                print(f"worker-comfyui - ComfyUI HTTP unreachable – aborting websocket reconnect")
+                raise websocket.WebSocketConnectionClosedException("ComfyUI HTTP unreachable during websocket reconnect")
+
+            print(f"worker-comfyui - Reconnect attempt {attempt + 1}/{WEBSOCKET_RECONNECT_ATTEMPTS}...")
+            try:
+                ws = await self._connect()
+                print(f"worker-comfyui - Websocket reconnected successfully.")
+                return ws
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as reconn_err:
+                last_reconnect_error = reconn_err
+                print(f"worker-comfyui - Reconnect attempt {attempt + 1} failed: {reconn_err}")
+                if attempt < WEBSOCKET_RECONNECT_ATTEMPTS - 1:
+                    await asyncio.sleep(WEBSOCKET_RECONNECT_DELAY_S)
+
+        print("worker-comfyui - Failed to reconnect websocket after connection closed.")
+        raise websocket.WebSocketConnectionClosedException(f"Connection closed and failed to reconnect. Last error: {last_reconnect_error}")
+
+    async def _read_loop(self):
+        try:
+            await self._receive_loop()
+        except Exception as e:
+            # A failing dispatch or protocol error: drop the socket so the next job reconnects
+            print(f"worker-comfyui - Websocket reader failed: {e}")
+            print(traceback.format_exc())
+            ws, self._ws = self._ws, None
+            if ws is not None:
+                try:
+                    await ws.close()
+                except Exception:
+                    pass
+            self._broadcast({"type": "connection_lost", "data": {"error": f"Websocket reader failed: {e}"}})
+
+    @property
+    def reader_alive(self):
+        return self._task is not None and not self._task.done()
+
+    async def _receive_loop(self):
+        while True:
+            msg = await self._ws.receive()
+            if msg.type == aiohttp.WSMsgType.TEXT:
+                try:
+                    self._dispatch(json.loads(msg.data))
+                except json.JSONDecodeError:
+                    print(f"worker-comfyui - Received invalid JSON message via websocket.")
+            elif msg.type == aiohttp.WSMsgType.BINARY:
+                self._dispatch_binary(msg.data)
+            elif msg.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                try:
+                    self._ws = await self._reconnect(self._ws.exception() or msg.type.name)
+                    print("worker-comfyui - Resuming message listening after successful reconnect.")
+                    self._broadcast({"type": "reconnected", "data": {}})
+                except websocket.WebSocketConnectionClosedException as reconn_failed_err:
+                    self._ws = None
+                    self._broadcast({"type": "connection_lost", "data": {"error": str(reconn_failed_err)}})
+                    return
+
+async_ws_manager = AsyncComfyWebsocketManager(COMFY_HOST)
+
+async def async_check_server(url, retries=500, delay=50):
+    """
+    Async variant of check_server().
+    """
+    print(f"worker-comfyui - Checking API server at {url}...")
+    for i in range(retries):
+        try:
+            response = await async_comfy_client.get(url, "probe")
+            if response.status == 200:
+                print(f"worker-comfyui - API is reachable")
+                return True
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass
+        await asyncio.sleep(delay / 1000)
+
+    print(f"worker-comfyui - Failed to connect to server at {url} after {retries} attempts.")
+    return False
+
+async def _async_upload_image(image, limit):
+    """
+    Upload one base64 encoded image. Returns (success message, error message, stored name).
+    """
+    name = image.get("name", "unknown")
+    try:
+        async with limit:
+            # Decoding and hashing a large image would block the event loop
+            blob, digest = await asyncio.to_thread(_decoded_input_image, image)
+
+            stored_name = name
+            if input_cache is not None:
+                stored_name = input_cache.stored_name(name, blob, digest)
+                if input_cache.acquire(stored_name):
+                    print(f"worker-comfyui - {name} is already in ComfyUI's input directory as {stored_name}")
+                    return f"Reused cached upload of {name}", None, stored_name
+                if await asyncio.to_thread(_restore_shared_input, stored_name):
+                    print(f"worker-comfyui - Copied {name} from the shared cache as {stored_name}")
+                    return f"Reused shared upload of {name}", None, stored_name
+
+            files = {
+                "image": (stored_name, blob, "image/png"),
+                "overwrite": (None, "true"),
+            }
+            response = await async_comfy_client.post("/upload/image", "upload", files=files)
+        response.raise_for_status()
+        if input_cache is not None:
+            input_cache.add(stored_name, len(blob))
+            _publish_input(stored_name, blob)
+        print(f"worker-comfyui - Successfully uploaded {name}")
+        return f"Successfully uploaded {name}", None, stored_name
+    except base64.binascii.Error as e:
+        error_msg = f"Error decoding base64 for {name}: {e}"
+    except asyncio.TimeoutError:
+        error_msg = f"Timeout uploading {name}"
+    except aiohttp.ClientError as e:
+        error_msg = f"Error uploading {name}: {e}"
+    except Exception as e:
+        error_msg = f"Unexpected error uploading {name}: {e}"
+    print(f"worker-comfyui - {error_msg}")
+    return None, error_msg, None
+
+async def async_upload_images(images, max_workers=None):
+    """
+    Async variant of upload_input_images(); up to `max_workers` images
+    (default COMFY_UPLOAD_WORKERS) are uploaded concurrently.
+    """
+    if not images:
+        return {"status": "success", "message": "No images to upload", "details": []}, {}
+
+    print(f"worker-comfyui - Uploading {len(images)} image(s)...")
+    limit = asyncio.Semaphore(max_workers or COMFY_UPLOAD_WORKERS)
+    results = await asyncio.gather(*(_async_upload_image(image, limit) for image in images))
+    return _upload_result(images, results)
+
+async def async_queue_workflow(workflow, client_id):
+    """
+    Async variant of queue_workflow().
+    """
+    payload = {"prompt": workflow, "client_id": client_id}
+    headers = {"Content-Type": "application/json"}
+    response = await async_comfy_client.post("/prompt", "prompt", data=json.dumps(payload).encode("utf-8"), headers=headers)
+
+    if response.status == 400:
+        # Building the message may query /object_info with the blocking client
+        await asyncio.to_thread(_raise_prompt_validation_error, response.text)
+
+    response.raise_for_status()
+    return response.json()
+
+async def async_get_history(prompt_id):
+    """
+    Async variant of get_history().
+    """
+    response = await async_comfy_client.get(f"/history/{prompt_id}", "history")
+    response.raise_for_status()
+    return response.json()
+
+async def async_get_image_data(filename, subfolder, image_type):
+    """
+    Async variant of get_image_data().
+    """
+    data = await asyncio.to_thread(read_local_output, filename, subfolder, image_type)
+    if data is not None:
+        return data
+
+    print(f"worker-comfyui - Fetching image data: type={image_type}, subfolder={subfolder}, filename={filename}")
+    params = {"filename": filename, "subfolder": subfolder, "type": image_type}
+    try:
+        response = await async_comfy_client.get("/view", "view", params=params)
+        response.raise_for_status()
+        print(f"worker-comfyui - Successfully fetched image data for {filename}")
+        return response.body
+    except asyncio.TimeoutError:
+        print(f"worker-comfyui - Timeout fetching image data for {filename}")
+    except aiohttp.ClientError as e:
+        print(f"worker-comfyui - Error fetching image data for {filename}: {e}")
+    except Exception as e:
+        print(f"worker-comfyui - Unexpected error fetching image data for {filename}: {e}")
+    return None
+
+async def _async_fetch_and_deliver(job_id, image_info, errors, upload_urls=None, budget=None, encoding=None, dedup=None):
+    if upload_urls or get_s3_uploader() is not None:
+        # Streaming uploads are blocking, run them in a thread
+        return await asyncio.to_thread(_fetch_and_deliver, job_id, image_info, errors, upload_urls, budget, encoding, dedup)
+
+    filename = image_info["filename"]
+    image_bytes = await async_get_image_data(filename, image_info["subfolder"], image_info["type"])
+    if not image_bytes:
+        errors.append(f"Failed to fetch image data for {filename} from /view endpoint.")
+        return None
+    # Encoding and transcoding are blocking, keep them off the event loop
+    return await asyncio.to_thread(_deliver_image_bytes, job_id, image_info, image_bytes, errors, None, budget, encoding, dedup)
+
+def _stream_event(message):
+    """
+    Translate a websocket event into the progress event a streaming job yields,
+    or None for events the client does not need.
+    """
+    data = message.get("data") or {}
+    if message.get("type") == "progress":
+        return {"type": "progress", "node": data.get("node"), "value": data.get("value"), "max": data.get("max")}
+    if message.get("type") == "executing" and data.get("node") is not None:
+        return {"type": "executing", "node": data.get("node")}
+    return None
+
+async def _async_job_events(job):
+    """
+    Run a job on the asyncio pipeline and yield what happens as it happens:
+    `executing`/`progress` events while the workflow runs, an `image` event for
+    every output as soon as it is delivered, and a final `result` event holding
+    the response of async_handler().
+    """
+    try:
+        async for event in _async_run_job(job):
+            yield event
+    finally:
+        inflight_jobs.abandon(job["id"])
+        if batch_scheduler is not None:
+            batch_scheduler.abandon(job["id"])
+
+async def _async_deliver_output(job_id, image_info, image_bytes, errors, upload_urls, budget, encoding, dedup):
+    if image_bytes is None:
+        entry = await _async_fetch_and_deliver(job_id, image_info, errors, upload_urls, budget, encoding, dedup)
+    else:
+        entry = await asyncio.to_thread(_deliver_image_bytes, job_id, image_info, image_bytes, errors, upload_urls, budget, encoding, dedup)
+    return image_info["node_id"], entry
+
+async def _async_run_job(job, batching=True):
+    """
+    Body of _async_job_events(). With batching False the job runs on its own.
+    """
+    job_input = job["input"]
+    job_id = job["id"]
+
+    validated_data, error_message = validate_input(job_input)
+    if error_message:
+        yield {"type": "result", "output": {"error": error_message}}
+        return
+
+    workflow = validated_data["workflow"]
+    input_images = validated_data.get("images")
+    response_format = validated_data.get("response_format", RESPONSE_FORMAT)
+    upload_urls = validated_data.get("upload_urls")
+    budget = _response_budget()
+    encoding = validated_data.get("output_encoding")
+    dedup = _job_output_dedup(upload_urls)
+
+    cache_key = await asyncio.to_thread(_job_cache_key, validated_data)
+    cached_outputs = await asyncio.to_thread(_acquire_cached_result, cache_key)
+    if cached_outputs is not None:
+        existing_outputs = [(image_info, None) for image_info in cached_outputs]
+    else:
+        # Share the outputs of an identical job that is already running
+        existing_outputs = await _async_wait_for_identical_job(cache_key, job_id)
+
+    # Run as one prompt with compatible jobs arriving within the batch window
+    errors = []
+    selection = validated_data.get("outputs")
+    batch = None
+    signature = _job_batch_signature(validated_data) if existing_outputs is None and batching else None
+    if signature is not None:
+        batch = batch_scheduler.join(signature, job_id, workflow)
+        if batch.leader_id == job_id:
+            await asyncio.to_thread(batch.full.wait, _batch_window_s())
+            if batch_scheduler.close(signature, batch):
+                workflow = batch.workflow
+                selection = _leader_selection(validated_data["workflow"], selection)
+            else:
+                batch = None
+        else:
+            try:
+                outputs = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(batch.done)), BATCH_LEADER_TIMEOUT_S)
+            except asyncio.TimeoutError:
+                print(f"worker-comfyui - Batched prompt did not finish within {BATCH_LEADER_TIMEOUT_S}s")
+                outputs = None
+            if outputs is not None and job_id not in batch.failed:
+                existing_outputs = _member_outputs(batch, job_id, workflow, selection, outputs, errors)
+            else:
+                print("worker-comfyui - Batched prompt failed, running the workflow on its own")
+                batch = None
+
+    if existing_outputs is not None:
+        deliveries = [
+            asyncio.create_task(_async_deliver_output(job_id, image_info, image_bytes, errors, upload_urls, budget, encoding, dedup))
+            for image_info, image_bytes in existing_outputs
+        ]
+        try:
+            for delivery in asyncio.as_completed(deliveries):
+                node_id, entry = await delivery
+                if entry:
+                    yield {"type": "image", "node_id": node_id, "image": entry}
+        finally:
+            for delivery in deliveries:
+                delivery.cancel()
+            if cached_outputs is not None:
+                result_cache.release(cache_key)
+        output_data = [entry for _, entry in (delivery.result() for delivery in deliveries) if entry]
+        if batch is not None:
+            _store_result(job_id, cache_key, existing_outputs, output_data, errors)
+        yield {"type": "result", "output": _build_response(output_data, errors, response_format)}
+        return
+
+    if not await async_check_server(f"http://{COMFY_HOST}/", COMFY_API_AVAILABLE_MAX_RETRIES, COMFY_API_AVAILABLE_INTERVAL_MS):
+        yield {"type": "result", "output": {"error": f"ComfyUI server ({COMFY_HOST}) not reachable after multiple retries."}}
+        return
+
+    if input_images and IMAGE_INPUT_MODE == "inline" and await asyncio.to_thread(node_class_available, INLINE_IMAGE_NODE_CLASS):
+        workflow, input_images = _inline_input_images(workflow, input_images)
+
+    stored_names = {}
+    if input_images:
+        upload_result, stored_names = await async_upload_images(input_images)
+        if upload_result["status"] == "error":
+            _release_input_images(stored_names)
+            yield {
+                "type": "result",
+                "output": {
+                    "error": "Failed to upload one or more input images",
+                    "details": upload_result["details"],
+                },
+            }
+            return
+        workflow = _rewrite_image_references(workflow, stored_names)
+
+    ws_output_prefixes = {}
+    if IMAGE_OUTPUT_MODE == "websocket" and batch is None and await asyncio.to_thread(node_class_available, WEBSOCKET_IMAGE_NODE_CLASS):
+        workflow, ws_output_prefixes = _rewrite_save_nodes_for_websocket(workflow)
+
+    prompt_id = None
+    prompt_outputs = _PromptOutputs(workflow, selection)
+    fetches = []
+    result = None
+    rerun_alone = False
+
+    try:
+        await async_ws_manager.start()
+
+        try:
+            queued_workflow = await async_queue_workflow(workflow, async_ws_manager.client_id)
+            prompt_id = queued_workflow.get("prompt_id")
+            if not prompt_id:
+                raise ValueError(f"Missing 'prompt_id' in queue response: {queued_workflow}")
+            print(f"worker-comfyui - Queued workflow with ID: {prompt_id}")
+            if batch is not None:
+                rerun_alone = _check_batch_node_errors(batch, job_id, queued_workflow)
+                if rerun_alone:
+                    prompt_outputs = _PromptOutputs(workflow, {"nodes": []})
+        except ValueError:
+            raise
+        except aiohttp.ClientError as e:
+            print(f"worker-comfyui - Error queuing workflow: {e}")
+            raise ValueError(f"Error queuing workflow: {e}")
+        except Exception as e:
+            print(f"worker-comfyui - Unexpected error queuing workflow: {e}")
+            raise ValueError(f"Unexpected error queuing workflow: {e}")
+
+        print(f"worker-comfyui - Waiting for workflow execution ({prompt_id})...")
+        events = async_ws_manager.register(prompt_id)
+
+        def start_delivery(node_id, delivery):
+            # Finished deliveries are announced on the prompt's event queue
+            task = asyncio.create_task(delivery)
+            task.add_done_callback(lambda _: events.put_nowait({"type": "delivered", "data": {"node_id": node_id, "task": task}}))
+            fetches.append(task)
+
+        execution_done = False
+        binary_frames = []
+        history = {}
+        announced = 0
+        while True:
+            try:
+                message = await asyncio.wait_for(events.get(), timeout=WEBSOCKET_EVENT_TIMEOUT_S)
+            except asyncio.TimeoutError:
+                if not async_ws_manager.reader_alive:
+                    raise websocket.WebSocketConnectionClosedException("Websocket reader stopped while waiting for the workflow")
+                print(f"worker-comfyui - Websocket receive timed out. Still waiting...")
+                continue
+
+            if message.get("type") == "delivered":
+                announced += 1
+                task = message["data"]["task"]
+                if not task.cancelled() and task.exception() is None and task.result():
+                    yield {"type": "image", "node_id": message["data"]["node_id"], "image": task.result()}
+                continue
+
+            if message.get("type") == "binary":
+                binary_frames.append(message["data"])
+                continue
+
+            stream_event = _stream_event(message)
+            if stream_event:
+                yield stream_event
+
+            finished_output = prompt_outputs.add_event(message)
+            if finished_output:
+                for image_info in prompt_outputs.new_images(finished_output, errors, exclude=ws_output_prefixes):
+                    start_delivery(image_info["node_id"], _async_fetch_and_deliver(job_id, image_info, errors, upload_urls, budget, encoding, dedup))
+
+            outcome = _prompt_event_outcome(message, prompt_id, errors)
+            if outcome == "reconnected":
+                if ws_output_prefixes:
+                    errors.append("Websocket reconnected during execution, images sent in the meantime are missing.")
+                history = await async_get_history(prompt_id)
+                if prompt_id in history:
+                    print(f"worker-comfyui - Prompt {prompt_id} finished while the websocket was reconnecting")
+                    outcome = "done"
+            if outcome == "done":
+                execution_done = True
+                break
+            if outcome == "error":
+                if batch is not None and _failed_in_other_job(batch, job_id, message):
+                    rerun_alone = True
+                break
+
+        if not execution_done and not errors:
+            raise ValueError("Workflow monitoring loop exited without confirmation of completion or error.")
+
+        if rerun_alone:
+            # Nothing of this run is handed out, the job runs again on its own
+            for fetch in fetches:
+                fetch.cancel()
+            fetches = []
+        elif ws_output_prefixes:
+            for image_info, image_bytes in prompt_outputs.websocket_images(binary_frames, ws_output_prefixes):
+                start_delivery(
+                    image_info["node_id"],
+                    asyncio.to_thread(_deliver_image_bytes, job_id, image_info, image_bytes, errors, upload_urls, budget, encoding, dedup),
+                )
+        elif prompt_outputs.needs_history():
+            if prompt_id not in history:
+                print(f"worker-comfyui - Fetching history for prompt {prompt_id}...")
+                history = await async_get_history(prompt_id)
+
+            if prompt_id not in history:
+                result = _missing_history_response(prompt_id, errors)
+            else:
+                outputs = prompt_outputs.merge_history(_history_outputs(history, prompt_id, errors))
+                for image_info in prompt_outputs.new_images(outputs, errors):
+                    start_delivery(image_info["node_id"], _async_fetch_and_deliver(job_id, image_info, errors, upload_urls, budget, encoding, dedup))
+        elif not prompt_outputs.outputs:
+            _no_outputs_warning(prompt_id, errors)
+
+        if batch is not None and execution_done:
+            # The other jobs of the batch need the outputs of all nodes
+            if not prompt_outputs.all_outputs_known():
+                if prompt_id not in history:
+                    history = await async_get_history(prompt_id)
+                prompt_outputs.merge_history(_history_outputs(history, prompt_id, []))
+            batch_scheduler.finish(batch, dict(prompt_outputs.outputs))
+
+        # Yield the remaining images as their deliveries finish
+        if result is None:
+            while announced < len(fetches):
+                message = await events.get()
+                if message.get("type") != "delivered":
+                    continue
+                announced += 1
+                task = message["data"]["task"]
+                if not task.cancelled() and task.exception() is None and task.result():
+                    yield {"type": "image", "node_id": message["data"]["node_id"], "image": task.result()}
+
+            delivered = [entry for entry in (task.result() for task in fetches) if entry]
+            result = _build_response(delivered, errors, response_format)
+            if not rerun_alone:
+                _store_result(job_id, cache_key, prompt_outputs.handed_out, delivered, errors)
+
+    except websocket.WebSocketException as e:
+        print(f"worker-comfyui - WebSocket Error: {e}")
+        print(traceback.format_exc())
+        result = {"error": f"WebSocket communication error: {e}"}
+    except aiohttp.ClientError as e:
+        print(f"worker-comfyui - HTTP Request Error: {e}")
+        print(traceback.format_exc())
+        result = {"error": f"HTTP communication error with ComfyUI: {e}"}
+    except ValueError as e:
+        print(f"worker-comfyui - Value Error: {e}")
+        print(traceback.format_exc())
+        result = {"error": str(e)}
+    except Exception as e:
+        print(f"worker-comfyui - Unexpected Handler Error: {e}")
+        print(traceback.format_exc())
+        result = {"error": f"An unexpected error occurred: {e}"}
+    finally:
+        for fetch in fetches:
+            fetch.cancel()
+        if prompt_id:
+            async_ws_manager.unregister(prompt_id)
+        _release_input_images(stored_names)
+        if rerun_alone:
+            batch_scheduler.finish(batch, None)
+
+    if rerun_alone:
+        async for event in _async_run_job(job, batching=False):
+            yield event
+        return
+    yield {"type": "result", "output": result}
+
+async def async_handler(job):
+    """
+    Async variant of handler() with the same input and output format.
+    Uploads and output fetches run concurrently.
+    """
+    result = None
+    async for event in _async_job_events(job):
+        if event["type"] == "result":
+            result = event["output"]
+    return result
+
+async def stream_handler(job):
+    """
+    Streaming variant of async_handler() for RunPod generator handlers.
+    Yields progress events and every output image (base64 or S3 URL) as soon
+    as it is delivered, then a `result` event with the job status and errors.
+    """
+    async for event in _async_job_events(job):
+        if event["type"] == "result":
+            # The images were already streamed, don't send them again
+            output = {key: value for key, value in event["output"].items() if key not in ("message", "images")}
+            yield {"type": "result", **output}
+        else:
+            yield event
+
+# ---------------------------------------------------------------------------
+# Concurrent job intake
+# ---------------------------------------------------------------------------
+
+_concurrency_state = {"last_change": 0.0}
+
+def concurrency_modifier(current_concurrency):
+    """
+    Called by the RunPod job scaler to decide how many jobs this worker holds at once.
+
+    Uses the lowest `queue_remaining` ComfyUI reported since the last
+    adjustment. If it fell below COMFY_TARGET_QUEUE_DEPTH, the GPU ran out of
+    queued work while jobs were still being prepared or delivered, so one more
+    job is accepted. If it never dropped to the target, jobs are waiting in
+    this worker that another worker could run, so one fewer is accepted.
+    Changes are rate limited because RunPod waits for all in-flight jobs to
+    finish before it applies a new value.
+    """
+    now = time.monotonic()
+    if now - _concurrency_state["last_change"] < COMFY_CONCURRENCY_ADJUST_INTERVAL_S:
+        return current_concurrency
+
+    manager = async_ws_manager if COMFY_ASYNC_HANDLER or COMFY_STREAM_OUTPUTS else ws_manager
+    low_water = manager.take_queue_low_water()
+    target = current_concurrency
+    if low_water is not None:
+        if low_water < COMFY_TARGET_QUEUE_DEPTH:
+            target += 1
+        elif low_water > COMFY_TARGET_QUEUE_DEPTH:
+            target -= 1
+    target = max(COMFY_MIN_CONCURRENCY, min(COMFY_MAX_CONCURRENCY, target))
+    _concurrency_state["current"] = target
+
+    if target != current_concurrency:
+        print(f"worker-comfyui - Adjusting concurrency {current_concurrency} -> {target} (lowest queue_remaining: {low_water})")
+        _concurrency_state["last_change"] = now
+    return target
+
+async def threaded_handler(job):
+    """
+    Run the blocking handler() in a worker thread so RunPod can process
+    several jobs at once without an async pipeline.
+    """
+    return await asyncio.to_thread(handler, job)
+
+def _serverless_config():
+    """
+    Build the runpod.serverless.start() configuration from the environment.
+    """
+    if COMFY_STREAM_OUTPUTS:
+        job_handler = stream_handler
+    elif COMFY_ASYNC_HANDLER:
+        job_handler = async_handler
+    elif COMFY_MAX_CONCURRENCY > 1:
+        job_handler = threaded_handler
+    else:
+        job_handler = handler
+
+    config = {"handler": job_handler}
+    if COMFY_STREAM_OUTPUTS:
+        # /run and /runsync return the list of all streamed events
+        config["return_aggregate_stream"] = True
+    if COMFY_MAX_CONCURRENCY > 1:
+        config["concurrency_modifier"] = concurrency_modifier
+    return config
 
 if __name__ == "__main__":
     print("worker-comfyui - Starting handler...")
-    runpod.serverless.start({"handler": handler}) 
\ No newline at end of file
+    runpod.serverless.start(_serverless_config()) 
\ No newline at end of file
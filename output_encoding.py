@@ -0,0 +1,50 @@
+"""
+Transcoding of output images for `input.output_encoding`.
+
+Kept out of handler.py because it runs in the encode process pool: spawned
+workers import this module, and importing handler.py would repeat its
+startup work (cache scans and evictions, websocket and thread pools,
+template loading) in every worker process.
+"""
+
+from io import BytesIO
+
+try:
+    from PIL import Image
+except ImportError:  # Only needed to transcode outputs (input.output_encoding)
+    Image = None
+
+# Formats outputs can be transcoded to with `input.output_encoding`: Pillow format and file extension
+OUTPUT_ENCODING_FORMATS = {"webp": ("WEBP", ".webp"), "avif": ("AVIF", ".avif"), "jpeg": ("JPEG", ".jpg"), "png": ("PNG", ".png")}
+
+def _save_image(image, image_format, quality):
+    """
+    Encode a Pillow image in the given output encoding format.
+    """
+    pil_format = OUTPUT_ENCODING_FORMATS[image_format][0]
+    if pil_format == "JPEG" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    elif image.mode not in ("RGB", "RGBA", "L"):
+        image = image.convert("RGBA" if image.has_transparency_data else "RGB")
+    buffer = BytesIO()
+    image.save(buffer, format=pil_format, quality=quality)
+    return buffer.getvalue()
+
+def transcode_image(image_bytes, encoding):
+    """
+    Transcode an image as described by a validated `input.output_encoding`.
+    Runs in the encode process pool. Returns (image bytes, thumbnail bytes or None).
+    """
+    with Image.open(BytesIO(image_bytes)) as image:
+        image.load()
+        max_dimension = encoding.get("max_dimension")
+        if max_dimension and max(image.size) > max_dimension:
+            image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        data = _save_image(image, encoding["format"], encoding["quality"])
+
+        thumbnail = None
+        if encoding.get("thumbnail"):
+            preview = image.copy()
+            preview.thumbnail((encoding["thumbnail"], encoding["thumbnail"]), Image.LANCZOS)
+            thumbnail = _save_image(preview, encoding["format"], encoding["quality"])
+    return data, thumbnail
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+Benchmark micro-batching (BATCH_WINDOW_MS) against back-to-back prompts.
+
+Unlike the other benchmarks this one needs a running ComfyUI with the
+models of the workflow (COMFY_HOST, default 127.0.0.1:8188), since what it
+measures is GPU time. It runs `--jobs` copies of the workflow at once
+through `handler.handler()`, each with its own seed (and, with
+`--vary-prompt`, its own prompt text), twice per round:
+
+- back-to-back: batching off, ComfyUI gets one prompt per job. Its executor
+  cache already reuses the loader and text encoder nodes between them.
+- merged: batching on, the jobs run as one merged prompt.
+
+Seeds change every round so no sampler result is reused from the cache.
+A warm-up job loads the models first.
+
+Usage:
+    python scripts/bench_batching.py [--workflow test_resources/workflows/workflow_sdxl_turbo.json] [--jobs 4] [--rounds 3] [--window-ms 200] [--vary-prompt]
+"""
+
+import argparse
+import copy
+import json
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+import handler  # noqa: E402
+
+DEFAULT_WORKFLOW = os.path.join(os.path.dirname(__file__), "..", "test_resources", "workflows", "workflow_sdxl_turbo.json")
+
+
+def make_jobs(workflow, count, vary_prompt, label):
+    jobs = []
+    for index in range(count):
+        job_workflow = copy.deepcopy(workflow)
+        for node in job_workflow.values():
+            inputs = node.get("inputs") or {}
+            for name in ("seed", "noise_seed"):
+                if isinstance(inputs.get(name), int):
+                    inputs[name] = random.randrange(2**32)
+            if vary_prompt and isinstance(inputs.get("text"), str) and inputs["text"]:
+                inputs["text"] = f"{inputs['text']}, variation {index}"
+        # Skip the result cache and job coalescing, every job runs its workflow
+        jobs.append({"id": f"{label}-{index}", "input": {"workflow": job_workflow, "cache": False}})
+    return jobs
+
+
+def run(jobs, scheduler):
+    handler.batch_scheduler = scheduler
+    start = time.perf_counter()
+    with ThreadPoolExecutor(len(jobs)) as pool:
+        results = list(pool.map(handler.handler, jobs))
+    elapsed = time.perf_counter() - start
+    for result in results:
+        assert "error" not in result, result
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workflow", default=DEFAULT_WORKFLOW)
+    parser.add_argument("--jobs", type=int, default=4)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--window-ms", type=float, default=200, help="BATCH_WINDOW_MS of the merged runs")
+    parser.add_argument("--vary-prompt", action="store_true", help="give every job its own prompt text, not only its own seed")
+    args = parser.parse_args()
+
+    with open(args.workflow) as f:
+        workflow = json.load(f)
+    workflow = workflow.get("input", {}).get("workflow", workflow)
+
+    # The batch window only applies while the worker takes several jobs at once
+    handler.COMFY_MAX_CONCURRENCY = args.jobs
+    handler._concurrency_state["current"] = args.jobs
+    scheduler = handler.BatchScheduler(args.window_ms / 1000, args.jobs)
+
+    if not handler.check_server(f"http://{handler.COMFY_HOST}/", 5, 500):
+        sys.exit(f"ComfyUI is not reachable at {handler.COMFY_HOST}")
+
+    # Silence the per-job log lines of the handler
+    stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+    timings = {"back-to-back": [], "merged": []}
+    try:
+        run(make_jobs(workflow, 1, False, "warmup"), None)
+        for round_index in range(args.rounds):
+            modes = [("back-to-back", None), ("merged", scheduler)]
+            # Alternate the order so neither mode always runs on a warmer GPU
+            for label, mode_scheduler in modes if round_index % 2 == 0 else modes[::-1]:
+                jobs = make_jobs(workflow, args.jobs, args.vary_prompt, f"{label}-{round_index}")
+                timings[label].append(run(jobs, mode_scheduler))
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    back_to_back, merged = (sum(timings[label]) / len(timings[label]) for label in ("back-to-back", "merged"))
+    print(f"back-to-back: {back_to_back * 1000:8.1f} ms for {args.jobs} job(s)")
+    print(f"      merged: {merged * 1000:8.1f} ms for {args.jobs} job(s) ({back_to_back / merged:.2f}x, {scheduler.batched} jobs batched)")
+
+
+if __name__ == "__main__":
+    main()
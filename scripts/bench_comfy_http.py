@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""
+Benchmark the per-job HTTP overhead of talking to ComfyUI.
+
+Starts a local stand-in for the ComfyUI HTTP API that counts the TCP
+connections it accepts, then simulates jobs making the same calls as
+handler.py (probe, upload, prompt, history, view) once with bare
+`requests.get/post` and once through the pooled `handler.comfy_client`.
+
+Usage:
+    python scripts/bench_comfy_http.py [--jobs 50] [--images 4]
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+import handler  # noqa: E402
+
+IMAGE_BYTES = b"\x89PNG" + b"\0" * 64 * 1024
+
+
+class FakeComfyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # aiohttp (used by ComfyUI) sets TCP_NODELAY as well
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def _send(self, body, content_type="application/json"):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.startswith("/view"):
+            self._send(IMAGE_BYTES, "image/png")
+        elif self.path.startswith("/history/"):
+            prompt_id = self.path.rsplit("/", 1)[-1]
+            self._send(json.dumps({prompt_id: {"outputs": {}}}).encode())
+        else:
+            self._send(b"{}")
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        if self.path == "/upload/image":
+            # Simulated time ComfyUI spends writing the upload to disk
+            time.sleep(self.server.upload_delay_s)
+        if self.path == "/prompt":
+            self._send(json.dumps({"prompt_id": "bench"}).encode())
+        else:
+            self._send(b'{"name": "input.png"}')
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeComfyHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.connections = 0
+    server.upload_delay_s = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_job(get, post, base_url, images):
+    """Issue the ComfyUI calls of a single job."""
+    get(f"{base_url}/").raise_for_status()
+    for i in range(images):
+        files = {"image": (f"in_{i}.png", IMAGE_BYTES, "image/png"), "overwrite": (None, "true")}
+        post(f"{base_url}/upload/image", files=files).raise_for_status()
+    post(f"{base_url}/prompt", data=b'{"prompt": {}}').raise_for_status()
+    get(f"{base_url}/history/bench").raise_for_status()
+    for i in range(images):
+        get(f"{base_url}/view?filename=out_{i}.png&subfolder=&type=output").content
+
+
+def measure(label, server, jobs, images, get, post):
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    server.connections = 0
+    start = time.perf_counter()
+    for _ in range(jobs):
+        run_job(get, post, base_url, images)
+    elapsed = time.perf_counter() - start
+    calls = 3 + 2 * images
+    print(
+        f"{label:>8}: {elapsed / jobs * 1000:7.2f} ms/job, "
+        f"{server.connections / jobs:5.2f} connections/job ({calls} calls/job)"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--jobs", type=int, default=50)
+    parser.add_argument("--images", type=int, default=4)
+    args = parser.parse_args()
+
+    server = start_server()
+    client = handler.ComfyClient(f"127.0.0.1:{server.server_address[1]}")
+
+    measure("requests", server, args.jobs, args.images, requests.get, requests.post)
+    measure(
+        "pooled",
+        server,
+        args.jobs,
+        args.images,
+        lambda url, **kw: client.get(url, "view", **kw),
+        lambda url, **kw: client.post(url, "upload", **kw),
+    )
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
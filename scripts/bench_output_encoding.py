@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""
+Benchmark output transcoding (input.output_encoding).
+
+Transcodes one output image to each requested format with
+`handler.transcode_image()` and reports the encoded size, the base64 size
+it adds to the response and the time per image. A batch of copies is then
+transcoded through the encode process pool to show how outputs of a job
+overlap.
+
+Usage:
+    python scripts/bench_output_encoding.py [--image test_resources/images/ComfyUI_00001_.png] [--formats webp avif jpeg] [--quality 85] [--batch 8]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+import handler  # noqa: E402
+
+DEFAULT_IMAGE = os.path.join(os.path.dirname(__file__), "..", "test_resources", "images", "ComfyUI_00001_.png")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--image", default=DEFAULT_IMAGE)
+    parser.add_argument("--formats", nargs="+", default=["webp", "avif", "jpeg"], choices=list(handler.OUTPUT_ENCODING_FORMATS))
+    parser.add_argument("--quality", type=int, default=handler.OUTPUT_ENCODING_QUALITY)
+    parser.add_argument("--batch", type=int, default=8, help="images transcoded through the process pool at once")
+    args = parser.parse_args()
+
+    if handler.Image is None:
+        sys.exit("Pillow is not installed")
+    with open(args.image, "rb") as f:
+        original = f.read()
+    print(f"{'original':>8}: {len(original) / 1024:8.1f} KB")
+
+    for image_format in args.formats:
+        encoding, error = handler._validate_output_encoding({"format": image_format, "quality": args.quality})
+        if error:
+            print(f"{image_format:>8}: skipped ({error})")
+            continue
+        start = time.perf_counter()
+        data, _ = handler.transcode_image(original, encoding)
+        elapsed = time.perf_counter() - start
+        print(
+            f"{image_format:>8}: {len(data) / 1024:8.1f} KB ({len(original) / len(data):4.1f}x smaller), "
+            f"{len(handler.base64.b64encode(data)) / 1024:8.1f} KB as base64, {elapsed * 1000:7.1f} ms"
+        )
+
+    encoding, _ = handler._validate_output_encoding({"format": args.formats[0], "quality": args.quality})
+    pool = handler.get_encode_pool()
+    # Start the processes before timing
+    pool.submit(handler.transcode_image, original, encoding).result()
+    for label, run in [
+        ("serial", lambda: [handler.transcode_image(original, encoding) for _ in range(args.batch)]),
+        ("pool", lambda: [f.result() for f in [pool.submit(handler.transcode_image, original, encoding) for _ in range(args.batch)]]),
+    ]:
+        start = time.perf_counter()
+        run()
+        print(f"{label:>8}: {(time.perf_counter() - start) * 1000:7.1f} ms for {args.batch} {args.formats[0]} image(s)")
+    pool.shutdown()
+
+
+if __name__ == "__main__":
+    main()
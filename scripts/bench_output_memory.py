@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""
+Benchmark the peak memory of delivering one output file.
+
+Starts a local stand-in for ComfyUI's /view endpoint that streams an output of
+the requested size, and a sink that accepts presigned-URL style PUTs. Each
+output is then delivered twice while tracemalloc records the peak of Python
+allocations:
+
+    buffered   get_image_data() + PUT of the whole body (the previous path)
+    streaming  open_output_source() -> stream_output() -> put_presigned_url()
+
+The buffered peak grows with the output size, the streaming peak stays at a
+few chunks.
+
+Usage:
+    python scripts/bench_output_memory.py [--sizes-mb 8 32 128] [--chunk-kb 1024]
+"""
+
+import argparse
+import os
+import sys
+import threading
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+import handler  # noqa: E402
+
+# The stand-in repeats this block so the server side needs no memory per output
+BLOCK = os.urandom(1024 * 1024)
+
+
+class FakeOutputHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        size = self.server.output_size
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        sent = 0
+        while sent < size:
+            block = BLOCK[: min(len(BLOCK), size - sent)]
+            self.wfile.write(block)
+            sent += len(block)
+
+    def do_PUT(self):
+        remaining = int(self.headers["Content-Length"])
+        while remaining:
+            remaining -= len(self.rfile.read(min(remaining, 1024 * 1024)))
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeOutputHandler)
+    server.daemon_threads = True
+    server.output_size = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def buffered(put_url, chunk_size):
+    data = handler.get_image_data("out.png", "", "output")
+    handler.upload_session.put(put_url, data=data).raise_for_status()
+
+
+def streaming(put_url, chunk_size):
+    source = handler.open_output_source("out.png", "", "output", chunk_size=chunk_size)
+    handler.stream_output(source, lambda stream: handler.put_presigned_url(put_url, stream, "image/png"))
+
+
+def peak_mb(deliver, put_url, chunk_size):
+    tracemalloc.start()
+    try:
+        deliver(put_url, chunk_size)
+        return tracemalloc.get_traced_memory()[1] / 1024 / 1024
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes-mb", type=int, nargs="+", default=[8, 32, 128])
+    parser.add_argument("--chunk-kb", type=int, default=handler.OUTPUT_STREAM_CHUNK_KB)
+    args = parser.parse_args()
+
+    server = start_server()
+    host = f"127.0.0.1:{server.server_address[1]}"
+    handler.comfy_client = handler.ComfyClient(host)
+    # Always go through /view, even if an out.png exists in the local output directory
+    handler.OUTPUT_READ_LOCAL = False
+    put_url = f"http://{host}/bucket/out.png?X-Amz-Signature=bench"
+
+    # Silence the per-file log lines of the handler
+    stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+    try:
+        results = []
+        for size_mb in args.sizes_mb:
+            server.output_size = size_mb * 1024 * 1024
+            results.append((
+                size_mb,
+                peak_mb(buffered, put_url, args.chunk_kb * 1024),
+                peak_mb(streaming, put_url, args.chunk_kb * 1024),
+            ))
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    print(f"{'output':>8}  {'buffered peak':>14}  {'streaming peak':>15}")
+    for size_mb, buffered_peak, streaming_peak in results:
+        print(f"{size_mb:>5} MB  {buffered_peak:>11.1f} MB  {streaming_peak:>12.1f} MB")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""
+Benchmark serial vs. parallel input image uploads.
+
+Runs `handler.upload_images()` against the local ComfyUI stand-in from
+bench_comfy_http.py, once with a single worker (the previous serial loop)
+and once with the configured number of upload workers.
+
+Usage:
+    python scripts/bench_upload_images.py [--images 8] [--size-kb 512] [--workers 4] [--latency-ms 20]
+"""
+
+import argparse
+import base64
+import os
+import sys
+import time
+
+# Every round uploads the same images, which the input cache would answer without any upload
+os.environ["INPUT_CACHE_MAX_MB"] = "0"
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_comfy_http import handler, start_server  # noqa: E402
+
+
+def measure(images, workers, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        result = handler.upload_images(images, max_workers=workers)
+        assert result["status"] == "success", result
+    return (time.perf_counter() - start) / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=8)
+    parser.add_argument("--size-kb", type=int, default=512)
+    parser.add_argument("--workers", type=int, default=handler.COMFY_UPLOAD_WORKERS)
+    parser.add_argument("--latency-ms", type=float, default=20, help="simulated server-side time per upload")
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    server = start_server()
+    server.upload_delay_s = args.latency_ms / 1000
+    handler.comfy_client = handler.ComfyClient(f"127.0.0.1:{server.server_address[1]}")
+
+    payload = base64.b64encode(os.urandom(args.size_kb * 1024)).decode()
+    images = [{"name": f"input_{i}.png", "image": f"data:image/png;base64,{payload}"} for i in range(args.images)]
+
+    # Silence the per-image log lines of the handler
+    stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+    try:
+        serial = measure(images, 1, args.rounds)
+        parallel = measure(images, args.workers, args.rounds)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    print(f"   serial: {serial * 1000:8.2f} ms for {args.images} image(s)")
+    print(f"{args.workers:>2} workers: {parallel * 1000:8.2f} ms for {args.images} image(s) ({serial / parallel:.1f}x faster)")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
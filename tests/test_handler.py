@@ -1,13 +1,22 @@
 import unittest
-from unittest.mock import patch, MagicMock, mock_open, Mock
+from unittest.mock import patch, MagicMock, mock_open, Mock, AsyncMock
+import asyncio
 import sys
 import os
 import json
 import base64
+import threading
+import tempfile
+import mmap
+import struct
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
-# Make sure that "src" is known and can be used to import handler.py
-sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
-from src import handler
+# Make sure that the repository root is known and can be used to import handler.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+import handler
 
 # Local folder for test resources
 RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES = "./test_resources/images"
@@ -64,7 +73,7 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         self.assertIsNotNone(error)
         self.assertEqual(error, "Please provide input")
 
-    @patch("handler.requests.get")
+    @patch("handler.comfy_client.get")
     def test_check_server_server_up(self, mock_requests):
         mock_response = MagicMock()
         mock_response.status_code = 200
@@ -73,9 +82,9 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         result = handler.check_server("http://127.0.0.1:8188", 1, 50)
         self.assertTrue(result)
 
-    @patch("handler.requests.get")
+    @patch("handler.comfy_client.get")
     def test_check_server_server_down(self, mock_requests):
-        mock_requests.get.side_effect = handler.requests.RequestException()
+        mock_requests.side_effect = handler.requests.RequestException()
         result = handler.check_server("http://127.0.0.1:8188", 1, 50)
         self.assertFalse(result)
 
@@ -205,7 +214,7 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         self.assertIn("simulated_uploaded", result["message"])
         self.assertEqual(result["status"], "success")
 
-    @patch("handler.requests.post")
+    @patch("handler.comfy_client.post")
     def test_upload_images_successful(self, mock_post):
         mock_response = unittest.mock.Mock()
         mock_response.status_code = 200
@@ -221,7 +230,7 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         self.assertEqual(len(responses), 3)
         self.assertEqual(responses["status"], "success")
 
-    @patch("handler.requests.post")
+    @patch("handler.comfy_client.post")
     def test_upload_images_failed(self, mock_post):
         mock_response = unittest.mock.Mock()
         mock_response.status_code = 400
@@ -236,3 +245,1691 @@ class TestRunpodWorkerComfy(unittest.TestCase):
 
         self.assertEqual(len(responses), 3)
         self.assertEqual(responses["status"], "error")
+
+
+class TestComfyClient(unittest.TestCase):
+    def _response(self, status_code):
+        response = MagicMock()
+        response.status_code = status_code
+        return response
+
+    def test_endpoint_timeout_is_applied(self):
+        client = handler.ComfyClient("127.0.0.1:8188")
+        with patch.object(handler.requests.Session, "request") as mock_request:
+            mock_request.return_value = self._response(200)
+            client.get("/history/123", "history")
+
+        mock_request.assert_called_once_with(
+            "GET", "http://127.0.0.1:8188/history/123", timeout=30
+        )
+
+    def test_idempotent_call_is_retried_on_connection_error(self):
+        client = handler.ComfyClient("127.0.0.1:8188", retries=2, backoff_s=0)
+        with patch.object(handler.requests.Session, "request") as mock_request:
+            mock_request.side_effect = [
+                handler.requests.ConnectionError("reset"),
+                self._response(503),
+                self._response(200),
+            ]
+            response = client.get("/view?filename=a.png", "view")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(mock_request.call_count, 3)
+
+    def test_prompt_is_never_retried(self):
+        client = handler.ComfyClient("127.0.0.1:8188", retries=2, backoff_s=0)
+        with patch.object(handler.requests.Session, "request") as mock_request:
+            mock_request.side_effect = handler.requests.ConnectionError("reset")
+            with self.assertRaises(handler.requests.ConnectionError):
+                client.post("/prompt", "prompt", data=b"{}")
+
+        self.assertEqual(mock_request.call_count, 1)
+
+    def test_threads_share_one_connection_pool(self):
+        import threading
+
+        client = handler.ComfyClient("127.0.0.1:8188")
+        sessions = []
+        thread = threading.Thread(target=lambda: sessions.append(client.session))
+        thread.start()
+        thread.join()
+        sessions.append(client.session)
+
+        self.assertIsNot(sessions[0], sessions[1])
+        self.assertIs(
+            sessions[0].get_adapter("http://127.0.0.1:8188"),
+            sessions[1].get_adapter("http://127.0.0.1:8188"),
+        )
+
+
+class TestComfyWebsocketManager(unittest.TestCase):
+    def test_events_are_routed_by_prompt_id(self):
+        manager = handler.ComfyWebsocketManager("127.0.0.1:8188")
+        first = manager.register("p1")
+        second = manager.register("p2")
+
+        manager._dispatch({"type": "executing", "data": {"node": "9", "prompt_id": "p2"}})
+        manager._dispatch({"type": "executing", "data": {"node": None, "prompt_id": "p1"}})
+
+        self.assertEqual(first.get_nowait()["data"], {"node": None, "prompt_id": "p1"})
+        self.assertEqual(second.get_nowait()["data"]["node"], "9")
+        self.assertTrue(first.empty())
+
+    def test_early_events_are_replayed_on_register(self):
+        manager = handler.ComfyWebsocketManager("127.0.0.1:8188")
+        manager._dispatch({"type": "execution_start", "data": {"prompt_id": "p1"}})
+        manager._dispatch({"type": "executing", "data": {"node": None, "prompt_id": "p1"}})
+
+        events = manager.register("p1")
+
+        self.assertEqual(events.get_nowait()["type"], "execution_start")
+        self.assertEqual(events.get_nowait()["type"], "executing")
+
+    def test_pending_buffer_is_bounded(self):
+        manager = handler.ComfyWebsocketManager("127.0.0.1:8188")
+        for i in range(handler.WEBSOCKET_PENDING_PROMPTS + 5):
+            manager._dispatch({"type": "executing", "data": {"prompt_id": f"p{i}"}})
+
+        self.assertEqual(len(manager._pending), handler.WEBSOCKET_PENDING_PROMPTS)
+        self.assertNotIn("p0", manager._pending)
+
+    def test_reader_failure_is_reported_to_waiters(self):
+        manager = handler.ComfyWebsocketManager("127.0.0.1:8188")
+        events = manager.register("p1")
+        manager._ws = MagicMock()
+        manager._ws.recv.side_effect = handler.websocket.WebSocketProtocolException("bad frame")
+
+        manager._read_loop()
+
+        self.assertEqual(events.get_nowait()["type"], "connection_lost")
+        self.assertIsNone(manager._ws)
+        self.assertFalse(manager.reader_alive)
+
+    def test_status_updates_queue_remaining(self):
+        manager = handler.ComfyWebsocketManager("127.0.0.1:8188")
+        manager._dispatch(
+            {"type": "status", "data": {"status": {"exec_info": {"queue_remaining": 3}}}}
+        )
+        self.assertEqual(manager.queue_remaining, 3)
+
+
+class TestHandler(unittest.TestCase):
+    """End-to-end runs of handler() with ComfyUI replaced by mocks."""
+
+    def setUp(self):
+        self.manager = handler.ComfyWebsocketManager("127.0.0.1:8188")
+        patches = [
+            patch("handler.ws_manager", self.manager),
+            patch.object(self.manager, "start"),
+            patch("handler.check_server", return_value=True),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def _queue_and_finish(self, events):
+        def queue_workflow(workflow, client_id):
+            self.assertEqual(client_id, self.manager.client_id)
+            for event in events:
+                self.manager._dispatch(event)
+            return {"prompt_id": "p1"}
+
+        return patch("handler.queue_workflow", side_effect=queue_workflow)
+
+    def test_handler_returns_first_image(self):
+        executed = {
+            "type": "executed",
+            "data": {
+                "node": "9",
+                "output": {"images": [{"filename": "a.png", "subfolder": "", "type": "output"}]},
+                "prompt_id": "p1",
+            },
+        }
+        finished = {"type": "executing", "data": {"node": None, "prompt_id": "p1"}}
+        with self._queue_and_finish([executed, finished]), patch(
+            "handler.get_history"
+        ) as mock_history, patch("handler.get_image_data", return_value=b"png") as mock_fetch:
+            result = handler.handler({"id": "job", "input": {"workflow": {}}})
+
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(result["message"], base64.b64encode(b"png").decode())
+        self.assertNotIn("p1", self.manager._waiters)
+        mock_fetch.assert_called_once_with("a.png", "", "output")
+        # Outputs came with the events, so the history is not needed
+        mock_history.assert_not_called()
+
+    def test_images_response_format_returns_all_images(self):
+        images = [{"filename": f"{i}.png", "subfolder": "", "type": "output"} for i in range(4)]
+        executed = {"type": "executed", "data": {"node": "9", "output": {"images": images}, "prompt_id": "p1"}}
+        finished = {"type": "executing", "data": {"node": None, "prompt_id": "p1"}}
+        # All fetches must be in flight at the same time to pass the barrier
+        barrier = threading.Barrier(len(images), timeout=5)
+
+        def get_image_data(filename, subfolder, image_type):
+            barrier.wait()
+            return filename.encode()
+
+        with self._queue_and_finish([executed, finished]), patch(
+            "handler.output_pool", handler.ThreadPoolExecutor(max_workers=len(images))
+        ), patch("handler.get_image_data", side_effect=get_image_data):
+            result = handler.handler({"id": "job", "input": {"workflow": {}, "response_format": "images"}})
+
+        self.assertEqual(result["status"], "success")
+        self.assertEqual([image["filename"] for image in result["images"]], ["0.png", "1.png", "2.png", "3.png"])
+        self.assertEqual(result["images"][2], {"filename": "2.png", "type": "base64", "data": base64.b64encode(b"2.png").decode()})
+        self.assertNotIn("errors", result)
+
+    def test_invalid_response_format(self):
+        result = handler.handler({"id": "job", "input": {"workflow": {}, "response_format": "zip"}})
+        self.assertEqual(result, {"error": "'response_format' must be one of: legacy, images"})
+
+    def test_history_fallback_after_reconnect(self):
+        workflow = {
+            "8": {"class_type": "VAEDecode", "inputs": {}},
+            "9": {"class_type": "SaveImage", "inputs": {"images": ["8", 0]}},
+            "40": {"class_type": "SaveImage", "inputs": {"images": ["8", 0]}},
+        }
+        image_a = {"filename": "a.png", "subfolder": "", "type": "output"}
+        image_b = {"filename": "b.png", "subfolder": "", "type": "output"}
+        executed = {"type": "executed", "data": {"node": "9", "output": {"images": [image_a]}, "prompt_id": "p1"}}
+        register = self.manager.register
+
+        def register_and_reconnect(prompt_id):
+            events = register(prompt_id)
+            # Connection events are broadcast to the registered prompts only
+            self.manager._broadcast({"type": "reconnected"})
+            return events
+
+        history = {"p1": {"outputs": {"9": {"images": [image_a]}, "40": {"images": [image_b]}}}}
+        with self._queue_and_finish([executed]), patch.object(
+            self.manager, "register", side_effect=register_and_reconnect
+        ), patch(
+            "handler.get_history", return_value=history
+        ) as mock_history, patch("handler.get_image_data", return_value=b"png") as mock_fetch:
+            result = handler.handler({"id": "job", "input": {"workflow": workflow}})
+
+        self.assertEqual(result["status"], "success")
+        # The history told that the prompt finished during the gap and is reused
+        mock_history.assert_called_once_with("p1")
+        self.assertEqual(sorted(c.args[0] for c in mock_fetch.call_args_list), ["a.png", "b.png"])
+
+    def test_history_fallback_for_cached_output_nodes(self):
+        workflow = {
+            "8": {"class_type": "VAEDecode", "inputs": {}},
+            "9": {"class_type": "SaveImage", "inputs": {"images": ["8", 0]}},
+        }
+        history = {"p1": {"outputs": {"9": {"images": [{"filename": "a.png", "subfolder": "", "type": "output"}]}}}}
+        events = [
+            {"type": "execution_cached", "data": {"nodes": ["8", "9"], "prompt_id": "p1"}},
+            {"type": "executing", "data": {"node": None, "prompt_id": "p1"}},
+        ]
+        with self._queue_and_finish(events), patch(
+            "handler.get_history", return_value=history
+        ), patch("handler.get_image_data", return_value=b"png"):
+            result = handler.handler({"id": "job", "input": {"workflow": workflow}})
+
+        self.assertEqual(result["message"], base64.b64encode(b"png").decode())
+
+    def test_handler_reports_execution_error(self):
+        error = {
+            "type": "execution_error",
+            "data": {"prompt_id": "p1", "node_id": "3", "node_type": "KSampler", "exception_message": "boom"},
+        }
+        with self._queue_and_finish([error]), patch(
+            "handler.get_history", return_value={"p1": {"outputs": {}}}
+        ):
+            result = handler.handler({"id": "job", "input": {"workflow": {}}})
+
+        self.assertEqual(result["error"], "Job processing failed")
+        self.assertIn("boom", result["details"][0])
+
+
+class TestAsyncHandler(unittest.TestCase):
+    """Runs of async_handler() with the aiohttp transport replaced by mocks."""
+
+    def setUp(self):
+        self.manager = handler.AsyncComfyWebsocketManager("127.0.0.1:8188")
+        patches = [
+            patch("handler.input_cache", None),
+            patch("handler.async_ws_manager", self.manager),
+            patch.object(self.manager, "start", new_callable=AsyncMock),
+            patch("handler.async_check_server", new_callable=AsyncMock, return_value=True),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_async_handler_returns_first_image(self):
+        outputs = {
+            "9": {"images": [{"filename": "a.png", "subfolder": "", "type": "output"}]},
+            "40": {"images": [{"filename": "b.png", "subfolder": "", "type": "output"}]},
+        }
+
+        async def queue_workflow(workflow, client_id):
+            for node_id, output in outputs.items():
+                self.manager._dispatch({"type": "executed", "data": {"node": node_id, "output": output, "prompt_id": "p1"}})
+            self.manager._dispatch({"type": "executing", "data": {"node": None, "prompt_id": "p1"}})
+            return {"prompt_id": "p1"}
+
+        with patch("handler.async_queue_workflow", side_effect=queue_workflow), patch(
+            "handler.async_get_history", new_callable=AsyncMock
+        ) as mock_history, patch(
+            "handler.async_get_image_data", new_callable=AsyncMock, return_value=b"png"
+        ) as mock_fetch:
+            result = asyncio.run(handler.async_handler({"id": "job", "input": {"workflow": {}}}))
+
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(result["message"], base64.b64encode(b"png").decode())
+        self.assertEqual(mock_fetch.await_count, 2)
+        mock_history.assert_not_awaited()
+
+    def test_stream_handler_yields_progress_and_images(self):
+        async def queue_workflow(workflow, client_id):
+            self.manager._dispatch({"type": "executing", "data": {"node": "3", "prompt_id": "p1"}})
+            self.manager._dispatch({"type": "progress", "data": {"node": "3", "value": 1, "max": 20, "prompt_id": "p1"}})
+            self.manager._dispatch({
+                "type": "executed",
+                "data": {"node": "9", "output": {"images": [{"filename": "a.png", "subfolder": "", "type": "output"}]}, "prompt_id": "p1"},
+            })
+            self.manager._dispatch({"type": "executing", "data": {"node": None, "prompt_id": "p1"}})
+            return {"prompt_id": "p1"}
+
+        async def collect():
+            return [event async for event in handler.stream_handler({"id": "job", "input": {"workflow": {}}})]
+
+        with patch("handler.async_queue_workflow", side_effect=queue_workflow), patch(
+            "handler.async_get_image_data", new_callable=AsyncMock, return_value=b"png"
+        ):
+            events = asyncio.run(collect())
+
+        self.assertEqual([event["type"] for event in events], ["executing", "progress", "image", "result"])
+        self.assertEqual(events[1], {"type": "progress", "node": "3", "value": 1, "max": 20})
+        self.assertEqual(events[2]["node_id"], "9")
+        self.assertEqual(events[2]["image"], {"filename": "a.png", "type": "base64", "data": base64.b64encode(b"png").decode()})
+        # The image is not repeated in the final event
+        self.assertEqual(events[3], {"type": "result", "status": "success", "refresh_worker": False})
+
+    def test_async_upload_images_runs_concurrently(self):
+        in_flight = []
+        peak = []
+
+        async def post(path, endpoint, files=None, **kwargs):
+            in_flight.append(files["image"][0])
+            peak.append(len(in_flight))
+            await asyncio.sleep(0.01)
+            in_flight.pop()
+            response = MagicMock()
+            response.raise_for_status.return_value = None
+            return response
+
+        image = base64.b64encode(b"Test Image Data").decode("utf-8")
+        images = [{"name": f"image{i}.png", "image": image} for i in range(4)]
+        decode = handler._decoded_input_image
+        decoded_in = []
+
+        def decoded_input_image(image):
+            decoded_in.append(threading.current_thread())
+            return decode(image)
+
+        with patch("handler.async_comfy_client.post", side_effect=post), patch("handler._decoded_input_image", side_effect=decoded_input_image):
+            result, _ = asyncio.run(handler.async_upload_images(images))
+
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(max(peak), 4)
+        # Images are decoded off the event loop
+        self.assertNotIn(threading.main_thread(), decoded_in)
+
+    def test_async_upload_images_reports_decode_errors(self):
+        images = [{"name": "broken.png", "image": "not-base64!"}]
+        result, stored_names = asyncio.run(handler.async_upload_images(images))
+
+        self.assertEqual(result["status"], "error")
+        self.assertIn("Error decoding base64 for broken.png", result["details"][0])
+        self.assertEqual(stored_names, {})
+
+
+class TestAsyncComfyWebsocketManager(unittest.TestCase):
+    def test_concurrent_starts_open_one_socket(self):
+        manager = handler.AsyncComfyWebsocketManager("127.0.0.1:8188")
+        sockets = []
+
+        async def connect():
+            await asyncio.sleep(0.01)
+            ws = MagicMock(closed=False)
+            # Nothing arrives, the reader keeps waiting
+            ws.receive = asyncio.Event().wait
+            sockets.append(ws)
+            return ws
+
+        async def start_three():
+            await asyncio.gather(*(manager.start() for _ in range(3)))
+            manager._task.cancel()
+
+        with patch.object(manager, "_connect", side_effect=connect):
+            asyncio.run(start_three())
+
+        self.assertEqual(len(sockets), 1)
+
+    def test_reader_failure_is_reported_to_waiters(self):
+        manager = handler.AsyncComfyWebsocketManager("127.0.0.1:8188")
+
+        async def run():
+            events = manager.register("p1")
+            manager._ws = MagicMock(close=AsyncMock())
+            manager._ws.receive = AsyncMock(side_effect=RuntimeError("Concurrent call to receive() is not allowed"))
+            await manager._read_loop()
+            return events.get_nowait()
+
+        self.assertEqual(asyncio.run(run())["type"], "connection_lost")
+        self.assertIsNone(manager._ws)
+
+
+class TestConcurrencyModifier(unittest.TestCase):
+    def setUp(self):
+        self.manager = handler.ComfyWebsocketManager("127.0.0.1:8188")
+        patches = [
+            patch("handler.ws_manager", self.manager),
+            patch("handler.COMFY_ASYNC_HANDLER", False),
+            patch("handler.COMFY_MIN_CONCURRENCY", 1),
+            patch("handler.COMFY_MAX_CONCURRENCY", 4),
+            patch("handler.COMFY_TARGET_QUEUE_DEPTH", 2),
+            patch("handler.COMFY_CONCURRENCY_ADJUST_INTERVAL_S", 0),
+            patch.dict(handler._concurrency_state, {"last_change": 0.0}),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def _status(self, queue_remaining):
+        self.manager._dispatch(
+            {"type": "status", "data": {"status": {"exec_info": {"queue_remaining": queue_remaining}}}}
+        )
+
+    def test_unknown_queue_keeps_concurrency(self):
+        self.assertEqual(handler.concurrency_modifier(2), 2)
+
+    def test_drained_queue_grows_concurrency(self):
+        self._status(2)
+        self._status(0)
+        self._status(2)
+        self.assertEqual(handler.concurrency_modifier(2), 3)
+
+    def test_deep_queue_shrinks_concurrency(self):
+        self._status(3)
+        self._status(4)
+        self.assertEqual(handler.concurrency_modifier(3), 2)
+
+    def test_concurrency_stays_within_bounds(self):
+        self._status(0)
+        self.assertEqual(handler.concurrency_modifier(4), 4)
+        self._status(9)
+        self._status(9)
+        handler.concurrency_modifier(4)
+        self.assertEqual(handler.concurrency_modifier(1), 1)
+
+    def test_changes_are_rate_limited(self):
+        self._status(0)
+        with patch("handler.COMFY_CONCURRENCY_ADJUST_INTERVAL_S", 3600):
+            handler._concurrency_state["last_change"] = handler.time.monotonic()
+            self.assertEqual(handler.concurrency_modifier(2), 2)
+
+    def test_serverless_config_uses_threads_for_concurrent_sync_handler(self):
+        config = handler._serverless_config()
+        self.assertIs(config["handler"], handler.threaded_handler)
+        self.assertIs(config["concurrency_modifier"], handler.concurrency_modifier)
+
+    @patch("handler.COMFY_STREAM_OUTPUTS", True)
+    def test_serverless_config_for_streaming(self):
+        config = handler._serverless_config()
+        self.assertIs(config["handler"], handler.stream_handler)
+        self.assertTrue(config["return_aggregate_stream"])
+
+
+class TestParallelUpload(unittest.TestCase):
+    def setUp(self):
+        patcher = patch("handler.input_cache", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_uploads_are_bounded_and_details_keep_input_order(self):
+        import threading
+
+        lock = threading.Lock()
+        in_flight = []
+        peak = []
+
+        def post(path, endpoint, files=None, **kwargs):
+            with lock:
+                in_flight.append(files["image"][0])
+                peak.append(len(in_flight))
+            handler.time.sleep(0.02)
+            with lock:
+                in_flight.remove(files["image"][0])
+            response = MagicMock()
+            if files["image"][0] == "image2.png":
+                response.raise_for_status.side_effect = handler.requests.HTTPError("500 Server Error")
+            return response
+
+        image = base64.b64encode(b"Test Image Data").decode("utf-8")
+        images = [{"name": f"image{i}.png", "image": image} for i in range(6)]
+        images[4]["image"] = "not-base64!"
+        with patch("handler.comfy_client.post", side_effect=post):
+            result = handler.upload_images(images, max_workers=3)
+
+        self.assertEqual(result["status"], "error")
+        self.assertEqual(len(result["details"]), 2)
+        self.assertTrue(result["details"][0].startswith("Error uploading image2.png"))
+        self.assertTrue(result["details"][1].startswith("Error decoding base64 for image4.png"))
+        self.assertLessEqual(max(peak), 3)
+        self.assertGreater(max(peak), 1)
+
+    @patch("handler.comfy_client.post")
+    def test_success_details_keep_input_order(self, mock_post):
+        image = base64.b64encode(b"Test Image Data").decode("utf-8")
+        images = [{"name": f"image{i}.png", "image": image} for i in range(5)]
+
+        result = handler.upload_images(images)
+
+        self.assertEqual(
+            result["details"], [f"Successfully uploaded image{i}.png" for i in range(5)]
+        )
+
+
+class TestInputImageCache(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.input_dir = self.tmp.name
+
+    def _put(self, cache, data):
+        stored_name = cache.stored_name("face.png", data)
+        with open(os.path.join(self.input_dir, stored_name), "wb") as f:
+            f.write(data)
+        cache.add(stored_name, len(data))
+        return stored_name
+
+    def test_stored_name_is_content_addressed(self):
+        name = handler.InputImageCache.stored_name("Face.PNG", b"abc")
+        self.assertEqual(name, "ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad.png")
+
+    def test_lru_eviction_by_total_bytes_skips_pinned_images(self):
+        cache = handler.InputImageCache(self.input_dir, max_bytes=20)
+        first = self._put(cache, b"a" * 10)
+        second = self._put(cache, b"b" * 10)
+        cache.release([second])
+        # `first` is still pinned by its job, so the unpinned `second` is evicted
+        third = self._put(cache, b"c" * 10)
+
+        self.assertTrue(os.path.exists(os.path.join(self.input_dir, first)))
+        self.assertFalse(os.path.exists(os.path.join(self.input_dir, second)))
+        self.assertTrue(cache.acquire(third))
+        self.assertFalse(cache.acquire(second))
+
+    def test_existing_images_are_indexed_on_startup(self):
+        stored_name = handler.InputImageCache.stored_name("x.png", b"data")
+        with open(os.path.join(self.input_dir, stored_name), "wb") as f:
+            f.write(b"data")
+        with open(os.path.join(self.input_dir, "user_upload.png"), "wb") as f:
+            f.write(b"other")
+
+        cache = handler.InputImageCache(self.input_dir, max_bytes=1024)
+
+        self.assertTrue(cache.acquire(stored_name))
+        self.assertEqual(list(cache._entries), [stored_name])
+
+    def test_cache_hit_skips_upload(self):
+        # Input directory of a remote ComfyUI: the index alone decides
+        cache = handler.InputImageCache(os.path.join(self.input_dir, "remote"), max_bytes=1024)
+        image = {"name": "face.png", "image": base64.b64encode(b"face").decode()}
+        with patch("handler.input_cache", cache), patch("handler.comfy_client.post") as mock_post:
+            first, stored_names = handler.upload_input_images([image])
+            handler._release_input_images(stored_names)
+            second, _ = handler.upload_input_images([image])
+
+        self.assertEqual(mock_post.call_count, 1)
+        uploaded_name = mock_post.call_args.kwargs["files"]["image"][0]
+        self.assertEqual(stored_names, {"face.png": uploaded_name})
+        self.assertEqual(second["details"], ["Reused cached upload of face.png"])
+
+    def test_rewrite_image_references(self):
+        workflow = {
+            "10": {"class_type": "LoadImage", "inputs": {"image": "face.png", "upload": "image"}},
+            "11": {"class_type": "CLIPTextEncode", "inputs": {"text": "a face", "clip": ["4", 1]}},
+        }
+
+        rewritten = handler._rewrite_image_references(workflow, {"face.png": "abc.png"})
+
+        self.assertEqual(rewritten["10"]["inputs"], {"image": "abc.png", "upload": "image"})
+        self.assertIs(rewritten["11"], workflow["11"])
+        self.assertEqual(workflow["10"]["inputs"]["image"], "face.png")
+
+
+class TestInlineInputImages(unittest.TestCase):
+    def setUp(self):
+        self.data = base64.b64encode(b"face").decode()
+        self.workflow = {
+            "10": {"class_type": "LoadImage", "inputs": {"image": "face.png", "upload": "image"}, "_meta": {"title": "Face"}},
+            "11": {"class_type": "LoadImage", "inputs": {"image": "pose.png", "upload": "image"}},
+            "12": {"class_type": "SomeCustomLoader", "inputs": {"path": "pose.png"}},
+        }
+
+    def test_load_image_nodes_are_rewritten(self):
+        images = [
+            {"name": "face.png", "image": f"data:image/png;base64,{self.data}"},
+            {"name": "pose.png", "image": self.data},
+        ]
+
+        workflow, remaining = handler._inline_input_images(self.workflow, images)
+
+        self.assertEqual(
+            workflow["10"],
+            {"class_type": "ETN_LoadImageBase64", "inputs": {"image": self.data}, "_meta": {"title": "Face"}},
+        )
+        self.assertEqual(workflow["11"]["class_type"], "ETN_LoadImageBase64")
+        # pose.png is still referenced by name, so it is uploaded as well
+        self.assertEqual([image["name"] for image in remaining], ["pose.png"])
+        self.assertEqual(self.workflow["10"]["class_type"], "LoadImage")
+
+    def test_invalid_base64_is_left_for_upload(self):
+        images = [{"name": "face.png", "image": "not-base64!"}]
+
+        workflow, remaining = handler._inline_input_images(self.workflow, images)
+
+        self.assertEqual(workflow["10"]["class_type"], "LoadImage")
+        self.assertEqual(remaining, images)
+
+    @patch.dict(handler._node_class_availability, clear=True)
+    @patch("handler.comfy_client.get")
+    def test_node_class_availability_is_cached(self, mock_get):
+        mock_get.return_value.json.return_value = {}
+
+        self.assertFalse(handler.node_class_available("ETN_LoadImageBase64"))
+        self.assertFalse(handler.node_class_available("ETN_LoadImageBase64"))
+
+        mock_get.assert_called_once_with("/object_info/ETN_LoadImageBase64", "object_info")
+
+    @patch("handler.IMAGE_INPUT_MODE", "inline")
+    @patch("handler.node_class_available", return_value=False)
+    @patch("handler.check_server", return_value=True)
+    @patch("handler.upload_input_images")
+    def test_handler_falls_back_to_upload(self, mock_upload, mock_check, mock_available):
+        mock_upload.return_value = ({"status": "error", "details": ["boom"]}, {})
+        images = [{"name": "face.png", "image": self.data}]
+
+        result = handler.handler({"id": "job", "input": {"workflow": self.workflow, "images": images}})
+
+        mock_upload.assert_called_once_with(images)
+        self.assertEqual(result["details"], ["boom"])
+
+
+class TestWebsocketOutputImages(unittest.TestCase):
+    def setUp(self):
+        self.workflow = {
+            "8": {"class_type": "VAEDecode", "inputs": {"samples": ["3", 0]}},
+            "9": {"class_type": "SaveImage", "inputs": {"images": ["8", 0], "filename_prefix": "out/portrait"}},
+        }
+
+    def test_save_nodes_are_rewritten(self):
+        workflow, prefixes = handler._rewrite_save_nodes_for_websocket(self.workflow)
+
+        self.assertEqual(
+            workflow["9"],
+            {"class_type": "ETN_SendImageWebSocket", "inputs": {"images": ["8", 0], "format": "PNG"}},
+        )
+        self.assertEqual(workflow["8"], self.workflow["8"])
+        self.assertEqual(prefixes, {"9": "portrait"})
+        self.assertEqual(self.workflow["9"]["class_type"], "SaveImage")
+
+    def test_binary_frames_are_routed_to_executing_prompt(self):
+        manager = handler.ComfyWebsocketManager("127.0.0.1:8188")
+        events = manager.register("p1")
+
+        # Frames outside of an executing prompt are dropped
+        manager._dispatch_binary(struct.pack(">II", 1, 2) + b"early")
+        manager._dispatch({"type": "executing", "data": {"node": "9", "prompt_id": "p1"}})
+        events.get_nowait()
+        manager._dispatch_binary(struct.pack(">II", 1, 2) + b"png")
+
+        frame = events.get_nowait()
+        self.assertEqual(frame["type"], "binary")
+        self.assertEqual(frame["data"], {"prompt_id": "p1", "node": "9", "image_type": 2, "image": b"png"})
+        self.assertTrue(events.empty())
+
+    @patch("handler.IMAGE_OUTPUT_MODE", "websocket")
+    @patch("handler.node_class_available", return_value=True)
+    @patch("handler.check_server", return_value=True)
+    @patch("handler.get_history")
+    def test_handler_skips_history(self, mock_history, mock_check, mock_available):
+        manager = handler.ComfyWebsocketManager("127.0.0.1:8188")
+        queued = []
+
+        def queue_workflow(workflow, client_id):
+            queued.append(workflow)
+            manager._dispatch({"type": "executing", "data": {"node": "9", "prompt_id": "p1"}})
+            manager._dispatch_binary(struct.pack(">II", 1, 2) + b"png")
+            manager._dispatch({"type": "executing", "data": {"node": None, "prompt_id": "p1"}})
+            return {"prompt_id": "p1"}
+
+        with patch("handler.ws_manager", manager), patch.object(manager, "start"), patch(
+            "handler.queue_workflow", side_effect=queue_workflow
+        ):
+            result = handler.handler({"id": "job", "input": {"workflow": self.workflow}})
+
+        self.assertEqual(queued[0]["9"]["class_type"], "ETN_SendImageWebSocket")
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(result["message"], base64.b64encode(b"png").decode())
+        mock_history.assert_not_called()
+
+
+class TestOutputSelection(unittest.TestCase):
+    def setUp(self):
+        self.outputs = {
+            "9": {"images": [{"filename": f"9_{i}.png", "subfolder": "", "type": "output"} for i in range(3)]},
+            "40": {"images": [{"filename": f"40_{i}.png", "subfolder": "", "type": "output"} for i in range(3)]},
+        }
+
+    def test_invalid_selection_is_rejected(self):
+        for selection, error in [
+            ([], "'outputs' must be an object"),
+            ({"nodes": "9"}, "'outputs.nodes' must be a list of node ids"),
+            ({"kinds": ["latents"]}, "'outputs.kinds' must be a list of: images, gifs, videos, audio"),
+            ({"kinds": [["images"]]}, "'outputs.kinds' must be a list of: images, gifs, videos, audio"),
+            ({"limit": 0}, "'outputs.limit' must be a positive integer"),
+        ]:
+            validated_data, error_message = handler.validate_input({"workflow": {}, "outputs": selection})
+            self.assertIsNone(validated_data)
+            self.assertEqual(error_message, error)
+
+    def test_node_ids_are_normalized(self):
+        validated_data, _ = handler.validate_input({"workflow": {}, "outputs": {"nodes": [40]}})
+        self.assertEqual(validated_data["outputs"], {"nodes": ["40"], "kinds": None, "limit": None})
+
+    def test_nodes_and_limit_are_applied(self):
+        prompt_outputs = handler._PromptOutputs({}, {"nodes": ["40"], "kinds": None, "limit": 2})
+
+        self.assertEqual(prompt_outputs.new_images({"9": self.outputs["9"]}, []), [])
+        images = prompt_outputs.new_images({"40": self.outputs["40"]}, [])
+
+        self.assertEqual([image["filename"] for image in images], ["40_0.png", "40_1.png"])
+        # Once the limit is reached the history is not needed either
+        prompt_outputs.reconnected = True
+        self.assertFalse(prompt_outputs.needs_history())
+
+    def test_unselected_kinds_are_skipped(self):
+        prompt_outputs = handler._PromptOutputs({}, {"nodes": None, "kinds": [], "limit": None})
+        self.assertEqual(prompt_outputs.new_images(self.outputs, []), [])
+
+    @patch("handler.check_server", return_value=True)
+    @patch("handler.get_image_data", return_value=b"png")
+    def test_handler_fetches_only_selected_images(self, mock_fetch, mock_check):
+        manager = handler.ComfyWebsocketManager("127.0.0.1:8188")
+
+        def queue_workflow(workflow, client_id):
+            for node_id, output in self.outputs.items():
+                manager._dispatch({"type": "executed", "data": {"node": node_id, "output": output, "prompt_id": "p1"}})
+            manager._dispatch({"type": "executing", "data": {"node": None, "prompt_id": "p1"}})
+            return {"prompt_id": "p1"}
+
+        job_input = {"workflow": {}, "outputs": {"nodes": ["40"], "limit": 1}, "response_format": "images"}
+        with patch("handler.ws_manager", manager), patch.object(manager, "start"), patch(
+            "handler.queue_workflow", side_effect=queue_workflow
+        ):
+            result = handler.handler({"id": "job", "input": job_input})
+
+        self.assertEqual([image["filename"] for image in result["images"]], ["40_0.png"])
+        mock_fetch.assert_called_once_with("40_0.png", "", "output")
+
+
+class TestLocalOutputReader(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.output_dir = os.path.join(tmp.name, "output")
+        os.makedirs(os.path.join(self.output_dir, "sub"))
+        with open(os.path.join(self.output_dir, "sub", "a.png"), "wb") as f:
+            f.write(b"png" * 100)
+        with open(os.path.join(tmp.name, "secret.txt"), "wb") as f:
+            f.write(b"secret")
+        os.symlink(os.path.join(tmp.name, "secret.txt"), os.path.join(self.output_dir, "link.png"))
+        p = patch("handler.COMFY_OUTPUT_DIR", self.output_dir)
+        p.start()
+        self.addCleanup(p.stop)
+
+    def test_reads_output_file(self):
+        self.assertEqual(handler.read_local_output("a.png", "sub", "output"), b"png" * 100)
+
+    @patch("handler.OUTPUT_MMAP_MIN_MB", 0.0001)
+    def test_large_files_are_memory_mapped(self):
+        data = handler.read_local_output("a.png", "sub", "output")
+        self.assertIsInstance(data, mmap.mmap)
+        self.assertEqual(base64.b64decode(base64.b64encode(data)), b"png" * 100)
+
+    def test_paths_outside_the_directory_are_refused(self):
+        self.assertIsNone(handler.read_local_output("../secret.txt", "", "output"))
+        self.assertIsNone(handler.read_local_output("secret.txt", "..", "output"))
+        self.assertIsNone(handler.read_local_output("link.png", "", "output"))
+        self.assertIsNone(handler.read_local_output("a.png", "sub", "unknown"))
+
+    @patch("handler.comfy_client.get")
+    def test_missing_files_fall_back_to_view(self, mock_get):
+        mock_get.return_value.content = b"remote"
+
+        self.assertEqual(handler.get_image_data("b.png", "", "output"), b"remote")
+        self.assertEqual(handler.get_image_data("a.png", "sub", "output"), b"png" * 100)
+        mock_get.assert_called_once()
+
+
+class FakeS3Handler(BaseHTTPRequestHandler):
+    """Minimal path-style S3 API: PUT object and the three multipart calls."""
+
+    protocol_version = "HTTP/1.1"
+
+    def _reply(self, body=b"", headers=None):
+        self.send_response(200)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_PUT(self):
+        path, _, query = self.path.partition("?")
+        params = urllib.parse.parse_qs(query)
+        body = self._body()
+        server = self.server
+        with server.lock:
+            if server.failures:
+                server.failures -= 1
+                self.send_response(503)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        time.sleep(server.delay_s)
+        with server.lock:
+            server.in_flight -= 1
+            if "partNumber" in params:
+                server.parts[params["uploadId"][0]][int(params["partNumber"][0])] = body
+            else:
+                server.objects[path] = (body, self.headers.get("Content-Type"))
+        self._reply(headers={"ETag": '"etag"'})
+
+    def do_POST(self):
+        path, _, query = self.path.partition("?")
+        params = urllib.parse.parse_qs(query, keep_blank_values=True)
+        self._body()
+        server = self.server
+        if "uploads" in params:
+            upload_id = f"upload-{len(server.parts)}"
+            server.parts[upload_id] = {}
+            server.multipart_types[upload_id] = self.headers.get("Content-Type")
+            body = f"<InitiateMultipartUploadResult><UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>"
+        else:
+            upload_id = params["uploadId"][0]
+            parts = server.parts[upload_id]
+            server.objects[path] = (b"".join(parts[n] for n in sorted(parts)), server.multipart_types[upload_id])
+            body = "<CompleteMultipartUploadResult><ETag>\"etag\"</ETag></CompleteMultipartUploadResult>"
+        self._reply(body.encode(), {"Content-Type": "application/xml"})
+
+    def log_message(self, *args):
+        pass
+
+
+def start_fake_s3(test):
+    """Start a FakeS3Handler server for the duration of a test."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeS3Handler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.objects, server.parts, server.multipart_types = {}, {}, {}
+    server.in_flight = server.max_in_flight = 0
+    server.delay_s = 0
+    server.failures = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    test.addCleanup(server.shutdown)
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+class TestS3Uploader(unittest.TestCase):
+    def setUp(self):
+        self.server, self.endpoint = start_fake_s3(self)
+
+    def _uploader(self, **kwargs):
+        return handler.S3Uploader(self.endpoint, "key", "secret", "outputs", **kwargs)
+
+    def test_upload_from_memory(self):
+        url = self._uploader().upload("job-1", "ComfyUI_00001_.png", b"png")
+
+        (key, (body, content_type)), = self.server.objects.items()
+        self.assertRegex(key, r"^/outputs/job-1/[0-9a-f]{8}\.png$")
+        self.assertEqual((body, content_type), (b"png", "image/png"))
+        self.assertTrue(url.startswith(f"{self.endpoint}{key}?"))
+
+    def test_large_files_use_multipart(self):
+        data = os.urandom(11 * 1024 * 1024)
+        uploader = self._uploader(multipart_threshold=1024 * 1024, multipart_chunksize=5 * 1024 * 1024)
+
+        uploader.upload("job-1", "clip.mp4", data)
+
+        self.assertEqual(len(self.server.parts["upload-0"]), 3)
+        (body, content_type), = self.server.objects.values()
+        self.assertEqual((body, content_type), (data, "video/mp4"))
+
+    def test_parallel_uploads_are_capped(self):
+        self.server.delay_s = 0.05
+        uploader = self._uploader(max_uploads=2)
+
+        with handler.ThreadPoolExecutor(max_workers=6) as executor:
+            list(executor.map(lambda i: uploader.upload("job-1", f"{i}.png", b"png"), range(6)))
+
+        self.assertEqual(len(self.server.objects), 6)
+        self.assertEqual(self.server.max_in_flight, 2)
+
+    def test_stream_output_uses_multipart_chunks(self):
+        chunks = [os.urandom(1024 * 1024) for _ in range(11)]
+        uploader = self._uploader(multipart_threshold=1024 * 1024, multipart_chunksize=5 * 1024 * 1024)
+
+        url = handler.stream_output((iter(chunks), None), lambda stream: uploader.upload("job-1", "out.png", stream))
+
+        self.assertEqual(len(self.server.parts["upload-0"]), 3)
+        (key, (body, _)), = self.server.objects.items()
+        self.assertEqual(body, b"".join(chunks))
+        self.assertIn(key, url)
+
+    def test_put_presigned_url_streams_with_content_length(self):
+        url = f"{self.endpoint}/outputs/a.png?X-Amz-Signature=abc"
+        source = (iter([b"ab", b"cd", b"e"]), 5)
+
+        result = handler.stream_output(source, lambda stream: handler.put_presigned_url(url, stream, "image/png"))
+
+        self.assertEqual(result, f"{self.endpoint}/outputs/a.png")
+        self.assertEqual(self.server.objects["/outputs/a.png"], (b"abcde", "image/png"))
+
+    def test_fetch_and_deliver_streams_to_s3(self):
+        response = MagicMock(headers={"Content-Length": "6"})
+        response.iter_content.return_value = iter([b"png", b"png"])
+        env = {"BUCKET_ENDPOINT_URL": self.endpoint, "BUCKET_ACCESS_KEY_ID": "key", "BUCKET_SECRET_ACCESS_KEY": "secret", "BUCKET_NAME": "outputs"}
+        image_info = {"node_id": "9", "filename": "a.png", "subfolder": "", "type": "output"}
+        with patch.dict(os.environ, env), patch.dict(handler._s3_uploaders, clear=True), patch(
+            "handler.comfy_client.get", return_value=response
+        ) as mock_get, patch("handler.get_image_data") as mock_fetch:
+            entry = handler._fetch_and_deliver("job-1", image_info, [])
+
+        self.assertEqual(entry["type"], "s3_url")
+        self.assertEqual(list(self.server.objects.values()), [(b"pngpng", "image/png")])
+        self.assertTrue(mock_get.call_args.kwargs["stream"])
+        response.close.assert_called_once()
+        mock_fetch.assert_not_called()
+
+    def test_deliver_image_reuses_the_client(self):
+        env = {"BUCKET_ENDPOINT_URL": self.endpoint, "BUCKET_ACCESS_KEY_ID": "key", "BUCKET_SECRET_ACCESS_KEY": "secret", "BUCKET_NAME": "outputs"}
+        with patch.dict(os.environ, env), patch.dict(handler._s3_uploaders, clear=True):
+            first = handler._deliver_image_bytes("job-1", {"node_id": "9", "filename": "a.png", "index": 0}, b"a", [])
+            second = handler._deliver_image_bytes("job-1", {"node_id": "9", "filename": "b.png", "index": 1}, b"b", [])
+            self.assertEqual(len(handler._s3_uploaders), 1)
+
+        self.assertEqual(first["type"], "s3_url")
+        self.assertEqual(second["filename"], "b.png")
+        self.assertEqual(len(self.server.objects), 2)
+
+
+class TestChunkStream(unittest.TestCase):
+    def test_reads_across_chunk_boundaries(self):
+        stream = handler.ChunkStream([b"abc", b"de", b"", b"fgh"], 8)
+
+        self.assertEqual(stream.len, 8)
+        self.assertEqual(stream.read(4), b"abcd")
+        self.assertEqual(stream.read(3), b"efg")
+        self.assertEqual(stream.read(10), b"h")
+        self.assertEqual(stream.read(10), b"")
+
+    def test_transform_wraps_the_chunks(self):
+        seen = []
+        result = handler.stream_output(
+            (iter([b"ab", b"cd"]), 4),
+            lambda stream: (getattr(stream, "len", None), stream.read()),
+            transform=lambda chunks: (seen.append(chunk) or chunk.upper() for chunk in chunks),
+        )
+
+        self.assertEqual(result, (None, b"ABCD"))
+        self.assertEqual(seen, [b"ab", b"cd"])
+
+
+class TestUploadUrls(unittest.TestCase):
+    def setUp(self):
+        self.server, self.endpoint = start_fake_s3(self)
+        self.images = [
+            {"node_id": "9", "filename": f"9_{i}.png", "subfolder": "", "type": "output", "index": i} for i in range(3)
+        ]
+
+    def _source(self, filename, subfolder, image_type):
+        return iter([filename.encode()]), len(filename)
+
+    def test_invalid_upload_urls_are_rejected(self):
+        for upload_urls in [[], ["ftp://host/a.png"], {"url": "https://host"}]:
+            validated_data, error_message = handler.validate_input({"workflow": {}, "upload_urls": upload_urls})
+            self.assertIsNone(validated_data)
+            self.assertIn("'upload_urls'", error_message)
+
+    @patch("handler.COMFY_HTTP_RETRY_BACKOFF_S", 0)
+    def test_outputs_go_to_their_urls_concurrently_with_retries(self):
+        self.server.failures = 2
+        self.server.delay_s = 0.05
+        urls = [f"{self.endpoint}/tenant/out_{i}.png?X-Amz-Signature=s{i}" for i in range(3)]
+        errors = []
+
+        with patch("handler.open_output_source", side_effect=self._source):
+            with handler.ThreadPoolExecutor(max_workers=3) as executor:
+                entries = list(executor.map(lambda info: handler._fetch_and_deliver("job", info, errors, urls), self.images))
+
+        self.assertEqual(errors, [])
+        self.assertEqual([entry["data"] for entry in entries], [f"{self.endpoint}/tenant/out_{i}.png" for i in range(3)])
+        self.assertEqual(entries[0]["type"], "url")
+        self.assertEqual(self.server.objects["/tenant/out_1.png"], (b"9_1.png", "image/png"))
+        self.assertGreater(self.server.max_in_flight, 1)
+
+    def test_url_template(self):
+        template = f"{self.endpoint}/tenant/{{job_id}}/{{node_id}}-{{index}}-{{filename}}?sig=abc"
+        with patch("handler.open_output_source", side_effect=self._source):
+            entry = handler._fetch_and_deliver("job 1", self.images[2], [], template)
+
+        self.assertEqual(entry["data"], f"{self.endpoint}/tenant/job%201/9-2-9_2.png")
+        self.assertIn("/tenant/job%201/9-2-9_2.png", self.server.objects)
+
+    def test_missing_url_and_client_errors_are_reported(self):
+        errors = []
+        with patch("handler.open_output_source", side_effect=self._source):
+            self.assertIsNone(handler._fetch_and_deliver("job", self.images[1], errors, [f"{self.endpoint}/a.png"]))
+            with patch("handler.put_presigned_url", side_effect=handler.requests.HTTPError(response=MagicMock(status_code=403))) as mock_put:
+                self.assertIsNone(handler._fetch_and_deliver("job", self.images[0], errors, [f"{self.endpoint}/a.png"]))
+
+        self.assertIn("No upload URL left for 9_1.png", errors[0])
+        self.assertIn("Error uploading 9_0.png", errors[1])
+        # Client errors such as an expired signature are not retried
+        mock_put.assert_called_once()
+
+    @patch("handler.COMFY_HTTP_RETRY_BACKOFF_S", 0)
+    def test_websocket_images_are_uploaded_from_memory(self):
+        info = {"node_id": "9", "filename": "ComfyUI_00001_.png", "index": 0}
+        entry = handler._deliver_image_bytes("job", info, b"png", [], [f"{self.endpoint}/ws.png?sig=1"])
+
+        self.assertEqual(entry, {"filename": "ComfyUI_00001_.png", "type": "url", "data": f"{self.endpoint}/ws.png"})
+        self.assertEqual(self.server.objects["/ws.png"], (b"png", "image/png"))
+
+
+class TestResponseBudget(unittest.TestCase):
+    def setUp(self):
+        self.server, self.endpoint = start_fake_s3(self)
+
+    def test_reserve_counts_base64_size_and_exhausts(self):
+        budget = handler._ResponseBudget(8)
+        self.assertTrue(budget.reserve(3))
+        self.assertEqual(budget.remaining, 4)
+        self.assertFalse(budget.reserve(None))
+        self.assertFalse(budget.exhausted)
+        self.assertFalse(budget.reserve(4))
+        # Once an output did not fit, the smaller ones go to object storage too
+        self.assertFalse(budget.reserve(1))
+        self.assertTrue(budget.exhausted)
+
+    def test_response_mixes_inline_and_uploaded_outputs(self):
+        sizes = {"small.png": 100, "large.png": 4000, "tiny.png": 10}
+        source = lambda filename, subfolder, image_type: (iter([b"x" * sizes[filename]]), sizes[filename])
+        budget = handler._ResponseBudget(1024)
+        urls = f"{self.endpoint}/out/{{filename}}?sig=1"
+        errors = []
+
+        with patch("handler.open_output_source", side_effect=source) as mock_source:
+            entries = [
+                handler._fetch_and_deliver("job", {"node_id": "9", "filename": name, "subfolder": "", "type": "output", "index": 0}, errors, urls, budget)
+                for name in sizes
+            ]
+
+        self.assertEqual(errors, [])
+        self.assertEqual(entries[0], {"filename": "small.png", "type": "base64", "data": base64.b64encode(b"x" * 100).decode()})
+        self.assertEqual(entries[1], {"filename": "large.png", "type": "url", "data": f"{self.endpoint}/out/large.png"})
+        self.assertEqual(entries[2]["type"], "url")
+        self.assertEqual(self.server.objects["/out/large.png"][0], b"x" * 4000)
+        # The source opened to measure an output is reused for its upload
+        self.assertEqual(mock_source.call_count, 3)
+
+    def test_without_object_storage_everything_is_inlined(self):
+        budget = handler._ResponseBudget(4)
+        entry = handler._deliver_image_bytes("job", {"node_id": "9", "filename": "a.png", "index": 0}, b"x" * 64, [], None, budget)
+        self.assertEqual(entry["type"], "base64")
+
+
+@unittest.skipIf(handler.Image is None, "Pillow is not installed")
+class TestOutputEncoding(unittest.TestCase):
+    def setUp(self):
+        buffer = handler.BytesIO()
+        handler.Image.new("RGBA", (640, 320), (200, 40, 40, 255)).save(buffer, format="PNG")
+        self.png = buffer.getvalue()
+        self.image_info = {"node_id": "9", "filename": "ComfyUI_00001_.png", "subfolder": "", "type": "output", "index": 0}
+
+    def test_invalid_encoding_is_rejected(self):
+        for encoding, message in [
+            ("webp", "'output_encoding' must be an object"),
+            ({"format": "gif"}, "'output_encoding.format'"),
+            ({"format": "webp", "quality": 0}, "'output_encoding.quality'"),
+            ({"format": "jpeg", "thumbnail": -1}, "'output_encoding.thumbnail'"),
+        ]:
+            validated_data, error_message = handler.validate_input({"workflow": {}, "output_encoding": encoding})
+            self.assertIsNone(validated_data)
+            self.assertIn(message, error_message)
+
+        validated_data, _ = handler.validate_input({"workflow": {}, "output_encoding": {"format": "webp", "max_dimension": 256}})
+        self.assertEqual(
+            validated_data["output_encoding"],
+            {"format": "webp", "quality": handler.OUTPUT_ENCODING_QUALITY, "max_dimension": 256, "thumbnail": None},
+        )
+
+    def test_transcode_resizes_and_makes_a_thumbnail(self):
+        data, thumbnail = handler.transcode_image(self.png, {"format": "jpeg", "quality": 80, "max_dimension": 320, "thumbnail": 64})
+
+        with handler.Image.open(handler.BytesIO(data)) as image:
+            self.assertEqual((image.format, image.size), ("JPEG", (320, 160)))
+        with handler.Image.open(handler.BytesIO(thumbnail)) as image:
+            self.assertEqual(image.size, (64, 32))
+        # Pool processes only import the side-effect free module
+        self.assertEqual(handler.transcode_image.__module__, "output_encoding")
+
+    def test_fetched_outputs_are_transcoded_in_the_process_pool(self):
+        encoding = {"format": "webp", "quality": 80, "max_dimension": None, "thumbnail": 32}
+        errors = []
+        with patch("handler.get_image_data", return_value=self.png):
+            entry = handler._fetch_and_deliver("job", self.image_info, errors, encoding=encoding)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(entry["filename"], "ComfyUI_00001_.webp")
+        with handler.Image.open(handler.BytesIO(base64.b64decode(entry["data"]))) as image:
+            self.assertEqual((image.format, image.size), ("WEBP", (640, 320)))
+        self.assertIn("thumbnail", entry)
+
+    def test_failed_transcoding_keeps_the_original(self):
+        errors = []
+        entry = handler._deliver_image_bytes("job", self.image_info, b"not an image", errors, encoding={"format": "webp", "quality": 80})
+
+        self.assertEqual(entry["filename"], "ComfyUI_00001_.png")
+        self.assertEqual(base64.b64decode(entry["data"]), b"not an image")
+        self.assertIn("Error transcoding ComfyUI_00001_.png to webp", errors[0])
+
+
+class TestOutputKinds(unittest.TestCase):
+    def setUp(self):
+        self.server, self.endpoint = start_fake_s3(self)
+        self.outputs = {
+            "9": {"images": [{"filename": "9_0.png", "subfolder": "", "type": "output"}]},
+            "12": {
+                "gifs": [{"filename": "clip_00001.mp4", "subfolder": "", "type": "output", "format": "video/h264-mp4"}],
+                "animated": [True],
+            },
+            "15": {"audio": [{"filename": "speech_00001_.flac", "subfolder": "audio", "type": "output"}]},
+        }
+
+    def test_all_kinds_are_collected(self):
+        errors = []
+        files = handler._collect_output_images(self.outputs, errors)
+
+        self.assertEqual(errors, [])
+        self.assertEqual([(info["filename"], info["kind"]) for info in files], [
+            ("9_0.png", "images"), ("clip_00001.mp4", "gifs"), ("speech_00001_.flac", "audio"),
+        ])
+        prompt_outputs = handler._PromptOutputs({}, {"nodes": None, "kinds": ["gifs"], "limit": None})
+        self.assertEqual([info["filename"] for info in prompt_outputs.new_images(self.outputs, [])], ["clip_00001.mp4"])
+
+    def test_videos_and_audio_are_streamed_with_their_content_type(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        output_dir = tmp.name
+        os.makedirs(os.path.join(output_dir, "audio"))
+        video = os.urandom(64 * 1024)
+        with open(os.path.join(output_dir, "clip_00001.mp4"), "wb") as f:
+            f.write(video)
+        with open(os.path.join(output_dir, "audio", "speech_00001_.flac"), "wb") as f:
+            f.write(b"fLaC")
+
+        files = handler._collect_output_images(self.outputs, [])
+        for info in files:
+            info["index"] = 0
+        with patch("handler.COMFY_OUTPUT_DIR", output_dir), patch("handler.get_image_data") as mock_fetch:
+            video_entry = handler._fetch_and_deliver("job", files[1], [], f"{self.endpoint}/out/{{filename}}")
+            audio_entry = handler._fetch_and_deliver("job", files[2], [], f"{self.endpoint}/out/{{filename}}")
+
+        self.assertEqual(video_entry, {"filename": "clip_00001.mp4", "type": "url", "data": f"{self.endpoint}/out/clip_00001.mp4", "kind": "gifs"})
+        self.assertEqual(audio_entry["kind"], "audio")
+        self.assertEqual(self.server.objects["/out/clip_00001.mp4"], (video, "video/mp4"))
+        self.assertEqual(self.server.objects["/out/speech_00001_.flac"], (b"fLaC", "audio/flac"))
+        # Never buffered as a whole
+        mock_fetch.assert_not_called()
+
+    def test_websocket_mode_still_fetches_other_outputs(self):
+        prompt_outputs = handler._PromptOutputs({})
+        fetched = prompt_outputs.new_images(self.outputs, [], exclude={"9": "ComfyUI"})
+        self.assertEqual([info["filename"] for info in fetched], ["clip_00001.mp4", "speech_00001_.flac"])
+
+        frames = [{"node": "9", "image_type": 2, "image": b"png"}]
+        (info, _), = prompt_outputs.websocket_images(frames, {"9": "ComfyUI"})
+        # Indexes pick upload URLs, so they must not collide with the fetched files
+        self.assertEqual(info["index"], 2)
+
+
+class TestOutputDedup(unittest.TestCase):
+    def setUp(self):
+        self.server, self.endpoint = start_fake_s3(self)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        for filename, data in [("9_0.png", b"same"), ("40_0.png", b"same"), ("40_1.png", b"other")]:
+            with open(os.path.join(tmp.name, filename), "wb") as f:
+                f.write(data)
+        p = patch("handler.COMFY_OUTPUT_DIR", tmp.name)
+        p.start()
+        self.addCleanup(p.stop)
+        self.images = [
+            {"node_id": filename.split("_")[0], "filename": filename, "subfolder": "", "type": "output", "index": index}
+            for index, filename in enumerate(["9_0.png", "40_0.png", "40_1.png"])
+        ]
+
+    def test_identical_outputs_are_uploaded_once(self):
+        self.server.delay_s = 0.05
+        dedup = handler._OutputDedup()
+        errors = []
+        template = f"{self.endpoint}/out/{{filename}}"
+
+        with handler.ThreadPoolExecutor(max_workers=3) as executor:
+            entries = list(executor.map(lambda info: handler._fetch_and_deliver("job", info, errors, template, dedup=dedup), self.images))
+
+        self.assertEqual(errors, [])
+        # The two copies of b"same" are uploaded once
+        self.assertEqual(sorted(body for body, _ in self.server.objects.values()), [b"other", b"same"])
+        first, copy = sorted(entries[:2], key=lambda entry: entry["type"] == "ref")
+        self.assertEqual(first["type"], "url")
+        self.assertEqual(copy["type"], "ref")
+        self.assertEqual(copy["data"], first["filename"])
+        self.assertEqual(entries[2]["type"], "url")
+
+    def test_copies_are_uploaded_to_every_upload_url(self):
+        self.assertIsNotNone(handler._job_output_dedup(None))
+        self.assertIsNone(handler._job_output_dedup(f"{self.endpoint}/out/{{filename}}"))
+        errors = []
+        urls = [f"{self.endpoint}/out/{index}.png" for index in range(3)]
+
+        entries = [handler._fetch_and_deliver("job", info, errors, urls, dedup=handler._job_output_dedup(urls)) for info in self.images]
+
+        self.assertEqual(errors, [])
+        self.assertEqual([entry["type"] for entry in entries], ["url"] * 3)
+        self.assertEqual(len(self.server.objects), 3)
+
+    def test_remote_videos_are_not_fetched_for_hashing(self):
+        video = {"node_id": "12", "filename": "clip.mp4", "subfolder": "", "type": "output", "kind": "videos", "index": 0}
+        with patch("handler.get_image_data") as mock_fetch:
+            self.assertEqual(handler._output_digest(video), ("", None))
+        mock_fetch.assert_not_called()
+
+    def test_copies_of_a_failed_output_are_delivered_on_their_own(self):
+        dedup = handler._OutputDedup()
+        self.assertIsNone(dedup.deliver(self.images[0], "digest", lambda: None))
+        entry = dedup.deliver(self.images[1], "digest", lambda: {"filename": "40_0.png", "type": "base64", "data": "c2FtZQ=="})
+        self.assertEqual(entry["type"], "base64")
+
+    def test_in_memory_copies_and_legacy_response(self):
+        dedup = handler._OutputDedup()
+        info = {"node_id": "9", "filename": "ComfyUI_00001_.png", "index": 0}
+        first = handler._deliver_image_bytes("job", info, b"png", [], dedup=dedup)
+        copy = handler._deliver_image_bytes("job", {**info, "filename": "ComfyUI_00002_.png", "index": 1}, b"png", [], dedup=dedup)
+
+        self.assertEqual(copy, {"filename": "ComfyUI_00002_.png", "type": "ref", "data": "ComfyUI_00001_.png"})
+        # The legacy format never returns a reference as the image
+        response = handler._build_response([copy, first], [])
+        self.assertEqual(response["message"], first["data"])
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.cache_dir = os.path.join(tmp.name, "results")
+        p = patch("handler.RESULT_CACHE_DIR", self.cache_dir)
+        p.start()
+        self.addCleanup(p.stop)
+        self.workflow = {
+            "3": {"class_type": "KSampler", "inputs": {"seed": 42, "model": ["4", 0]}},
+            "4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "sd_xl.safetensors"}, "_meta": {"title": "Load"}},
+        }
+
+    def _outputs(self, *names):
+        return [({"node_id": "9", "filename": name, "kind": "images"}, name.encode() * 100) for name in names]
+
+    def test_key_is_canonical(self):
+        reordered = {"4": {"inputs": {"ckpt_name": "sd_xl.safetensors"}, "class_type": "CheckpointLoaderSimple"}, "3": self.workflow["3"]}
+        key = handler.result_cache_key(self.workflow)
+
+        self.assertEqual(handler.result_cache_key(reordered), key)
+        image = {"name": "in.png", "image": base64.b64encode(b"a").decode()}
+        self.assertNotEqual(handler.result_cache_key(self.workflow, [image]), key)
+        self.assertNotEqual(handler.result_cache_key(self.workflow, selection={"nodes": ["9"], "kinds": None, "limit": None}), key)
+
+    def test_model_files_are_part_of_the_key(self):
+        checkpoints = os.path.join(self.tmp, "models", "checkpoints")
+        os.makedirs(checkpoints)
+        with patch("handler.COMFY_MODEL_DIRS", [os.path.join(self.tmp, "models")]), patch.dict(handler._model_paths, clear=True):
+            missing = handler.result_cache_key(self.workflow)
+            with open(os.path.join(checkpoints, "sd_xl.safetensors"), "wb") as f:
+                f.write(b"v1")
+            # A missing model is only searched for again after MODEL_LOOKUP_RETRY_S
+            self.assertEqual(handler.result_cache_key(self.workflow), missing)
+            with patch("handler.MODEL_LOOKUP_RETRY_S", 0):
+                first = handler.result_cache_key(self.workflow)
+            with open(os.path.join(checkpoints, "sd_xl.safetensors"), "wb") as f:
+                f.write(b"v2-retrained")
+            second = handler.result_cache_key(self.workflow)
+
+        self.assertEqual(len({missing, first, second}), 3)
+
+    def test_random_and_nondeterministic_workflows_bypass_the_cache(self):
+        for node in [
+            {"class_type": "KSampler", "inputs": {"seed": -1}},
+            {"class_type": "KSampler", "inputs": {"seed": 1, "control_after_generate": "randomize"}},
+            {"class_type": "LoadImageFromUrl", "inputs": {"url": "https://example.com/a.png"}},
+        ]:
+            self.assertIsNone(handler.result_cache_key({**self.workflow, "3": node}))
+        for workflow in ["abc", [1]]:
+            self.assertIsNone(handler.result_cache_key(workflow))
+
+    def test_key_and_upload_decode_images_once(self):
+        image = {"name": "in.png", "image": base64.b64encode(b"png").decode()}
+        response = MagicMock(status_code=200)
+        with patch("handler._decode_image_data", wraps=handler._decode_image_data) as mock_decode, patch(
+            "handler.comfy_client.post", return_value=response
+        ), patch("handler.input_cache", None):
+            handler.result_cache_key(self.workflow, [image])
+            self.assertEqual(handler._upload_image(image)[2], "in.png")
+
+        mock_decode.assert_called_once()
+
+    def test_store_acquire_and_lru_eviction(self):
+        cache = handler.ResultCache(self.cache_dir, 2000)
+        cache.store("a" * 64, self._outputs("a.png"))
+        cache.store("b" * 64, self._outputs("b.png"))
+
+        outputs = cache.acquire("a" * 64)
+        self.assertEqual(outputs, [{"node_id": "9", "filename": "a.png", "subfolder": "a" * 64 + "/0", "type": "cached", "kind": "images", "index": 0}])
+        self.assertEqual(handler.read_local_output("a.png", outputs[0]["subfolder"], "cached"), b"a.png" * 100)
+        # "b" is now the least recently used entry, "a" is pinned anyway
+        cache.store("c" * 64, self._outputs("c.png", "d.png"))
+        self.assertIsNone(cache.acquire("b" * 64))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        cache.release("a" * 64)
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, "b" * 64)))
+
+        # A restart indexes the stored entries and drops abandoned staging directories,
+        # but not those a store that is still running writes to
+        abandoned, writing = os.path.join(self.cache_dir, ".abandoned.1"), os.path.join(self.cache_dir, ".writing.2")
+        os.makedirs(abandoned)
+        os.makedirs(writing)
+        os.utime(abandoned, (0, 0))
+        restarted = handler.ResultCache(self.cache_dir, 10000)
+        self.assertIsNotNone(restarted.acquire("c" * 64))
+        self.assertFalse(os.path.exists(abandoned))
+        self.assertTrue(os.path.exists(writing))
+
+    @patch("handler.check_server")
+    def test_handler_answers_repeats_without_comfyui(self, mock_check):
+        cache = handler.ResultCache(self.cache_dir, 10 ** 6)
+        job_input = {"workflow": self.workflow, "response_format": "images"}
+        cache.store(handler.result_cache_key(self.workflow), self._outputs("ComfyUI_00001_.png"))
+
+        with patch("handler.result_cache", cache):
+            result = handler.handler({"id": "job", "input": job_input})
+            async_result = asyncio.run(handler.async_handler({"id": "job", "input": job_input}))
+            with patch("handler.check_server", return_value=False):
+                bypassed = handler.handler({"id": "job", "input": {**job_input, "cache": False}})
+
+        mock_check.assert_not_called()
+        self.assertEqual(result["images"][0]["filename"], "ComfyUI_00001_.png")
+        self.assertEqual(base64.b64decode(result["images"][0]["data"]), b"ComfyUI_00001_.png" * 100)
+        self.assertEqual(async_result, result)
+        self.assertIn("not reachable", bypassed["error"])
+
+
+class TestSharedCache(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.shared_dir = os.path.join(tmp.name, "volume")
+
+    def _index(self):
+        with open(os.path.join(self.shared_dir, "index.json")) as f:
+            return json.load(f)
+
+    def test_publish_and_lookup(self):
+        cache = handler.SharedCache(self.shared_dir, 10 ** 6)
+        self.assertIsNone(cache.lookup("inputs", "a.png"))
+        cache.publish("inputs", "a.png", b"png")
+        cache.publish("inputs", "a.png", b"ignored")
+
+        with open(cache.lookup("inputs", "a.png"), "rb") as f:
+            self.assertEqual(f.read(), b"png")
+        self.assertEqual(cache.stats["inputs"], {"hits": 1, "misses": 1})
+        self.assertEqual(list(self._index()), ["inputs/a.png"])
+        # No staging files are left behind
+        self.assertEqual(os.listdir(os.path.join(self.shared_dir, "inputs")), ["a.png"])
+
+    def test_workers_publish_concurrently_and_evict_least_recently_used(self):
+        # Two instances stand for two workers sharing the volume
+        workers = [handler.SharedCache(self.shared_dir, 1000), handler.SharedCache(self.shared_dir, 1000)]
+        with handler.ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda i: workers[i % 2].publish("inputs", f"{i}.png", b"x" * 100), range(8)))
+        self.assertEqual(len(self._index()), 8)
+
+        index = self._index()
+        for i in range(8):
+            index[f"inputs/{i}.png"][1] = i
+        workers[0]._write_index(index)
+        workers[1].publish("inputs", "big.png", b"x" * 350)
+
+        remaining = sorted(self._index())
+        self.assertEqual(remaining, sorted(["inputs/big.png"] + [f"inputs/{i}.png" for i in range(2, 8)]))
+        self.assertFalse(os.path.exists(os.path.join(self.shared_dir, "inputs", "0.png")))
+
+    def test_results_from_other_workers_are_copied_to_the_local_tier(self):
+        shared = handler.SharedCache(self.shared_dir, 10 ** 6)
+        other_worker = handler.ResultCache(os.path.join(self.tmp, "other"), 10 ** 6)
+        this_worker = handler.ResultCache(os.path.join(self.tmp, "local"), 10 ** 6)
+        key = "f" * 64
+        with patch("handler.result_cache", other_worker), patch("handler.shared_cache", shared):
+            handler._share_result(key, [({"node_id": "9", "filename": "a.png"}, b"png")])
+
+        with patch("handler.result_cache", this_worker), patch("handler.shared_cache", shared), patch("handler.RESULT_CACHE_DIR", this_worker.directory):
+            outputs = handler._acquire_cached_result(key)
+            self.assertEqual(handler.read_local_output("a.png", outputs[0]["subfolder"], "cached"), b"png")
+            stats = handler.cache_stats()
+
+        self.assertEqual(stats["results.shared"], {"hits": 1, "misses": 0})
+        self.assertEqual(stats["results.local"], {"hits": 0, "misses": 1})
+        self.assertTrue(os.path.isdir(os.path.join(this_worker.directory, key)))
+
+    def test_shared_input_images_skip_the_upload(self):
+        input_dir = os.path.join(self.tmp, "input")
+        os.makedirs(input_dir)
+        shared = handler.SharedCache(self.shared_dir, 10 ** 6)
+        cache = handler.InputImageCache(input_dir, 10 ** 6)
+        blob = b"png"
+        stored_name = cache.stored_name("in.png", blob)
+        shared.publish("inputs", stored_name, blob)
+
+        with patch("handler.input_cache", cache), patch("handler.shared_cache", shared), patch("handler.comfy_client.post") as mock_post:
+            success, error, name = handler._upload_image({"name": "in.png", "image": base64.b64encode(blob).decode()})
+
+        self.assertEqual((success, error, name), ("Reused shared upload of in.png", None, stored_name))
+        mock_post.assert_not_called()
+        with open(os.path.join(input_dir, stored_name), "rb") as f:
+            self.assertEqual(f.read(), blob)
+        self.assertEqual(shared.stats["inputs"]["hits"], 1)
+
+
+class TestInflightJobs(unittest.TestCase):
+    workflow = {"3": {"class_type": "KSampler", "inputs": {"seed": 42}}, "9": {"class_type": "SaveImage", "inputs": {}}}
+
+    def test_followers_share_the_leaders_outputs(self):
+        jobs = handler.InflightJobs()
+        self.assertIsNone(jobs.join("key", "leader"))
+        follower = jobs.join("key", "follower")
+        jobs.finish("key", "follower", [])
+        self.assertFalse(follower.done())
+
+        jobs.finish("key", "leader", ["output"])
+        self.assertEqual(follower.result(), ["output"])
+        self.assertEqual(jobs.coalesced, 1)
+        # The next identical job runs the workflow again
+        self.assertIsNone(jobs.join("key", "next"))
+
+    @patch("handler.check_server", return_value=False)
+    def test_one_job_at_a_time_skips_the_key(self, mock_check):
+        with patch("handler.result_cache_key") as mock_key:
+            result = handler.handler({"id": "job", "input": {"workflow": self.workflow}})
+        mock_key.assert_not_called()
+        self.assertIn("not reachable", result["error"])
+
+    @patch("handler.COMFY_MAX_CONCURRENCY", 2)
+    @patch("handler.async_check_server", new_callable=AsyncMock, return_value=False)
+    @patch("handler.check_server", return_value=False)
+    def test_workflows_that_are_not_objects_get_an_error(self, mock_check, mock_async_check):
+        for workflow in ["abc", [1]]:
+            job = {"id": "job", "input": {"workflow": workflow}}
+            self.assertIn("not reachable", handler.handler(job)["error"])
+            self.assertIn("not reachable", asyncio.run(handler.async_handler(job))["error"])
+
+    def test_follower_takes_over_when_the_leader_fails(self):
+        jobs = handler.InflightJobs()
+        jobs.join("key", "leader")
+        with patch("handler.inflight_jobs", jobs):
+            with ThreadPoolExecutor(1) as pool:
+                waiting = pool.submit(handler._wait_for_identical_job, "key", "follower")
+                time.sleep(0.05)
+                jobs.abandon("leader")
+                self.assertIsNone(waiting.result(timeout=5))
+        # The follower is now the leader
+        self.assertIsNotNone(jobs.join("key", "other"))
+
+    @patch("handler.COMFY_MAX_CONCURRENCY", 2)
+    @patch("handler.check_server")
+    def test_handler_delivers_the_outputs_of_an_identical_running_job(self, mock_check):
+        jobs = handler.InflightJobs()
+        job_input = {"workflow": self.workflow, "response_format": "images"}
+        key = handler.result_cache_key(self.workflow)
+        jobs.join(key, "leader")
+        info = {"node_id": "9", "filename": "ComfyUI_00001_.png", "subfolder": "", "type": "output", "index": 0}
+
+        with patch("handler.inflight_jobs", jobs), ThreadPoolExecutor(2) as pool:
+            follower = pool.submit(handler.handler, {"id": "follower", "input": job_input})
+            async_follower = pool.submit(asyncio.run, handler.async_handler({"id": "async-follower", "input": job_input}))
+            while jobs.coalesced < 2:
+                time.sleep(0.01)
+            jobs.finish(key, "leader", [(info, b"png")])
+            result = follower.result(timeout=5)
+            async_result = async_follower.result(timeout=5)
+
+        mock_check.assert_not_called()
+        self.assertEqual(result["images"], [{"filename": "ComfyUI_00001_.png", "type": "base64", "data": base64.b64encode(b"png").decode()}])
+        self.assertEqual(async_result, result)
+
+
+class TestBatching(unittest.TestCase):
+    def _workflow(self, seed, text):
+        return {
+            "3": {"class_type": "KSampler", "inputs": {"seed": seed, "model": ["4", 0], "positive": ["6", 0], "latent_image": ["5", 0]}},
+            "4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "sd_xl.safetensors"}},
+            "5": {"class_type": "EmptyLatentImage", "inputs": {"width": 512, "height": 512, "batch_size": 1}},
+            "6": {"class_type": "CLIPTextEncode", "inputs": {"text": text, "clip": ["4", 1]}},
+            "9": {"class_type": "SaveImage", "inputs": {"images": ["3", 0]}, "_meta": {"title": "Save"}},
+        }
+
+    def test_merge_shares_identical_nodes(self):
+        merged, mappings = handler.merge_workflows([self._workflow(1, "a cat"), self._workflow(2, "a cat"), self._workflow(3, "a dog")])
+
+        self.assertEqual(mappings[0], {node_id: node_id for node_id in ["3", "4", "5", "6", "9"]})
+        # Loader, latent and the first prompt's encoding are shared
+        self.assertEqual([mappings[1][node_id] for node_id in ["4", "5", "6"]], ["4", "5", "6"])
+        self.assertEqual([mappings[2][node_id] for node_id in ["4", "5"]], ["4", "5"])
+        self.assertEqual(len(merged), 5 + 2 + 3)
+        sampler = merged[mappings[2]["3"]]
+        self.assertEqual(sampler["inputs"]["positive"], [mappings[2]["6"], 0])
+        self.assertEqual(merged[mappings[2]["9"]]["inputs"]["images"], [mappings[2]["3"], 0])
+
+    def test_identical_output_nodes_of_a_member_are_kept_apart(self):
+        with open(os.path.join(os.path.dirname(__file__), "..", "test_input.json")) as f:
+            workflow = json.load(f)["input"]["workflow"]
+        batch = handler._Batch("a")
+        batch.workflow, mappings = handler.merge_workflows([workflow, workflow, workflow])
+        batch.mappings = dict(zip("abc", mappings))
+        outputs = {
+            merged_id: {"images": [{"filename": f"{merged_id}.png", "subfolder": "", "type": "output"}]}
+            for merged_id, node in batch.workflow.items() if node["class_type"] == "SaveImage"
+        }
+
+        for job_id in "abc":
+            self.assertEqual(len(handler._member_outputs(batch, job_id, workflow, None, outputs, [])), 2)
+
+    def test_signature_ignores_varying_inputs(self):
+        signature = handler.batch_signature(self._workflow(1, "a cat"))
+        self.assertEqual(handler.batch_signature(self._workflow(2, "a dog")), signature)
+        changed = self._workflow(1, "a cat")
+        changed["5"]["inputs"]["width"] = 1024
+        self.assertNotEqual(handler.batch_signature(changed), signature)
+
+    def test_scheduler_groups_jobs_and_fails_abandoned_batches(self):
+        scheduler = handler.BatchScheduler(0.01, 2)
+        alone = scheduler.join("sig", "a", self._workflow(1, "x"))
+        self.assertFalse(scheduler.close("sig", alone))
+
+        batch = scheduler.join("sig", "b", self._workflow(1, "x"))
+        self.assertIs(scheduler.join("sig", "c", self._workflow(2, "y")), batch)
+        self.assertTrue(batch.full.is_set())
+        self.assertIsNot(scheduler.join("sig", "d", self._workflow(3, "z")), batch)
+        self.assertTrue(scheduler.close("sig", batch))
+        scheduler.abandon("b")
+        self.assertIsNone(batch.done.result())
+
+    @patch("handler.check_server")
+    def test_follower_delivers_its_outputs_of_the_merged_prompt(self, mock_check):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        with open(os.path.join(tmp.name, "ComfyUI_00002_.png"), "wb") as f:
+            f.write(b"follower")
+        scheduler = handler.BatchScheduler(5, 2)
+        leader_workflow, follower_workflow = self._workflow(1, "a cat"), self._workflow(2, "a dog")
+        batch = scheduler.join(handler.batch_signature(leader_workflow), "leader", leader_workflow)
+
+        with patch("handler.batch_scheduler", scheduler), patch("handler.COMFY_OUTPUT_DIR", tmp.name), ThreadPoolExecutor(1) as pool:
+            follower = pool.submit(handler.handler, {"id": "follower", "input": {"workflow": follower_workflow, "response_format": "images"}})
+            batch.full.wait(5)
+            scheduler.close(handler.batch_signature(leader_workflow), batch)
+            saved = batch.mappings["follower"]["9"]
+            scheduler.finish(batch, {
+                "9": {"images": [{"filename": "ComfyUI_00001_.png", "subfolder": "", "type": "output"}]},
+                saved: {"images": [{"filename": "ComfyUI_00002_.png", "subfolder": "", "type": "output"}]},
+            })
+            result = follower.result(timeout=5)
+
+        mock_check.assert_not_called()
+        self.assertEqual(result["images"], [{"filename": "ComfyUI_00002_.png", "type": "base64", "data": base64.b64encode(b"follower").decode()}])
+
+    @patch("handler.check_server", return_value=False)
+    def test_follower_with_node_errors_runs_on_its_own(self, mock_check):
+        scheduler = handler.BatchScheduler(5, 2)
+        leader_workflow, follower_workflow = self._workflow(1, "a cat"), self._workflow(2, "a dog")
+        batch = scheduler.join(handler.batch_signature(leader_workflow), "leader", leader_workflow)
+
+        with patch("handler.batch_scheduler", scheduler), ThreadPoolExecutor(1) as pool:
+            follower = pool.submit(handler.handler, {"id": "follower", "input": {"workflow": follower_workflow}})
+            batch.full.wait(5)
+            scheduler.close(handler.batch_signature(leader_workflow), batch)
+            sampler, saved = batch.mappings["follower"]["3"], batch.mappings["follower"]["9"]
+            leader_failed = handler._check_batch_node_errors(batch, "leader", {
+                "prompt_id": "p1",
+                "node_errors": {sampler: {"errors": [{"type": "value_smaller_than_min"}], "dependent_outputs": [saved], "class_type": "KSampler"}},
+            })
+            scheduler.finish(batch, {"9": {"images": [{"filename": "ComfyUI_00001_.png", "subfolder": "", "type": "output"}]}})
+            result = follower.result(timeout=5)
+
+        self.assertFalse(leader_failed)
+        self.assertEqual(batch.failed, {"follower"})
+        mock_check.assert_called_once()
+        self.assertIn("not reachable", result["error"])
+
+    @patch("handler.check_server", return_value=False)
+    def test_follower_runs_on_its_own_when_the_leader_times_out(self, mock_check):
+        scheduler = handler.BatchScheduler(5, 2)
+        workflow = self._workflow(1, "a cat")
+        batch = scheduler.join(handler.batch_signature(workflow), "leader", workflow)
+
+        with patch("handler.batch_scheduler", scheduler), patch("handler.BATCH_LEADER_TIMEOUT_S", 0.05):
+            result = handler.handler({"id": "follower", "input": {"workflow": self._workflow(2, "a dog")}})
+
+        self.assertFalse(batch.done.done())
+        self.assertIn("not reachable", result["error"])
+
+    def test_leader_reruns_when_a_node_of_another_job_fails(self):
+        batch = handler._Batch("leader")
+        batch.mappings = {"leader": {"3": "3", "9": "9"}, "follower": {"3": "10", "9": "11"}}
+        self.assertTrue(handler._failed_in_other_job(batch, "leader", {"type": "execution_error", "data": {"node_id": "10"}}))
+        self.assertFalse(handler._failed_in_other_job(batch, "leader", {"type": "execution_error", "data": {"node_id": "3"}}))
+
+    def test_window_is_skipped_at_concurrency_one(self):
+        with patch("handler.batch_scheduler", handler.BatchScheduler(0.5, 2)), patch.dict(handler._concurrency_state, {"current": 1}):
+            with patch("handler.COMFY_MAX_CONCURRENCY", 1):
+                self.assertEqual(handler._batch_window_s(), 0)
+            with patch("handler.COMFY_MAX_CONCURRENCY", 4):
+                self.assertEqual(handler._batch_window_s(), 0)
+                handler._concurrency_state["current"] = 2
+                self.assertEqual(handler._batch_window_s(), 0.5)
+
+    def test_invalid_seeds_are_not_batched(self):
+        with patch("handler.batch_scheduler", handler.BatchScheduler(0.01, 2)):
+            self.assertIsNotNone(handler._job_batch_signature({"workflow": self._workflow(1, "a cat")}))
+            for seed in [-1, "1", 1.5, True]:
+                self.assertIsNone(handler._job_batch_signature({"workflow": self._workflow(seed, "a cat")}))
+            for workflow in ["abc", [1], {"3": "node"}]:
+                self.assertIsNone(handler._job_batch_signature({"workflow": workflow}))
+
+
+class TestWorkflowTemplates(unittest.TestCase):
+    def setUp(self):
+        self.templates = handler.load_workflow_templates(os.path.join(os.path.dirname(__file__), "..", "test_resources", "workflows"))
+        self.template = self.templates["workflow_sdxl_turbo"]
+
+    def test_loads_raw_and_job_input_files(self):
+        self.assertIn("flux_dev_checkpoint_example", self.templates)
+        self.assertIn("workflow_flux1_dev", self.templates)
+        self.assertEqual(self.template.targets["prompt"], [("6", "text")])
+        self.assertEqual(self.template.targets["negative_prompt"], [("7", "text")])
+        self.assertEqual(self.template.targets["seed"], [("3", "seed")])
+
+    def test_invalid_files_are_skipped(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for name, content in [("broken.json", "{"), ("dangling.json", '{"1": {"class_type": "VAEDecode", "inputs": {"vae": ["4", 2]}}}')]:
+                with open(os.path.join(directory, name), "w") as f:
+                    f.write(content)
+            self.assertEqual(handler.load_workflow_templates(directory), {})
+
+    def test_instantiate_applies_overrides(self):
+        workflow, error = self.template.instantiate({"prompt": "a lighthouse", "seed": 7, "width": 512, "nodes": {"3": {"steps": 8}}})
+
+        self.assertIsNone(error)
+        self.assertEqual(workflow["6"]["inputs"]["text"], "a lighthouse")
+        self.assertEqual(workflow["3"]["inputs"]["seed"], 7)
+        self.assertEqual(workflow["3"]["inputs"]["steps"], 8)
+        self.assertEqual(workflow["5"]["inputs"]["width"], 512)
+        # The template itself is unchanged and untouched nodes are shared
+        self.assertEqual(self.template.workflow["6"]["inputs"]["text"], "ancient rome, 4k photo")
+        self.assertIs(workflow["4"], self.template.workflow["4"])
+
+    def test_invalid_overrides(self):
+        for overrides, message in [
+            ({"style": "noir"}, "Unknown override"),
+            ({"seed": "7"}, "must be an integer"),
+            ({"images": ["a.png"]}, "has no input for override 'images'"),
+            ({"nodes": {"99": {"seed": 1}}}, "unknown node 99"),
+            ({"nodes": {"3": {"model": ["4", 0]}}}, "no widget input 'model'"),
+        ]:
+            workflow, error = self.template.instantiate(overrides)
+            self.assertIsNone(workflow)
+            self.assertIn(message, error)
+
+    def test_validate_input_builds_the_workflow_from_a_template(self):
+        with patch("handler.workflow_templates", self.templates):
+            validated, error = handler.validate_input({"template": "workflow_sdxl_turbo", "overrides": {"negative_prompt": "blurry"}})
+            self.assertIsNone(error)
+            self.assertEqual(validated["workflow"]["7"]["inputs"]["text"], "blurry")
+
+            self.assertIn("Unknown template", handler.validate_input({"template": "missing"})[1])
+            self.assertIn("not both", handler.validate_input({"template": "workflow_sdxl_turbo", "workflow": {}})[1])
+            self.assertIn("requires 'template'", handler.validate_input({"workflow": {}, "overrides": {"seed": 1}})[1])